@@ -0,0 +1,549 @@
+#!/usr/bin/env python3
+"""
+DGX Chargeback Benchmarks
+
+Loads a synthetic Slurm cluster (see synthetic.py) into embedded SQLite files (the default), or
+a scratch MySQL server, and times the ETL and the report API against it:
+  - extract:    SlurmDb.getJobsRange, getJobsRangeStream and getJobsRangeColumnBatches
+  - parse:      common.parseSlurmJobs (both association backends), the parallel and columnar parsers
+  - load:       ChargebackDb.addUniqueJob and addUniqueJobs, with new and with duplicate jobs
+  - etl:        the cronjob's streaming extract -> parse -> load path over every job
+  - rollup:     ChargebackDb.updateDailyRollup over every day
+  - api:        the report, batch report and export endpoints, through the FastAPI app
+
+Results are written as JSON, tagged with the commit and the data set, and can be compared
+with the results of another run (E.g. on the base commit) with --compare.
+With the mysql backend and no --db-host, only the benchmarks that need no database (parse) are run.
+"""
+
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from os import environ
+from datetime import datetime
+from functools import partial
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+import logzero
+from logzero import logger
+from prettytable import PrettyTable
+import synthetic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import common
+import columnar
+import database
+import ssh
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARGEBACK_SCHEMA_FILE = os.path.join(BENCH_DIR, '..', 'deploy', 'files', 'chargeback_db.sql')
+CHARGEBACK_TABLE = 'gpu_usage'
+
+# The columns of the Slurm tables that the ETL reads, with the types slurmdbd uses
+#  The statements work on both backends, every row is inserted with its ID
+SLURM_TABLES = [
+    """CREATE TABLE `{cluster}_job_table` (
+        `job_db_inx` BIGINT UNSIGNED NOT NULL,
+        `job_name` TINYTEXT NOT NULL,
+        `id_job` INT UNSIGNED NOT NULL,
+        `time_start` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        `time_end` BIGINT UNSIGNED NOT NULL DEFAULT 0,
+        `cpus_req` INT UNSIGNED NOT NULL,
+        `exit_code` INT UNSIGNED NOT NULL DEFAULT 0,
+        `id_user` INT UNSIGNED NOT NULL,
+        `id_group` INT UNSIGNED NOT NULL,
+        `nodelist` TEXT,
+        `nodes_alloc` INT UNSIGNED NOT NULL,
+        `state` INT UNSIGNED NOT NULL,
+        `tres_req` TEXT NOT NULL,
+        `tres_alloc` TEXT NOT NULL,
+        `account` TINYTEXT,
+        `partition` TINYTEXT NOT NULL,
+        PRIMARY KEY (`job_db_inx`)
+    )""",
+    "CREATE INDEX `{cluster}_rollup2` ON `{cluster}_job_table` (`time_end`)",
+    """CREATE TABLE `{cluster}_assoc_table` (
+        `id_assoc` INT UNSIGNED NOT NULL,
+        `user` TINYTEXT NOT NULL,
+        `acct` TINYTEXT NOT NULL,
+        `is_def` TINYINT NOT NULL DEFAULT 0,
+        `deleted` TINYINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (`id_assoc`)
+    )""",
+    """CREATE TABLE `bench_dataset` (
+        `fingerprint` CHAR(32) NOT NULL,
+        PRIMARY KEY (`fingerprint`)
+    )"""
+]
+
+class BenchmarkRunner:
+    """
+    Runs benchmarks and collects their results
+    Each benchmark is repeated, with an untimed setup before each repeat, and the median time is
+    reported. The run events (E.g. DB round trips) of the last repeat are kept with the result.
+    """
+    def __init__(self, repeat, only=None):
+        self._repeat = repeat
+        self._only = only
+        self.results = {}
+
+    def isSelected(self, name):
+        return not self._only or any(name == prefix or name.startswith(prefix + '.') for prefix in self._only)
+
+    def run(self, name, func, setup=None, repeat=None):
+        """
+        Time func, which returns the number of items it processed, or (items, [per-item latencies])
+        """
+        if not self.isSelected(name):
+            return None
+        runs = []
+        latencies = []
+        items = 0
+        for _ in range(repeat or self._repeat):
+            if setup is not None:
+                setup()
+            common.resetEvents()
+            started = time.perf_counter()
+            result = func()
+            runs.append(time.perf_counter() - started)
+            items, latencies = result if isinstance(result, tuple) else (result, [])
+
+        seconds = statistics.median(runs)
+        self.results[name] = {
+            "seconds": round(seconds, 6),
+            "min_seconds": round(min(runs), 6),
+            "runs": [round(run, 6) for run in runs],
+            "items": items,
+            "items_per_sec": round(items / seconds, 1) if seconds else None,
+            "events": common.getEvents()[0]
+        }
+        if latencies:
+            latencies = sorted(latencies)
+            self.results[name]["latency_ms"] = {
+                "p50": round(latencies[len(latencies) // 2] * 1000, 3),
+                "p95": round(latencies[int(len(latencies) * 0.95)] * 1000, 3),
+                "max": round(latencies[-1] * 1000, 3)
+            }
+        logger.info("{}: {:.3f} sec, {} items".format(name, seconds, items))
+        return self.results[name]
+
+def getCommit():
+    """
+    Get the current commit, and whether the tracked files have uncommitted changes
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR, capture_output=True, text=True, check=True).stdout.strip() != ''
+        return commit, dirty
+    except Exception as err:
+        logger.warning("Failed to get the git commit: {}".format(err))
+        return 'unknown', False
+
+def getSchema(args, schemaName):
+    """
+    Get the database name of a schema. With the sqlite backend, each schema is a file in --db-dir
+    """
+    if args.db_backend == 'sqlite':
+        return os.path.join(os.path.abspath(args.db_dir), schemaName + ".db")
+    return schemaName
+
+def dropSchema(args, schemaName):
+    if args.db_backend == 'sqlite':
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(getSchema(args, schemaName) + suffix):
+                os.remove(getSchema(args, schemaName) + suffix)
+    else:
+        with database.MySqlDb(args.db_username, args.db_password, args.db_host, args.db_port, None) as db:
+            db.executeQuery("DROP DATABASE IF EXISTS `" + schemaName + "`")
+            db.executeQuery("CREATE DATABASE `" + schemaName + "`")
+
+def getSlurmDb(args):
+    return database.SlurmDb(
+        args.slurm_cluster_name, args.db_username, args.db_password,
+        args.db_host, args.db_port, getSchema(args, args.slurm_db_schema_name), backend=args.db_backend)
+
+def getChargebackDb(args):
+    return database.ChargebackDb(
+        CHARGEBACK_TABLE, args.db_username, args.db_password,
+        args.db_host, args.db_port, getSchema(args, args.chargeback_db_schema_name), backend=args.db_backend)
+
+def insertRows(db, table, rows, batchSize=10000):
+    """
+    Insert an iterable of dicts into a table with multi-row inserts, returning the number of rows
+    """
+    count = 0
+    query = None
+    batch = []
+    for row in rows:
+        if query is None:
+            fields = ", ".join("`{}`".format(key) for key in row.keys())
+            query = "INSERT INTO " + table + " (" + fields + ") VALUES (" + ", ".join(["%s"] * len(row)) + ")"
+        batch.append(tuple(row.values()))
+        if len(batch) >= batchSize:
+            count += db.insertManyQuery(query, batch)
+            batch = []
+    if batch:
+        count += db.insertManyQuery(query, batch)
+    return count
+
+def setupSlurmDb(args, cluster):
+    """
+    Create the Slurm schema and load the synthetic cluster into it
+    A schema that already holds the same data set is reused, unless --reload is set
+    """
+    if not args.reload:
+        try:
+            with getSlurmDb(args) as slurmDb:
+                rows = slurmDb.readQuery("SELECT fingerprint FROM bench_dataset", None)
+            if rows and rows[0]["fingerprint"] == cluster.getFingerprint():
+                logger.info("Reusing the Slurm data set '{}' in '{}'".format(cluster.getFingerprint(), args.slurm_db_schema_name))
+                return {"reused": True}
+        except Exception:
+            pass
+    dropSchema(args, args.slurm_db_schema_name)
+
+    logger.info("Loading '{}' synthetic jobs into '{}'".format(cluster.jobs, args.slurm_db_schema_name))
+    started = time.perf_counter()
+    with getSlurmDb(args) as slurmDb:
+        for statement in SLURM_TABLES:
+            slurmDb.executeQuery(statement.format(cluster=args.slurm_cluster_name))
+        insertRows(slurmDb, args.slurm_cluster_name + "_assoc_table", cluster.iterAssocRows())
+        jobs = insertRows(slurmDb, args.slurm_cluster_name + "_job_table", cluster.iterJobs())
+        slurmDb.insertQuery("INSERT INTO bench_dataset (fingerprint) VALUES (%s)", (cluster.getFingerprint(),))
+    seconds = time.perf_counter() - started
+    return {"seconds": round(seconds, 3), "items": jobs, "items_per_sec": round(jobs / seconds, 1)}
+
+def setupChargebackDb(args, cluster):
+    """
+    Create the Chargeback schema from the deployed schema file, with month partitions covering the data set
+    The sqlite backend creates its own schema
+    """
+    dropSchema(args, args.chargeback_db_schema_name)
+    if args.db_backend == 'sqlite':
+        getChargebackDb(args).close()
+        return
+
+    with open(CHARGEBACK_SCHEMA_FILE) as schemaFile:
+        statements = [statement.strip() for statement in schemaFile.read().split(';')]
+    with getChargebackDb(args) as chargebackDb:
+        for statement in statements:
+            if statement:
+                chargebackDb.executeQuery(statement)
+        chargebackDb.addMonthPartitions(cluster.endDate[:7])
+
+def truncateChargebackDb(args):
+    with getChargebackDb(args) as chargebackDb:
+        chargebackDb.executeQuery(("TRUNCATE TABLE " if args.db_backend == 'mysql' else "DELETE FROM ") + CHARGEBACK_TABLE)
+
+def runExtractBenchmarks(runner, args, sampleRange):
+    def getJobsRange():
+        with getSlurmDb(args) as slurmDb:
+            return len(slurmDb.getJobsRange(sampleRange["start"], sampleRange["end"]))
+
+    def getJobsRangeStream():
+        with getSlurmDb(args) as slurmDb:
+            return sum(1 for job in slurmDb.getJobsRangeStream(sampleRange["start"], sampleRange["end"], args.fetch_batch_size))
+
+    def getJobsRangeColumnBatches():
+        with getSlurmDb(args) as slurmDb:
+            return sum(len(columns["id_job"]) for columns in slurmDb.getJobsRangeColumnBatches(sampleRange["start"], sampleRange["end"], args.fetch_batch_size))
+
+    runner.run("extract.getJobsRange", getJobsRange)
+    runner.run("extract.getJobsRangeStream", getJobsRangeStream)
+    runner.run("extract.getJobsRangeColumnBatches", getJobsRangeColumnBatches)
+
+def runParseBenchmarks(runner, args, cluster, jobs, batches, identityIndex, slurmAssocIndex):
+    # TRES strings are memoized by common.parseTres, every repeat starts with an empty cache
+    def clearCaches():
+        common.parseTres.cache_clear()
+
+    def parseRows(slurmAssocBackend):
+        return lambda: len(common.parseSlurmJobs(jobs, identityIndex, slurmAssocBackend, dict(slurmAssocIndex), '', args.gpus_used_field))
+
+    def parseColumns():
+        return sum(len(columnar.parseSlurmJobColumns(columns, identityIndex, 'slurm_acctdb', dict(slurmAssocIndex), '', args.gpus_used_field)) for columns in batches)
+
+    def parseParallel():
+        return sum(1 for record in common.iterParseSlurmJobsParallel(
+            jobs, identityIndex, 'slurm_acctdb', dict(slurmAssocIndex), '', args.parse_workers, args.parse_chunk_size, args.gpus_used_field))
+
+    runner.run("parse.parseSlurmJobs.slurm_acctdb", parseRows('slurm_acctdb'), clearCaches)
+    runner.run("parse.parseSlurmJobs.etc_group", parseRows('etc_group'), clearCaches)
+    runner.run("parse.parseSlurmJobColumns", parseColumns, clearCaches)
+    runner.run("parse.iterParseSlurmJobsParallel", parseParallel, clearCaches)
+
+def runLoadBenchmarks(runner, args, records):
+    singleRecords = records[:args.single_insert_jobs]
+
+    def addUniqueJob():
+        with getChargebackDb(args) as chargebackDb:
+            return sum(1 for record in singleRecords if chargebackDb.addUniqueJob(record))
+
+    def addUniqueJobs():
+        with getChargebackDb(args) as chargebackDb:
+            return chargebackDb.addUniqueJobs(records, args.insert_chunk_size, args.slurm_cluster_name)[0]
+
+    runner.run("load.addUniqueJob", addUniqueJob, partial(truncateChargebackDb, args))
+    runner.run("load.addUniqueJobs", addUniqueJobs, partial(truncateChargebackDb, args))
+
+def runEtlBenchmarks(runner, args, cluster, identityIndex, slurmAssocIndex, records):
+    """
+    Run the cronjob's streaming path over every job, and leave the chargeback table loaded for the reports
+    """
+    dateRange = cluster.getDateRangeUnix()
+
+    def etl():
+        with getSlurmDb(args) as slurmDb, getChargebackDb(args) as chargebackDb:
+            jobs = slurmDb.getJobsRangeStream(dateRange["start"], dateRange["end"], args.fetch_batch_size)
+            chargebackRecords = common.iterParseSlurmJobs(jobs, identityIndex, 'slurm_acctdb', dict(slurmAssocIndex), '', args.gpus_used_field)
+            return chargebackDb.addUniqueJobs(chargebackRecords, args.insert_chunk_size, args.slurm_cluster_name)[0]
+
+    def addDuplicateJobs():
+        with getChargebackDb(args) as chargebackDb:
+            return len(records) - chargebackDb.addUniqueJobs(records, args.insert_chunk_size, args.slurm_cluster_name)[0]
+
+    def updateDailyRollup():
+        with getChargebackDb(args) as chargebackDb:
+            chargebackDb.updateDailyRollup(cluster.getDays(), args.min_job_duration_sec)
+        return len(cluster.getDays())
+
+    def clearEtl():
+        common.parseTres.cache_clear()
+        truncateChargebackDb(args)
+
+    # Every repeat of the ETL reloads the full table, so it only runs once
+    #  The later benchmarks need the full table, so it is loaded untimed if the ETL is not selected
+    if not runner.run("etl.stream", etl, clearEtl, repeat=1):
+        clearEtl()
+        etl()
+    runner.run("load.addUniqueJobs.duplicates", addDuplicateJobs)
+
+    # The report benchmarks read the rollup, so it is also built untimed if not selected
+    if not runner.run("rollup.updateDailyRollup", updateDailyRollup):
+        updateDailyRollup()
+
+def runApiBenchmarks(runner, args, cluster):
+    """
+    Time the report endpoints through the FastAPI app, with the report cache cold and warm
+    """
+    # The API reads its settings from the environment when it is imported
+    environ.update({
+        "CHARGEBACK_DB_BACKEND": args.db_backend,
+        "SLURM_DB_BACKEND": args.db_backend,
+        "CHARGEBACK_DB_TABLE_NAME": CHARGEBACK_TABLE,
+        "CHARGEBACK_DB_USERNAME": args.db_username,
+        "CHARGEBACK_DB_PASSWORD": args.db_password,
+        "CHARGEBACK_DB_HOST": args.db_host,
+        "CHARGEBACK_DB_PORT": str(args.db_port),
+        "CHARGEBACK_DB_SCHEMA_NAME": getSchema(args, args.chargeback_db_schema_name),
+        "SLURM_CLUSTER_NAME": args.slurm_cluster_name,
+        "SLURM_DB_USERNAME": args.db_username,
+        "SLURM_DB_PASSWORD": args.db_password,
+        "SLURM_DB_HOST": args.db_host,
+        "SLURM_DB_PORT": str(args.db_port),
+        "GPU_USD_COST_PER_MINUTE": "0.05",
+        "API_REPORT_CACHE_POLL_SEC": "3600"
+    })
+    from fastapi.testclient import TestClient
+    import api
+    api.env.slurm_db_name = getSchema(args, args.slurm_db_schema_name)
+
+    days = cluster.getDays()
+    reportParams = {"range": "dateRange", "start_date": days[0], "end_date": days[-1]}
+    exportParams = {"range": "dateRange", "start_date": days[-7], "end_date": days[-1]}
+    usernames = random.Random(cluster.seed).sample(cluster.getUsernames(), min(args.report_requests, len(cluster.getUsernames())))
+
+    def clearReportCache():
+        with getChargebackDb(args) as chargebackDb:
+            chargebackDb.bumpGeneration()
+        api.reportCache.refreshGeneration()
+
+    def getReports(client, path, useRollup=True):
+        def run():
+            api.env.report_use_rollup = useRollup
+            latencies = []
+            for username in usernames:
+                started = time.perf_counter()
+                response = client.get(path.format(username), params=reportParams)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+            return len(usernames), latencies
+        return run
+
+    def getBatchReport(client, target_type):
+        def run():
+            response = client.post("/report/batch", json={"target_type": target_type, **reportParams})
+            response.raise_for_status()
+            return response.text.count("\n")
+        return run
+
+    def exportJobs(client):
+        response = client.get("/export/jobs", params={**exportParams, "format": "csv"})
+        response.raise_for_status()
+        return response.text.count("\n") - 1
+
+    with TestClient(api.app) as client:
+        runner.run("api.report_users", getReports(client, "/report/users/{}"), clearReportCache)
+        runner.run("api.report_users.cached", getReports(client, "/report/users/{}"))
+        runner.run("api.report_users.no_rollup", getReports(client, "/report/users/{}", False), clearReportCache)
+        runner.run("api.report_groups", getReports(client, "/report/groups/{}"), clearReportCache)
+        runner.run("api.report_batch.users", getBatchReport(client, 'user'))
+        runner.run("api.report_batch.groups", getBatchReport(client, 'group'))
+        runner.run("api.export_jobs", partial(exportJobs, client))
+
+def formatResults(results, baseResults=None):
+    """
+    Format the results as a table, with the change from the base results if given
+    """
+    columns = ["Benchmark", "Items", "Median sec", "Min sec", "Items/sec", "p95 ms"]
+    if baseResults is not None:
+        columns += ["Base sec", "Change"]
+    table = PrettyTable(columns)
+    table.align = "r"
+    table.align["Benchmark"] = "l"
+    for name, result in results.items():
+        row = [name, result["items"], "{:.3f}".format(result["seconds"]), "{:.3f}".format(result["min_seconds"]),
+               result["items_per_sec"], result.get("latency_ms", {}).get("p95", "")]
+        if baseResults is not None:
+            base = baseResults.get(name)
+            if base is not None and base["seconds"]:
+                row += ["{:.3f}".format(base["seconds"]), "{:+.1%}".format(result["seconds"] / base["seconds"] - 1)]
+            else:
+                row += ["", ""]
+        table.add_row(row)
+    return table.get_string()
+
+def main(args):
+    """ Main entry point of the app """
+    logzero.loglevel(args.log_level)
+    cluster = synthetic.SyntheticCluster(args.jobs, args.users, args.accounts, args.days, args.end_date, args.seed)
+    runner = BenchmarkRunner(args.repeat, [name.strip() for name in args.only.split(',') if name.strip()])
+    commit, dirty = getCommit()
+    setup = {}
+    print("Benchmarking commit '{}'{} with data set '{}': {}".format(commit, " (dirty)" if dirty else "", cluster.getFingerprint(), cluster.getParams()))
+
+    # The in-memory benchmarks use the first 'sample' jobs, the database is loaded with every job
+    sampleJobs = min(args.sample_jobs, cluster.jobs)
+    sampleRange = {"start": cluster.getDateRangeUnix()["start"], "end": cluster.getJobTimeEnd(sampleJobs) - 1}
+    started = time.perf_counter()
+    jobs = list(cluster.iterJobs(sampleJobs))
+    batches = list(cluster.iterJobColumnBatches(args.fetch_batch_size, sampleJobs))
+    setup["generate_sample"] = {"seconds": round(time.perf_counter() - started, 3), "items": sampleJobs}
+
+    identityIndex = ssh.IdentityIndex.fromFiles(cluster.getPasswdFile(), cluster.getGroupFile())
+    slurmAssocIndex = common.buildSlurmAssocIndex(
+        [row for row in cluster.iterAssocRows() if row["user"] != '' and row["deleted"] == 0])
+
+    runParseBenchmarks(runner, args, cluster, jobs, batches, identityIndex, slurmAssocIndex)
+
+    if args.db_backend == 'sqlite' or args.db_host:
+        os.makedirs(args.db_dir, exist_ok=True)
+        setup["load_slurm_db"] = setupSlurmDb(args, cluster)
+        setupChargebackDb(args, cluster)
+        records = common.parseSlurmJobs(jobs, identityIndex, 'slurm_acctdb', dict(slurmAssocIndex), '', args.gpus_used_field)
+        runExtractBenchmarks(runner, args, sampleRange)
+        runLoadBenchmarks(runner, args, records)
+        runEtlBenchmarks(runner, args, cluster, identityIndex, slurmAssocIndex, records)
+        if any(runner.isSelected("api." + name) for name in ["report_users", "report_groups", "report_batch", "export_jobs"]):
+            runApiBenchmarks(runner, args, cluster)
+    else:
+        logger.warning("No --db-host set for the mysql backend, only running the benchmarks that need no database")
+
+    output = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.now().isoformat(timespec='seconds'),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "dataset": cluster.getFingerprint(),
+        "params": {**cluster.getParams(), "db_backend": args.db_backend, "sample_jobs": sampleJobs, "repeat": args.repeat,
+                   "fetch_batch_size": args.fetch_batch_size, "insert_chunk_size": args.insert_chunk_size,
+                   "parse_workers": args.parse_workers, "report_requests": len(cluster.getUsernames()[:args.report_requests])},
+        "setup": setup,
+        "results": runner.results
+    }
+
+    baseResults = None
+    if args.compare:
+        with open(args.compare) as baseFile:
+            base = json.load(baseFile)
+        # The number of repeats does not change what is measured
+        baseParams = {name: value for name, value in base.get("params", {}).items() if name != "repeat"}
+        params = {name: value for name, value in output["params"].items() if name != "repeat"}
+        if base.get("dataset") != output["dataset"] or baseParams != params:
+            logger.warning("'{}' was run with different parameters, the results are not comparable".format(args.compare))
+        print("Comparing with commit '{}'{}".format(base.get("commit"), " (dirty)" if base.get("dirty") else ""))
+        baseResults = base.get("results", {})
+    print(formatResults(runner.results, baseResults))
+
+    outputFile = args.output or os.path.join(BENCH_DIR, 'results', "{}{}-{}.json".format(commit, "-dirty" if dirty else "", cluster.getFingerprint()))
+    os.makedirs(os.path.dirname(os.path.abspath(outputFile)), exist_ok=True)
+    with open(outputFile, "w") as resultsFile:
+        json.dump(output, resultsFile, indent=2)
+    print("Wrote results to '{}'".format(outputFile))
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Synthetic data set
+    #  The same parameters always generate the same data
+    parser.add_argument("--jobs", type=int, default=environ.get("BENCH_JOBS", "100000").strip())
+    parser.add_argument("--users", type=int, default=environ.get("BENCH_USERS", "1000").strip())
+    parser.add_argument("--accounts", type=int, default=environ.get("BENCH_ACCOUNTS", "0").strip())
+    parser.add_argument("--days", type=int, default=environ.get("BENCH_DAYS", "90").strip())
+    parser.add_argument("--end-date", default=environ.get("BENCH_END_DATE", "2024-06-30").strip())
+    parser.add_argument("--seed", type=int, default=environ.get("BENCH_SEED", "1").strip())
+
+    # Number of jobs held in memory for the extract, parse and load benchmarks
+    parser.add_argument("--sample-jobs", type=int, default=environ.get("BENCH_SAMPLE_JOBS", "100000").strip())
+    # Number of jobs inserted one at a time by addUniqueJob
+    parser.add_argument("--single-insert-jobs", type=int, default=environ.get("BENCH_SINGLE_INSERT_JOBS", "2000").strip())
+    # Number of users each report benchmark requests a report for
+    parser.add_argument("--report-requests", type=int, default=environ.get("BENCH_REPORT_REQUESTS", "200").strip())
+
+    # Runs
+    #  Benchmarks can be selected by name or prefix, E.g. "parse,load.addUniqueJobs"
+    parser.add_argument("--repeat", type=int, default=environ.get("BENCH_REPEAT", "3").strip())
+    parser.add_argument("--only", default=environ.get("BENCH_ONLY", "").strip())
+    parser.add_argument("--output", default=environ.get("BENCH_OUTPUT", "").strip())
+    parser.add_argument("--compare", default=environ.get("BENCH_COMPARE", "").strip())
+    parser.add_argument("--log-level", default=environ.get("LOG_LEVEL", "WARNING").strip())
+
+    # Settings of the code under test, named as in the cronjob
+    parser.add_argument("--fetch-batch-size", type=int, default=environ.get("SLURM_DB_FETCH_BATCH_SIZE", "5000").strip())
+    parser.add_argument("--insert-chunk-size", type=int, default=environ.get("CHARGEBACK_DB_INSERT_CHUNK_SIZE", "1000").strip())
+    parser.add_argument("--parse-workers", type=int, default=environ.get("PARSE_WORKERS", "4").strip())
+    parser.add_argument("--parse-chunk-size", type=int, default=environ.get("PARSE_CHUNK_SIZE", "5000").strip())
+    parser.add_argument("--gpus-used-field", default=environ.get("GPUS_USED_FIELD", "tres_req").strip())
+    parser.add_argument("--min-job-duration-sec", type=int, default=environ.get("ROLLUP_MIN_JOB_DURATION_SEC", "60").strip())
+
+    # Database backend, "sqlite" (files in db-dir) or "mysql" (a scratch server)
+    #  The schemas are dropped and recreated, never point this at a real database
+    parser.add_argument("--db-backend", default=environ.get("BENCH_DB_BACKEND", "sqlite").strip())
+    parser.add_argument("--db-dir", default=environ.get("BENCH_DB_DIR", os.path.join(BENCH_DIR, "data")).strip())
+    parser.add_argument("--db-host", default=environ.get("BENCH_DB_HOST", "").strip())
+    parser.add_argument("--db-port", type=int, default=environ.get("BENCH_DB_PORT", "3306").strip())
+    parser.add_argument("--db-username", default=environ.get("BENCH_DB_USERNAME", "root").strip())
+    parser.add_argument("--db-password", default=environ.get("BENCH_DB_PASSWORD", "").strip())
+    parser.add_argument("--slurm-db-schema-name", default=environ.get("BENCH_SLURM_DB_SCHEMA_NAME", "bench_slurm_acct_db").strip())
+    parser.add_argument("--chargeback-db-schema-name", default=environ.get("BENCH_CHARGEBACK_DB_SCHEMA_NAME", "bench_chargeback").strip())
+    parser.add_argument("--slurm-cluster-name", default=environ.get("BENCH_SLURM_CLUSTER_NAME", "bench").strip())
+    # Reload the Slurm data set even if the schema already holds it
+    parser.add_argument("--reload", action='store_true', default=environ.get("BENCH_RELOAD", "false").strip().lower() == "true")
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,251 @@
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from datetime import datetime, timedelta
+import hashlib
+import json
+import numpy as np
+
+"""
+Synthetic Slurm accounting data
+Generates <cluster>_job_table and <cluster>_assoc_table rows, and the matching
+/etc/passwd and /etc/group files, for benchmarking. The data only depends on the parameters
+(and GENERATOR_VERSION), so runs with the same parameters see the same data on any commit.
+A small share of the data is made to hit the ETL's problem paths (unmapped UIDs, users without
+a '-G' group or Slurm association, jobs without GPUs or an account), like a real cluster.
+"""
+
+# Bump when the generated data changes, so results from different generators are not compared
+GENERATOR_VERSION = 1
+
+# Jobs are generated in fixed blocks, each with its own random stream, so the data does not
+#  depend on the batch size it is read in
+_BLOCK_SIZE = 10000
+
+_JOB_NAMES = np.array(['train', 'eval', 'notebook', 'preprocess', 'finetune', 'inference', 'sweep', 'bash'], dtype=object)
+_PARTITIONS = np.array(['batch', 'interactive', 'debug', 'preempt'], dtype=object)
+_PARTITION_P = [0.7, 0.15, 0.1, 0.05]
+_STATES = np.array([3, 5, 4, 6, 7, 8])
+_STATE_P = [0.72, 0.12, 0.1, 0.04, 0.01, 0.01]
+_GPUS = np.array([1, 2, 4, 8, 16, 32])
+_GPU_P = [0.45, 0.22, 0.15, 0.13, 0.03, 0.02]
+_CPUS_PER_GPU = 16
+_GPUS_PER_NODE = 8
+_NODE_COUNT = 64
+
+class SyntheticCluster:
+
+    def __init__(self, jobs, users, accounts=None, days=90, endDate='2024-06-30', seed=1):
+        """
+        Describe a synthetic cluster. Jobs end evenly spread over the 'days' days before endDate.
+        Users and accounts are generated up front, jobs are generated as they are read.
+        """
+        self.jobs = int(jobs)
+        self.users = int(users)
+        self.accounts = int(accounts or max(self.users // 25, 1))
+        self.days = int(days)
+        self.endDate = endDate
+        self.seed = int(seed)
+
+        end = datetime.strptime(endDate, "%Y-%m-%d") + timedelta(days=1)
+        self._startUnix = int((end - timedelta(days=self.days)).timestamp())
+        self._endUnix = int(end.timestamp()) - 1
+
+        rng = np.random.default_rng([self.seed, 0])
+        self._uids = 20000 + np.arange(self.users)
+        self._usernames = np.array(["user{:06d}".format(index) for index in range(self.users)], dtype=object)
+        self._accountNames = np.array(["acct{:05d}".format(index) for index in range(self.accounts)], dtype=object)
+        self._userAccounts = rng.integers(0, self.accounts, self.users)
+
+        # A few percent of users hit each of the ETL's lookup problems
+        self._unmapped = rng.random(self.users) < 0.01
+        self._noSuffixGroup = rng.random(self.users) < 0.02
+        self._noAssoc = rng.random(self.users) < 0.01
+        self._secondAccount = np.where(rng.random(self.users) < 0.1, rng.integers(0, self.accounts, self.users), -1)
+
+        # Activity is skewed, a few users submit most of the jobs
+        weights = 1.0 / np.power(np.arange(1, self.users + 1), 0.8)
+        self._userWeights = rng.permutation(weights / weights.sum())
+
+    def getParams(self):
+        return {
+            "jobs": self.jobs,
+            "users": self.users,
+            "accounts": self.accounts,
+            "days": self.days,
+            "end_date": self.endDate,
+            "seed": self.seed,
+            "generator_version": GENERATOR_VERSION
+        }
+
+    def getFingerprint(self):
+        """
+        Get a short hash identifying the generated data
+        """
+        return hashlib.sha1(json.dumps(self.getParams(), sort_keys=True).encode()).hexdigest()[:12]
+
+    def getDateRangeUnix(self):
+        """
+        Get the start/end range in UNIX timestamps covering every job
+        """
+        return {"start": self._startUnix, "end": self._endUnix}
+
+    def getJobTimeEnd(self, index):
+        """
+        Get the earliest possible time_end of the job at index. time_end never decreases with the index,
+        so the first n jobs are exactly the jobs with time_end below getJobTimeEnd(n)
+        """
+        span = self._endUnix - self._startUnix
+        return self._startUnix + (index * span) // self.jobs
+
+    def getDays(self):
+        """
+        Get the 'YYYY-MM-DD' days covered by the jobs
+        """
+        start = datetime.fromtimestamp(self._startUnix).date()
+        return [(start + timedelta(days=day)).strftime("%Y-%m-%d") for day in range(self.days)]
+
+    def getUsernames(self, mappedOnly=True):
+        """
+        Get the usernames, by default only those in the passwd file
+        """
+        if mappedOnly:
+            return self._usernames[~self._unmapped].tolist()
+        return self._usernames.tolist()
+
+    def getAccountNames(self):
+        return self._accountNames.tolist()
+
+    def getPasswdFile(self):
+        """
+        Get the /etc/passwd file. Unmapped users are left out, so their UIDs do not resolve
+        """
+        lines = ["root:x:0:0:root:/root:/bin/bash", "nobody:x:65534:65534:nobody:/nonexistent:/usr/sbin/nologin"]
+        for index in range(self.users):
+            if self._unmapped[index]:
+                continue
+            username = self._usernames[index]
+            lines.append("{0}:x:{1}:{2}:{0}:/home/{0}:/bin/bash".format(username, self._uids[index], self._getPrimaryGid(index)))
+        return "\n".join(lines) + "\n"
+
+    def getGroupFile(self):
+        """
+        Get the /etc/group file. Each account has a '<account>-G' group, which is the primary group of its users
+        Users with a second account are also listed as members of its group
+        """
+        members = [[] for _ in range(self.accounts)]
+        for index in np.flatnonzero(self._secondAccount >= 0).tolist():
+            members[self._secondAccount[index]].append(self._usernames[index])
+        lines = ["root:x:0:", "users:x:100:", "nogroup:x:65534:"]
+        for index, accountName in enumerate(self._accountNames.tolist()):
+            lines.append("{}-G:x:{}:{}".format(accountName, 30000 + index, ",".join(members[index])))
+        return "\n".join(lines) + "\n"
+
+    def _getPrimaryGid(self, index):
+        if self._noSuffixGroup[index]:
+            return 100
+        return 30000 + int(self._userAccounts[index])
+
+    def iterAssocRows(self):
+        """
+        Yield the <cluster>_assoc_table rows: an account level row per account, and a default
+        association per user, with a second non-default association for some users
+        Users without an association only have deleted rows.
+        """
+        index = 0
+        for accountName in self._accountNames.tolist():
+            index += 1
+            yield {"id_assoc": index, "user": "", "acct": accountName, "is_def": 0, "deleted": 0}
+        for user in range(self.users):
+            deleted = int(self._noAssoc[user])
+            index += 1
+            yield {"id_assoc": index, "user": self._usernames[user], "acct": self._accountNames[self._userAccounts[user]], "is_def": 1, "deleted": deleted}
+            if self._secondAccount[user] >= 0:
+                index += 1
+                yield {"id_assoc": index, "user": self._usernames[user], "acct": self._accountNames[self._secondAccount[user]], "is_def": 0, "deleted": deleted}
+
+    def _generateBlock(self, block):
+        """
+        Generate the jobs of one block as a dict of column lists, like SlurmDb.getJobsRangeColumnBatches
+        """
+        first = block * _BLOCK_SIZE
+        count = min(_BLOCK_SIZE, self.jobs - first)
+        rng = np.random.default_rng([self.seed, 1, block])
+        index = np.arange(first, first + count)
+
+        # time_end never decreases with the job index, see getJobTimeEnd
+        span = self._endUnix - self._startUnix
+        slotStart = self._startUnix + (index * span) // self.jobs
+        slotEnd = self._startUnix + ((index + 1) * span) // self.jobs
+        timeEnd = slotStart + (rng.random(count) * (slotEnd - slotStart)).astype(np.int64)
+        duration = np.clip(rng.lognormal(np.log(1800), 1.5, count), 1, 7 * 86400).astype(np.int64)
+        timeStart = timeEnd - duration
+
+        user = rng.choice(self.users, count, p=self._userWeights)
+        state = rng.choice(_STATES, count, p=_STATE_P)
+        gpus = np.where(rng.random(count) < 0.85, rng.choice(_GPUS, count, p=_GPU_P), 0)
+        nodes = np.maximum(1, -(-gpus // _GPUS_PER_NODE))
+        cpus = np.maximum(gpus * _CPUS_PER_GPU, rng.choice([1, 2, 4, 8], count))
+        firstNode = rng.integers(0, _NODE_COUNT - 4, count)
+        hasAccount = rng.random(count) >= 0.05
+        notAllocated = rng.random(count) < 0.03
+
+        tresReq = []
+        for jobCpus, jobNodes, jobGpus in zip(cpus.tolist(), nodes.tolist(), gpus.tolist()):
+            tres = "1={0},2={1},4={2},5={0}".format(jobCpus, jobCpus * 4096, jobNodes)
+            if jobGpus:
+                tres += ",1001={}".format(jobGpus)
+            tresReq.append(tres)
+        nodelist = [
+            "dgx{:03d}".format(node) if jobNodes == 1 else "dgx[{:03d}-{:03d}]".format(node, node + jobNodes - 1)
+            for node, jobNodes in zip(firstNode.tolist(), nodes.tolist())
+        ]
+
+        return {
+            "job_db_inx":  (index + 1).tolist(),
+            "job_name":    (_JOB_NAMES[rng.integers(0, len(_JOB_NAMES), count)] + "-" + rng.integers(0, 10, count).astype(str).astype(object)).tolist(),
+            "id_job":      (1000000 + index).tolist(),
+            "time_start":  timeStart.tolist(),
+            "time_end":    timeEnd.tolist(),
+            "cpus_req":    cpus.tolist(),
+            "exit_code":   np.where(state == 3, 0, 256).tolist(),
+            "id_user":     self._uids[user].tolist(),
+            "id_group":    [self._getPrimaryGid(userIndex) for userIndex in user.tolist()],
+            "nodelist":    nodelist,
+            "nodes_alloc": nodes.tolist(),
+            "state":       state.tolist(),
+            "tres_req":    tresReq,
+            "tres_alloc":  ['' if skip else tres for skip, tres in zip(notAllocated.tolist(), tresReq)],
+            "account":     [self._accountNames[self._userAccounts[userIndex]] if keep else None for userIndex, keep in zip(user.tolist(), hasAccount.tolist())],
+            "partition":   _PARTITIONS[rng.choice(len(_PARTITIONS), count, p=_PARTITION_P)].tolist()
+        }
+
+    def iterJobColumnBatches(self, batchSize=5000, limit=None):
+        """
+        Yield the first 'limit' jobs (all by default) as batches of column lists
+        """
+        limit = self.jobs if limit is None else min(limit, self.jobs)
+        pending = None
+        for block in range(-(-limit // _BLOCK_SIZE)):
+            columns = self._generateBlock(block)
+            keep = min(_BLOCK_SIZE, limit - block * _BLOCK_SIZE)
+            if pending is None:
+                pending = {name: values[:keep] for name, values in columns.items()}
+            else:
+                for name, values in columns.items():
+                    pending[name].extend(values[:keep])
+            while len(pending["job_db_inx"]) >= batchSize:
+                yield {name: values[:batchSize] for name, values in pending.items()}
+                pending = {name: values[batchSize:] for name, values in pending.items()}
+        if pending and pending["job_db_inx"]:
+            yield pending
+
+    def iterJobs(self, limit=None):
+        """
+        Yield the first 'limit' jobs (all by default) as dicts, like SlurmDb.getJobsRangeStream
+        """
+        for columns in self.iterJobColumnBatches(_BLOCK_SIZE, limit):
+            names = list(columns.keys())
+            for values in zip(*columns.values()):
+                yield dict(zip(names, values))
@@ -18,9 +18,57 @@ CREATE TABLE `gpu_usage` (
 	`gpus_requested` INT(2) NULL DEFAULT '0' COMMENT 'Number of GPUs Requested',
 	`gpus_used` INT(2) NULL DEFAULT '0' COMMENT 'Number of GPUs Used',
 	`added` DATETIME NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Datetime when this record was added',
-	`partition` CHAR(128) NOT NULL DEFAULT '' COMMENT 'Slurm Partition Name' COLLATE 'latin1_swedish_ci'
-	PRIMARY KEY (`job_id`) USING BTREE
+	`partition` CHAR(128) NOT NULL DEFAULT '' COMMENT 'Slurm Partition Name' COLLATE 'latin1_swedish_ci',
+	`cluster_name` CHAR(64) NOT NULL DEFAULT '' COMMENT 'Slurm Cluster Name' COLLATE 'latin1_swedish_ci',
+	PRIMARY KEY (`job_id`, `time_end`) USING BTREE,
+	UNIQUE INDEX `ux_cluster_slurm_id_job` (`cluster_name`, `slurm_id_job`, `time_end`) USING BTREE,
+	INDEX `ix_time_end` (`time_end`) USING BTREE,
+	INDEX `ix_user_time_end` (`user_name`, `time_end`, `time_start`, `duration_sec`, `gpus_used`, `job_result`) USING BTREE,
+	INDEX `ix_group_time_end` (`group_name`, `time_end`, `time_start`, `duration_sec`, `gpus_used`, `job_result`) USING BTREE,
+	INDEX `ix_added` (`added`) USING BTREE
 )
 COLLATE='latin1_swedish_ci'
 ENGINE=InnoDB
-;
\ No newline at end of file
+PARTITION BY RANGE COLUMNS(`time_end`) (
+	PARTITION p_old VALUES LESS THAN ('2021-01-01'),
+	PARTITION pmax VALUES LESS THAN (MAXVALUE)
+)
+;
+
+CREATE TABLE `chargeback_watermark` (
+	`cluster_name` CHAR(64) NOT NULL COMMENT 'Slurm Cluster Name' COLLATE 'latin1_swedish_ci',
+	`last_time_end` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'UNIX time_end up to which jobs have been loaded',
+	`last_job_db_inx` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Highest Slurm job_db_inx loaded',
+	`updated` DATETIME NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Datetime when this watermark was updated',
+	PRIMARY KEY (`cluster_name`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
+
+CREATE TABLE `gpu_usage_daily` (
+	`day` DATE NOT NULL COMMENT 'Day of Job End',
+	`user_name` CHAR(50) NOT NULL DEFAULT '' COMMENT 'Name of User' COLLATE 'latin1_swedish_ci',
+	`group_name` CHAR(50) NOT NULL DEFAULT '' COMMENT 'Group Name of User' COLLATE 'latin1_swedish_ci',
+	`partition` CHAR(128) NOT NULL DEFAULT '' COMMENT 'Slurm Partition Name' COLLATE 'latin1_swedish_ci',
+	`job_result` CHAR(12) NOT NULL COMMENT 'End result of job' COLLATE 'latin1_swedish_ci',
+	`job_count` INT(11) NOT NULL DEFAULT '0' COMMENT 'Number of Jobs',
+	`gpu_count` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Sum of GPUs Used',
+	`gpu_seconds` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Sum of GPUs Used * Duration in Seconds',
+	PRIMARY KEY (`day`, `user_name`, `group_name`, `partition`, `job_result`) USING BTREE,
+	INDEX `ix_user_day` (`user_name`, `day`) USING BTREE,
+	INDEX `ix_group_day` (`group_name`, `day`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
+
+CREATE TABLE `chargeback_generation` (
+	`name` CHAR(32) NOT NULL COMMENT 'Name of the data set' COLLATE 'latin1_swedish_ci',
+	`generation` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Incremented after every load that changed the data',
+	`updated` DATETIME NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Datetime when this generation was bumped',
+	PRIMARY KEY (`name`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
@@ -0,0 +1,13 @@
+-- Add the report and dedup indexes to an existing gpu_usage table
+--  - ux_slurm_id_job backs the dedup lookup in ChargebackDb.addUniqueJobs
+--  - ix_user_time_end / ix_group_time_end let the report queries run as index range scans.
+--    The trailing columns make them covering, so report queries never read the table rows.
+--
+-- The unique index will fail if duplicate slurm_id_job rows exist. List them first with:
+--   SELECT slurm_id_job, COUNT(*) FROM gpu_usage GROUP BY slurm_id_job HAVING COUNT(*) > 1;
+ALTER TABLE `gpu_usage`
+	ADD UNIQUE INDEX `ux_slurm_id_job` (`slurm_id_job`) USING BTREE,
+	ADD INDEX `ix_user_time_end` (`user_name`, `time_end`, `time_start`, `duration_sec`, `gpus_used`, `job_result`) USING BTREE,
+	ADD INDEX `ix_group_time_end` (`group_name`, `time_end`, `time_start`, `duration_sec`, `gpus_used`, `job_result`) USING BTREE,
+	ALGORITHM=INPLACE, LOCK=NONE
+;
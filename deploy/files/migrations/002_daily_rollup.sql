@@ -0,0 +1,34 @@
+-- Add the daily rollup table used by the report API, and populate it from all existing gpu_usage rows
+--  - ix_time_end lets the nightly ETL re-aggregate a single day as an index range scan
+--  - The rollup only counts jobs the reports would count (duration_sec >= 60, time_start after 2020).
+--    Keep the 60 in sync with ROLLUP_MIN_JOB_DURATION_SEC.
+ALTER TABLE `gpu_usage`
+	ADD INDEX `ix_time_end` (`time_end`) USING BTREE,
+	ALGORITHM=INPLACE, LOCK=NONE
+;
+
+CREATE TABLE `gpu_usage_daily` (
+	`day` DATE NOT NULL COMMENT 'Day of Job End',
+	`user_name` CHAR(50) NOT NULL DEFAULT '' COMMENT 'Name of User' COLLATE 'latin1_swedish_ci',
+	`group_name` CHAR(50) NOT NULL DEFAULT '' COMMENT 'Group Name of User' COLLATE 'latin1_swedish_ci',
+	`partition` CHAR(128) NOT NULL DEFAULT '' COMMENT 'Slurm Partition Name' COLLATE 'latin1_swedish_ci',
+	`job_result` CHAR(12) NOT NULL COMMENT 'End result of job' COLLATE 'latin1_swedish_ci',
+	`job_count` INT(11) NOT NULL DEFAULT '0' COMMENT 'Number of Jobs',
+	`gpu_count` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Sum of GPUs Used',
+	`gpu_seconds` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Sum of GPUs Used * Duration in Seconds',
+	PRIMARY KEY (`day`, `user_name`, `group_name`, `partition`, `job_result`) USING BTREE,
+	INDEX `ix_user_day` (`user_name`, `day`) USING BTREE,
+	INDEX `ix_group_day` (`group_name`, `day`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
+
+INSERT INTO `gpu_usage_daily` (`day`, `user_name`, `group_name`, `partition`, `job_result`, `job_count`, `gpu_count`, `gpu_seconds`)
+SELECT DATE(time_end), user_name, COALESCE(group_name, ''), `partition`, job_result,
+       COUNT(*), COALESCE(SUM(gpus_used), 0), COALESCE(SUM(gpus_used * duration_sec), 0)
+FROM `gpu_usage`
+WHERE duration_sec >= 60
+  AND time_start >= '2021-01-01'
+GROUP BY 1, 2, 3, 4, 5
+;
@@ -0,0 +1,15 @@
+-- Tag gpu_usage rows with the Slurm cluster they came from, so several clusters can share the table
+--  Slurm Job IDs are only unique within a cluster, so the dedup index becomes (cluster_name, slurm_id_job)
+--
+-- Existing rows must be tagged with the cluster they were loaded from before the next run, or the
+-- next run will insert the overlapping days again. Replace 'my_cluster' with SLURM_CLUSTER_NAME.
+ALTER TABLE `gpu_usage`
+	ADD COLUMN `cluster_name` CHAR(64) NOT NULL DEFAULT '' COMMENT 'Slurm Cluster Name' COLLATE 'latin1_swedish_ci'
+;
+
+UPDATE `gpu_usage` SET `cluster_name` = 'my_cluster' WHERE `cluster_name` = '';
+
+ALTER TABLE `gpu_usage`
+	DROP INDEX `ux_slurm_id_job`,
+	ADD UNIQUE INDEX `ux_cluster_slurm_id_job` (`cluster_name`, `slurm_id_job`) USING BTREE
+;
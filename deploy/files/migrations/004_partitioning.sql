@@ -0,0 +1,13 @@
+-- Prepare gpu_usage for partitioning by time_end month
+--  MySQL requires every unique key of a partitioned table to include the partitioning column.
+--  Adding time_end to the dedup index widens the key: a Slurm Job ID may now appear more than once
+--  per cluster if the copies have different time_end values (e.g. a requeued job, or IDs reused after
+--  a slurmdbd reset). The ingest dedup in database.py uses the same (slurm_id_job, time_end) key.
+--
+-- After this migration, partition the table with 'python partitions.py init' (see docs/cronjob.md)
+ALTER TABLE `gpu_usage`
+	DROP PRIMARY KEY,
+	ADD PRIMARY KEY (`job_id`, `time_end`) USING BTREE,
+	DROP INDEX `ux_cluster_slurm_id_job`,
+	ADD UNIQUE INDEX `ux_cluster_slurm_id_job` (`cluster_name`, `slurm_id_job`, `time_end`) USING BTREE
+;
@@ -0,0 +1,10 @@
+-- Report data generation, bumped by the cronjob after each load so the API can drop cached reports
+CREATE TABLE `chargeback_generation` (
+	`name` CHAR(32) NOT NULL COMMENT 'Name of the data set' COLLATE 'latin1_swedish_ci',
+	`generation` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Incremented after every load that changed the data',
+	`updated` DATETIME NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Datetime when this generation was bumped',
+	PRIMARY KEY (`name`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
@@ -0,0 +1,11 @@
+-- Per-cluster load watermark, used by the cronjob's incremental extraction (SLURM_JOB_INCREMENTAL)
+CREATE TABLE `chargeback_watermark` (
+	`cluster_name` CHAR(64) NOT NULL COMMENT 'Slurm Cluster Name' COLLATE 'latin1_swedish_ci',
+	`last_time_end` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'UNIX time_end up to which jobs have been loaded',
+	`last_job_db_inx` BIGINT(20) NOT NULL DEFAULT '0' COMMENT 'Highest Slurm job_db_inx loaded',
+	`updated` DATETIME NULL DEFAULT CURRENT_TIMESTAMP COMMENT 'Datetime when this watermark was updated',
+	PRIMARY KEY (`cluster_name`) USING BTREE
+)
+COLLATE='latin1_swedish_ci'
+ENGINE=InnoDB
+;
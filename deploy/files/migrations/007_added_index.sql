@@ -0,0 +1,5 @@
+-- Index on `added`, used by history.py to find the months with rows added since its last export
+ALTER TABLE `gpu_usage`
+	ADD INDEX `ix_added` (`added`) USING BTREE,
+	ALGORITHM=INPLACE, LOCK=NONE
+;
@@ -0,0 +1,30 @@
+-- Rename the unmapped user placeholder from 'UNKOWN' to 'UNKNOWN'
+--  Older versions stored jobs whose UID could not be mapped under user_name 'UNKOWN'. They are now
+--  stored as 'UNKNOWN', the same as unknown groups, so rename the old rows to keep reports together.
+--  The rollup primary key includes user_name, so both names are dropped from it and re-aggregated
+--  (same filters as 002_daily_rollup.sql, keep the 60 in sync with ROLLUP_MIN_JOB_DURATION_SEC).
+--  `added` is not changed, so run 'python history.py --full-export' afterwards if you use the history export.
+UPDATE `gpu_usage`
+SET user_name = 'UNKNOWN'
+WHERE user_name = 'UNKOWN'
+;
+
+DELETE FROM `gpu_usage_daily`
+WHERE user_name IN ('UNKOWN', 'UNKNOWN')
+;
+
+INSERT INTO `gpu_usage_daily` (`day`, `user_name`, `group_name`, `partition`, `job_result`, `job_count`, `gpu_count`, `gpu_seconds`)
+SELECT DATE(time_end), user_name, COALESCE(group_name, ''), `partition`, job_result,
+       COUNT(*), COALESCE(SUM(gpus_used), 0), COALESCE(SUM(gpus_used * duration_sec), 0)
+FROM `gpu_usage`
+WHERE user_name = 'UNKNOWN'
+  AND duration_sec >= 60
+  AND time_start >= '2021-01-01'
+GROUP BY 1, 2, 3, 4, 5
+;
+
+-- Drop report caches built on the old name
+UPDATE `chargeback_generation`
+SET generation = generation + 1, updated = NOW()
+WHERE name = 'reports'
+;
@@ -1,11 +1,25 @@
 
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, PlainTextResponse
+from logzero import logger
 import common
 import database
+import history
+import metrics
 from os import environ
 from decimal import Decimal
-from dataclasses import dataclass
-from collections import Counter
+from dataclasses import dataclass, field, fields
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from collections import OrderedDict
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import threading
+import time
 
 # Define Data Classes
 @dataclass
@@ -14,71 +28,86 @@ class ReportField:
     value: any
     description: str
 
+# Each field uses a default_factory so every report gets its own ReportFields.
+#  Reports are built concurrently on the DB worker threads, and must not share them.
 @dataclass
 class BasicReport:
-    target_type: ReportField = ReportField(
+    target_type: ReportField = field(default_factory=partial(ReportField,
         name='Report Target Type',
         value=None,
         description=None
-    )
-    target_name: ReportField = ReportField(
+    ))
+    target_name: ReportField = field(default_factory=partial(ReportField,
         name='Report Target Name',
         value=None,
         description=None
-    )
-    gpu_usd_cost_per_minute: ReportField = ReportField(
+    ))
+    gpu_usd_cost_per_minute: ReportField = field(default_factory=partial(ReportField,
         name='GPU Cost/Minute in USD',
         value=None,
         description=None
-    )
-    range: ReportField = ReportField(
+    ))
+    range: ReportField = field(default_factory=partial(ReportField,
         name='Date Range',
         value=None,
         description=None
-    )
-    total_jobs: ReportField = ReportField(
+    ))
+    total_jobs: ReportField = field(default_factory=partial(ReportField,
         name='Total Jobs',
         value=None,
         description=None
-    )
-    completed_jobs: ReportField = ReportField(
+    ))
+    completed_jobs: ReportField = field(default_factory=partial(ReportField,
         name='Completed Jobs',
         value=None,
         description=None
-    )
-    failed_jobs: ReportField = ReportField(
+    ))
+    failed_jobs: ReportField = field(default_factory=partial(ReportField,
         name='Failed Jobs',
         value=None,
         description=None
-    )
-    total_gpus_used: ReportField = ReportField(
+    ))
+    total_gpus_used: ReportField = field(default_factory=partial(ReportField,
         name='Total GPUs Used',
         value=None,
         description=None
-    )
-    total_gpu_seconds: ReportField = ReportField(
+    ))
+    total_gpu_seconds: ReportField = field(default_factory=partial(ReportField,
         name='Total GPUs Seconds Used',
         value=None,
         description=None
-    )
-    total_gpu_minutes: ReportField = ReportField(
+    ))
+    total_gpu_minutes: ReportField = field(default_factory=partial(ReportField,
         name='Total GPUs Minutes Used',
         value=None,
         description=None
-    )
-    total_gpu_hours: ReportField = ReportField(
+    ))
+    total_gpu_hours: ReportField = field(default_factory=partial(ReportField,
         name='Total GPUs Hours Used',
         value=None,
         description=None
-    )
-    total_gpu_cost_usd: ReportField = ReportField(
+    ))
+    total_gpu_cost_usd: ReportField = field(default_factory=partial(ReportField,
         name='Estimated Total Cost in USD',
         value=None,
         description=None
-    )
+    ))
+
+# Request body of a batch report. With targets None, every user/group with jobs in the range is reported
+@dataclass
+class BatchReportRequest:
+    target_type: str = 'group'
+    targets: list[str] | None = None
+    range: str = 'thisMonth'
+    start_date: str | None = None
+    end_date: str | None = None
+    format: str = 'jsonl'
 
 # Report Builders
-def build_basic_report(jobs,gpu_usd_cost_per_minute,range,target_type,target_name):
+def build_basic_report(jobStats,gpu_usd_cost_per_minute,range,target_type,target_name):
+    """
+    Build a BasicReport from aggregated job stats (see ChargebackDb.getUserJobStatsThisMonth)
+    """
     
     # Calculate and build Report
     report = BasicReport()
@@ -87,17 +116,14 @@ def build_basic_report(jobs,gpu_usd_cost_per_minute,range,target_type,target_nam
     report.gpu_usd_cost_per_minute.value = gpu_usd_cost_per_minute
     report.range.value = range
 
-    # Calculate Job Counts
-    report.total_jobs.value = int(len(jobs))
-    job_results = Counter(job['job_result'] for job in jobs)
-    report.completed_jobs.value = int(job_results['COMPLETED'])
-    report.failed_jobs.value = int(job_results['FAILED'])
+    # Job Counts
+    report.total_jobs.value = int(jobStats['total_jobs'])
+    report.completed_jobs.value = int(jobStats['completed_jobs'])
+    report.failed_jobs.value = int(jobStats['failed_jobs'])
 
-    # Calulate GPU Counts
-    report.total_gpus_used.value = int(sum(job['gpus_used'] for job in jobs))
-    report.total_gpu_seconds.value = int(0)
-    for job in jobs:
-        report.total_gpu_seconds.value += int(int(job['gpus_used']) * int(job['duration_sec']))
+    # GPU Counts
+    report.total_gpus_used.value = int(jobStats['total_gpus_used'])
+    report.total_gpu_seconds.value = int(jobStats['total_gpu_seconds'])
 
     report.total_gpu_minutes.value = round(Decimal(report.total_gpu_seconds.value / 60), 3)
     report.total_gpu_hours.value   = round(Decimal(report.total_gpu_seconds.value / 60 / 60), 3)
@@ -111,6 +137,8 @@ def build_basic_report(jobs,gpu_usd_cost_per_minute,range,target_type,target_nam
 class Environment:
     
     # Chargeback DB Settings
+    #  The backend can be "mysql" or "sqlite". With "sqlite", the schema name is the path of the database file
+    chargeback_db_backend: str = environ.get("CHARGEBACK_DB_BACKEND", "mysql").strip()
     chargeback_db_table_name: str = environ.get("CHARGEBACK_DB_TABLE_NAME", "").strip()
     chargeback_db_username: str = environ.get("CHARGEBACK_DB_USERNAME", "").strip()
     chargeback_db_password: str = environ.get("CHARGEBACK_DB_PASSWORD", "").strip()
@@ -119,6 +147,8 @@ class Environment:
     chargeback_db_schema_name: int = environ.get("CHARGEBACK_DB_SCHEMA_NAME", "").strip()
 
     # Slurm DB Settings
+    #  Slurm always uses MySQL. The backend is only changed to run the API against synthetic data (see bench/)
+    slurm_db_backend: str = environ.get("SLURM_DB_BACKEND", "mysql").strip()
     slurm_cluster_name: str = environ.get("SLURM_CLUSTER_NAME", "").strip()
     slurm_db_username: str = environ.get("SLURM_DB_USERNAME", "").strip()
     slurm_db_password: str = environ.get("SLURM_DB_PASSWORD", "").strip()
@@ -129,12 +159,343 @@ class Environment:
     # Reporting Settings
     gpu_usd_cost_per_minute: Decimal = environ.get("GPU_USD_COST_PER_MINUTE", "").strip()
     min_job_duration_sec: int = 60
+    report_use_rollup: bool = environ.get("API_REPORT_USE_ROLLUP", "true").strip().lower() == "true"
+    chargeback_db_rollup_table_name: str = environ.get("CHARGEBACK_DB_ROLLUP_TABLE_NAME", "gpu_usage_daily").strip()
+    report_backend: str = environ.get("API_REPORT_BACKEND", "mysql").strip()
+    history_dir: str = environ.get("API_HISTORY_DIR", "/data/chargeback-history").strip()
+
+    # Connection Pool and Cache Settings
+    #  Connections are only taken on the DB workers, and by one background cache refresher per pool
+    db_workers: int = int(environ.get("API_DB_WORKERS", "5").strip())
+    db_pool_size: int = max(int(environ.get("API_DB_POOL_SIZE", "5").strip()), db_workers + 1)
+    max_streams: int = int(environ.get("API_MAX_STREAMS", "2").strip())
+    export_fetch_batch_size: int = int(environ.get("API_EXPORT_FETCH_BATCH_SIZE", "5000").strip())
+    slurm_assoc_cache_ttl_sec: int = int(environ.get("API_SLURM_ASSOC_CACHE_TTL_SEC", "300").strip())
+    report_cache_max_entries: int = int(environ.get("API_REPORT_CACHE_MAX_ENTRIES", "10000").strip())
+    report_cache_poll_sec: int = int(environ.get("API_REPORT_CACHE_POLL_SEC", "60").strip())
+    report_cache_max_age_sec: int = int(environ.get("API_REPORT_CACHE_MAX_AGE_SEC", "300").strip())
 
 env = Environment()
 
+# Database Connections
+#  Connections come from app-lifetime pools, so each request reuses an open connection
+def getChargebackDb():
+    return database.ChargebackDb(
+        env.chargeback_db_table_name,
+        env.chargeback_db_username,
+        env.chargeback_db_password,
+        env.chargeback_db_host, 
+        env.chargeback_db_port,
+        env.chargeback_db_schema_name,
+        rollupTable=env.chargeback_db_rollup_table_name,
+        poolName='chargeback_db',
+        poolSize=env.db_pool_size,
+        backend=env.chargeback_db_backend)
+
+def getReportDb():
+    """
+    Get the backend that job stats for reports are read from
+    """
+    if env.report_backend == 'history':
+        return history.HistoryStore(env.history_dir)
+    elif env.report_backend == 'mysql':
+        return getChargebackDb()
+    else:
+        raise ValueError("Unknown report backend {}".format(env.report_backend))
+
+def getSlurmDb():
+    return database.SlurmDb(
+        env.slurm_cluster_name,
+        env.slurm_db_username,
+        env.slurm_db_password,
+        env.slurm_db_host, 
+        env.slurm_db_port,
+        env.slurm_db_name,
+        poolName='slurm_db',
+        poolSize=env.db_pool_size,
+        backend=env.slurm_db_backend)
+
+class SlurmAssocCache:
+    """
+    In-process cache of the Slurm User->Account index
+    The index is refreshed by a background thread every ttl seconds. If the cache is
+    older than twice the ttl (E.g. the refresher is failing), it is refreshed on read.
+    """
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._index = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh(self):
+        with getSlurmDb() as slurmDb:
+            index = common.buildSlurmAssocIndex(slurmDb.getAccountAssociations())
+        with self._lock:
+            self._index = index
+            self._loaded = time.monotonic()
+        logger.info("Refreshed Slurm association cache with '{}' users".format(len(index)))
+
+    def get(self):
+        if self._index is None or time.monotonic() - self._loaded > self._ttl * 2:
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.error(err)
+                if self._index is None:
+                    raise
+                logger.warning("Failed to refresh Slurm association cache, serving stale entries")
+        return self._index
+
+    def _run(self):
+        while not self._stop.wait(self._ttl):
+            try:
+                self.refresh()
+            except Exception as err:
+                logger.error(err)
+                logger.warning("Background refresh of Slurm association cache failed")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='slurm-assoc-cache', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+slurmAssocCache = SlurmAssocCache(env.slurm_assoc_cache_ttl_sec)
+
+class ReportCache:
+    """
+    In-process cache of built reports, keyed by (target type, target, date range)
+    Report data only changes when the cronjob loads new jobs and bumps the data generation.
+    A background thread polls the generation every poll seconds, and empties the cache when
+    it changes. The least recently used entries are evicted past maxEntries.
+    """
+    def __init__(self, maxEntries, poll):
+        self._maxEntries = maxEntries
+        self._poll = poll
+        self._entries = OrderedDict()
+        self._generation = None
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refreshGeneration(self):
+        with getChargebackDb() as chargebackDb:
+            generation = chargebackDb.getGeneration()
+        with self._lock:
+            if generation != self._generation:
+                self._entries.clear()
+                self._generation = generation
+                logger.info("Report data generation is now '{}', cleared report cache".format(generation))
+
+    def getGeneration(self):
+        return self._generation
+
+    def getETag(self, key):
+        """
+        Get the ETag of a report in the current generation, or None until the generation is known
+        """
+        generation = self._generation
+        if generation is None:
+            return None
+        return '"{}-{}"'.format(generation, hashlib.sha1(repr(key).encode()).hexdigest()[:16])
+
+    def get(self, key):
+        with self._lock:
+            report = self._entries.get(key)
+            if report is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+            else:
+                self._misses += 1
+            return report
+
+    def getStats(self):
+        """
+        Get the cache's hits, misses and number of entries
+        """
+        with self._lock:
+            return self._hits, self._misses, len(self._entries)
+
+    def put(self, key, generation, report):
+        """
+        Cache a report built from the given generation. Reports built from an older generation are dropped
+        """
+        if self._maxEntries <= 0:
+            return
+        with self._lock:
+            if generation is None or generation != self._generation:
+                return
+            self._entries[key] = report
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxEntries:
+                self._entries.popitem(last=False)
+
+    def _run(self):
+        while not self._stop.wait(self._poll):
+            try:
+                self.refreshGeneration()
+            except Exception as err:
+                logger.error(err)
+                logger.warning("Failed to poll report data generation")
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='report-cache', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+reportCache = ReportCache(env.report_cache_max_entries, env.report_cache_poll_sec)
+
+# Blocking DB work runs on a bounded thread pool, so the event loop is never stalled by a slow query
+#  The connection pools are sized to at least the number of workers, plus the background refresher
+dbExecutor = ThreadPoolExecutor(max_workers=env.db_workers, thread_name_prefix='db-worker')
+
+# Streamed responses (exports and batch reports) wait for one of env.max_streams slots, so they
+#  can not take every DB worker. The semaphore is created on the app's event loop at startup
+streamSlots = None
+
+# Metrics, exposed in the Prometheus format on /metrics
+#  DB work is timed from when it starts on a worker, and the wait for a free worker is timed separately
+requestLatency = metrics.Histogram(("method", "route", "status"))
+dbWorkSeconds = metrics.Histogram(("work",))
+dbQueueWaitSeconds = metrics.Histogram(())
+apiState = {"in_flight": 0, "db_workers_busy": 0, "streams": 0}
+apiStateLock = threading.Lock()
+
+def _runTimedDbWork(func, args, name, submitted):
+    started = time.perf_counter()
+    dbQueueWaitSeconds.observe(started - submitted)
+    with apiStateLock:
+        apiState["db_workers_busy"] += 1
+    try:
+        return func(*args)
+    finally:
+        with apiStateLock:
+            apiState["db_workers_busy"] -= 1
+        dbWorkSeconds.observe(time.perf_counter() - started, name)
+
+async def runDbWork(func, *args, name=None):
+    loop = asyncio.get_running_loop()
+    work = partial(_runTimedDbWork, func, args, name or func.__name__, time.perf_counter())
+    return await loop.run_in_executor(dbExecutor, work)
+
+async def streamDbWork(iterator):
+    """
+    Pull each item of a blocking iterator on the DB worker threads, for use in a StreamingResponse
+    The iterator must not hold a DB connection between items (see iter_job_export)
+    """
+    async with streamSlots:
+        apiState["streams"] += 1
+        try:
+            while True:
+                item = await runDbWork(next, iterator, None, name=iterator.__name__)
+                if item is None:
+                    break
+                yield item
+        finally:
+            apiState["streams"] -= 1
+            await runDbWork(iterator.close, name=iterator.__name__)
+
 # Build API
 app = FastAPI()
 
+@app.on_event("startup")
+def startup():
+    global streamSlots
+    streamSlots = asyncio.Semaphore(env.max_streams)
+
+    # Create the connection pools and warm the association cache
+    try:
+        getChargebackDb().close()
+    except Exception as err:
+        logger.error(err)
+        logger.warning("Failed to connect to the Chargeback DB at startup, will retry on first use")
+    try:
+        slurmAssocCache.refresh()
+    except Exception as err:
+        logger.error(err)
+        logger.warning("Failed to load Slurm association cache at startup, will retry on first use")
+    slurmAssocCache.start()
+    try:
+        reportCache.refreshGeneration()
+    except Exception as err:
+        logger.error(err)
+        logger.warning("Failed to load report data generation at startup, reports will not be cached until it loads")
+    reportCache.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    slurmAssocCache.stop()
+    reportCache.stop()
+    dbExecutor.shutdown(wait=False)
+
+@app.middleware("http")
+async def timeRequests(request: Request, call_next):
+    """
+    Time every request by route template (E.g. /report/users/{user_name}), and count requests in flight
+    For streamed responses, the time is up to the start of the response body
+    """
+    started = time.perf_counter()
+    apiState["in_flight"] += 1
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        apiState["in_flight"] -= 1
+        route = request.scope.get("route")
+        routePath = route.path if route is not None else "unmatched"
+        requestLatency.observe(time.perf_counter() - started, request.method, routePath, str(status))
+
+@app.get("/metrics")
+async def read_metrics():
+    cacheHits, cacheMisses, cacheEntries = reportCache.getStats()
+    cacheRequests = cacheHits + cacheMisses
+    poolUsage = database.MySqlDb.getPoolUsage()
+    counts = common.getEvents()[0]
+    with apiStateLock:
+        dbWorkersBusy = apiState["db_workers_busy"]
+
+    return PlainTextResponse(metrics.formatPrometheus([
+        ("api_request_duration_seconds", "histogram", "Request latency by route",
+            requestLatency.getSamples()),
+        ("api_requests_in_flight", "gauge", "Requests being handled",
+            [({}, apiState["in_flight"])]),
+        ("api_db_work_seconds", "histogram", "Time spent on DB worker threads, by handler",
+            dbWorkSeconds.getSamples()),
+        ("api_db_queue_wait_seconds", "histogram", "Time DB work waited for a free DB worker thread",
+            dbQueueWaitSeconds.getSamples()),
+        ("api_streams_in_flight", "gauge", "Streamed responses being sent",
+            [({}, apiState["streams"])]),
+        ("api_db_workers", "gauge", "DB worker threads",
+            [({}, env.db_workers)]),
+        ("api_db_workers_busy", "gauge", "DB worker threads running DB work",
+            [({}, dbWorkersBusy)]),
+        ("api_db_pool_size", "gauge", "Connections in each DB connection pool",
+            [({"pool": name}, size) for name, (inUse, size) in sorted(poolUsage.items())]),
+        ("api_db_pool_in_use", "gauge", "Connections taken from each DB connection pool",
+            [({"pool": name}, inUse) for name, (inUse, size) in sorted(poolUsage.items())]),
+        ("api_db_round_trips_total", "counter", "DB statements, fetches and commits sent",
+            [({}, counts.get("db_round_trips", 0))]),
+        ("api_db_connect_failures_total", "counter", "Failed DB connections, including exhausted pools",
+            [({}, counts.get("db_connect_failures", 0))]),
+        ("api_report_cache_requests_total", "counter", "Report cache lookups, by result",
+            [({"result": "hit"}, cacheHits), ({"result": "miss"}, cacheMisses)]),
+        ("api_report_cache_hit_ratio", "gauge", "Share of report cache lookups that were hits",
+            [({}, round(cacheHits / cacheRequests, 4) if cacheRequests else 0)]),
+        ("api_report_cache_entries", "gauge", "Reports in the report cache",
+            [({}, cacheEntries)])
+    ]))
+
 @app.get("/")
 async def root():
     return {"message": "Hello"}
@@ -144,65 +505,204 @@ async def root():
     return {"message": "OK"}
 
 @app.get("/report/users/{user_name}")
-async def read_report_user_range(user_name: str, start_date: str | None = None, end_date: str | None = None, range: str = 'thisMonth'):
-    
-    # Setup the Chargeback DB
-    chargebackDb = database.ChargebackDb(
-        env.chargeback_db_table_name,
-        env.chargeback_db_username,
-        env.chargeback_db_password,
-        env.chargeback_db_host, 
-        env.chargeback_db_port,
-        env.chargeback_db_schema_name)
-    
-    # Get Completed Jobs for this user in the defined timerange
+async def read_report_user_range(user_name: str, request: Request, response: Response, start_date: str | None = None, end_date: str | None = None, range: str = 'thisMonth'):
+    return await serveCachedReport(request, response, 'user', user_name, start_date, end_date, range, get_user_report)
+
+@app.get("/report/groups/{user_name}")
+async def read_report_group_range(user_name: str, request: Request, response: Response, start_date: str | None = None, end_date: str | None = None, range: str = 'thisMonth'):
+    # The association cache may refresh from the Slurm DB on read, so the lookup runs on a DB worker
+    group_name = await runDbWork(get_user_group, user_name)
+    return await serveCachedReport(request, response, 'group', group_name, start_date, end_date, range, get_group_report)
+
+async def serveCachedReport(request, response, target_type, target_name, start_date, end_date, range, handler):
+    """
+    Serve a report from the report cache, building it with handler(target_name, ...) on a miss
+    Clients that send back the current ETag get a 304 without the report being looked up.
+    """
+    dateRange = getReportDateRange(range, start_date, end_date)
+    key = (target_type, target_name, range, dateRange["start"], dateRange["end"])
+
+    generation = reportCache.getGeneration()
+    etag = reportCache.getETag(key)
+    headers = {"Cache-Control": "private, max-age={}".format(env.report_cache_max_age_sec)}
+    if etag is not None:
+        headers["ETag"] = etag
+        ifNoneMatch = request.headers.get("if-none-match", "")
+        if etag in [tag.strip().removeprefix("W/") for tag in ifNoneMatch.split(",")]:
+            return Response(status_code=304, headers=headers)
+
+    report = reportCache.get(key)
+    if report is None:
+        report = await runDbWork(handler, target_name, start_date, end_date, range)
+        reportCache.put(key, generation, report)
+
+    response.headers.update(headers)
+    return report
+
+@app.post("/report/batch")
+async def read_report_batch(batch: BatchReportRequest):
+    dateRange = getReportDateRange(batch.range, batch.start_date, batch.end_date)
+    if batch.target_type not in ['user', 'group']:
+        raise ValueError("Unknown target type {}".format(batch.target_type))
+    if batch.format not in ['jsonl', 'csv']:
+        raise ValueError("Unknown format {}".format(batch.format))
+    mediaType = 'application/x-ndjson' if batch.format == 'jsonl' else 'text/csv'
+
+    reports = iter_batch_reports(batch.target_type, batch.targets, dateRange, getReportRangeName(batch.range, batch.start_date, batch.end_date), batch.format)
+    return StreamingResponse(streamDbWork(reports), media_type=mediaType)
+
+@app.get("/export/jobs")
+async def read_export_jobs(start_date: str | None = None, end_date: str | None = None, range: str = 'thisMonth',
+                           user_name: str | None = None, group_name: str | None = None, cluster_name: str | None = None,
+                           format: str = 'csv'):
+    dateRange = getReportDateRange(range, start_date, end_date)
+    if format not in ['jsonl', 'csv']:
+        raise ValueError("Unknown format {}".format(format))
+    mediaType = 'application/x-ndjson' if format == 'jsonl' else 'text/csv'
+    fileName = "gpu_usage_{}_{}.{}".format(dateRange["start"], dateRange["end"], format)
+
+    jobs = iter_job_export(dateRange, {"user_name": user_name, "group_name": group_name, "cluster_name": cluster_name}, format)
+    return StreamingResponse(streamDbWork(jobs), media_type=mediaType,
+                             headers={"Content-Disposition": 'attachment; filename="{}"'.format(fileName)})
+
+def getReportDateRange(range, start_date, end_date):
+    """
+    Get the half-open date range of a report range type
+    """
     if range == 'thisMonth':
-        jobs = chargebackDb.getUserJobsThisMonth(user_name, env.min_job_duration_sec)
+        return common.getThisMonthDateRange()
     elif range == 'dateRange':
-        jobs = chargebackDb.getUserJobsInDateRange(user_name, start_date, end_date, env.min_job_duration_sec)
-        range = "{} to {}".format(start_date, end_date)
+        return common.getInclusiveDateRange(start_date, end_date)
     else:
         raise ValueError("Unknown range type {}".format(range))
 
+def getReportRangeName(range, start_date, end_date):
+    if range == 'dateRange':
+        return "{} to {}".format(start_date, end_date)
+    return range
+
+# Report Handlers
+#  These are blocking, and must be run through runDbWork
+def get_user_report(user_name, start_date, end_date, range):
+    
+    # Get Completed Job stats for this user in the defined timerange
+    with getReportDb() as chargebackDb:
+        if range == 'thisMonth':
+            jobStats = chargebackDb.getUserJobStatsThisMonth(user_name, env.min_job_duration_sec, env.report_use_rollup)
+        elif range == 'dateRange':
+            jobStats = chargebackDb.getUserJobStatsInDateRange(user_name, start_date, end_date, env.min_job_duration_sec, env.report_use_rollup)
+            range = "{} to {}".format(start_date, end_date)
+        else:
+            raise ValueError("Unknown range type {}".format(range))
+
     # Calculate and build Report
-    report = build_basic_report(jobs, env.gpu_usd_cost_per_minute, range, 'user', user_name)
+    report = build_basic_report(jobStats, env.gpu_usd_cost_per_minute, range, 'user', user_name)
 
     return report
 
-@app.get("/report/groups/{user_name}")
-async def read_report_group_range(user_name: str, start_date: str | None = None, end_date: str | None = None, range: str = 'thisMonth'):
-    
-    # Setup the Slurm DB
-    slurmDb = database.SlurmDb(
-        env.slurm_cluster_name,
-        env.slurm_db_username,
-        env.slurm_db_password,
-        env.slurm_db_host, 
-        env.slurm_db_port,
-        env.slurm_db_name)
-    
+def get_user_group(user_name):
+
     # Map User to Group
-    group_name = common.getUserSlurmAssoc(slurmDb.getAccountAssociations(),user_name)
+    return common.getUserSlurmAssoc(slurmAssocCache.get(), user_name, recordMisses=False)
 
-    # Setup the Chargeback DB
-    chargebackDb = database.ChargebackDb(
-        env.chargeback_db_table_name,
-        env.chargeback_db_username,
-        env.chargeback_db_password,
-        env.chargeback_db_host, 
-        env.chargeback_db_port,
-        env.chargeback_db_schema_name)
-    
-    # Get Completed Jobs for this user in the defined timerange
-    if range == 'thisMonth':
-        jobs = chargebackDb.getGroupJobsThisMonth(group_name, env.min_job_duration_sec)
-    elif range == 'dateRange':
-        jobs = chargebackDb.getGroupJobsInDateRange(user_name, start_date, end_date, env.min_job_duration_sec)
-        range = "{} to {}".format(start_date, end_date)
-    else:
-        raise ValueError("Unknown range type {}".format(range))
+def get_group_report(group_name, start_date, end_date, range):
+
+    # Get Completed Job stats for this group in the defined timerange
+    with getReportDb() as chargebackDb:
+        if range == 'thisMonth':
+            jobStats = chargebackDb.getGroupJobStatsThisMonth(group_name, env.min_job_duration_sec, env.report_use_rollup)
+        elif range == 'dateRange':
+            jobStats = chargebackDb.getGroupJobStatsInDateRange(group_name, start_date, end_date, env.min_job_duration_sec, env.report_use_rollup)
+            range = "{} to {}".format(start_date, end_date)
+        else:
+            raise ValueError("Unknown range type {}".format(range))
 
     # Calculate and build Report
-    report = build_basic_report(jobs, env.gpu_usd_cost_per_minute, range, 'group', group_name)
+    report = build_basic_report(jobStats, env.gpu_usd_cost_per_minute, range, 'group', group_name)
+
+    return report
+
+def iter_batch_reports(target_type, targets, dateRange, range, format, chunkSize=500, pageSize=5000):
+    """
+    Build the reports of a batch request from grouped queries, yielding chunks of JSON lines or CSV
+    Targets are read pageSize at a time, each page with its own connection, so no connection is held
+    while the response is sent. Requested targets with no jobs in the range get a report with zero usage.
+    """
+    missing = dict.fromkeys(targets) if targets is not None else {}
+
+    def iterJobStats():
+        after = None
+        while True:
+            with getReportDb() as chargebackDb:
+                if target_type == 'user':
+                    page = chargebackDb.getUserJobStatsPage(targets, dateRange, env.min_job_duration_sec, env.report_use_rollup, after, pageSize)
+                else:
+                    page = chargebackDb.getGroupJobStatsPage(targets, dateRange, env.min_job_duration_sec, env.report_use_rollup, after, pageSize)
+            yield from page
+            if len(page) < pageSize:
+                return
+            after = page[-1]["target_name"]
+
+    def iterReports():
+        for jobStats in iterJobStats():
+            missing.pop(jobStats["target_name"], None)
+            yield build_basic_report(jobStats, env.gpu_usd_cost_per_minute, range, target_type, jobStats["target_name"])
+        emptyStats = dict.fromkeys(["total_jobs", "completed_jobs", "failed_jobs", "total_gpus_used", "total_gpu_seconds"], 0)
+        for target_name in missing:
+            yield build_basic_report(emptyStats, env.gpu_usd_cost_per_minute, range, target_type, target_name)
+
+    names = [reportField.name for reportField in fields(BasicReport)]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if format == 'csv':
+        writer.writerow(names)
+
+    count = 0
+    for report in iterReports():
+        if format == 'csv':
+            writer.writerow([getattr(report, name).value for name in names])
+        else:
+            buffer.write(json.dumps(jsonable_encoder(report)) + "\n")
+        count += 1
+        if count % chunkSize == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def iter_job_export(dateRange, filters, format, chunkSize=1000):
+    """
+    Stream the raw job rows in a range from the Chargeback DB, yielding chunks of CSV or JSON lines
+    Jobs are read a page of env.export_fetch_batch_size at a time, each page with its own connection,
+    so no connection is held while the response is sent.
+    """
+    def iterJobs():
+        after = None
+        while True:
+            with getChargebackDb() as chargebackDb:
+                page = chargebackDb.getJobsInDateRangePage(dateRange, filters, after, env.export_fetch_batch_size)
+            yield from page
+            if len(page) < env.export_fetch_batch_size:
+                return
+            after = (page[-1]["time_end"], page[-1]["job_id"])
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
 
-    return report
\ No newline at end of file
+    count = 0
+    for job in iterJobs():
+        if format == 'csv':
+            if count == 0:
+                writer.writerow(job.keys())
+            writer.writerow(job.values())
+        else:
+            buffer.write(json.dumps(job, default=str) + "\n")
+        count += 1
+        if count % chunkSize == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+    logger.info("Exported '{}' jobs from '{}' to '{}'".format(count, dateRange["start"], dateRange["end"]))
@@ -0,0 +1,206 @@
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from logzero import logger
+from datetime import date, datetime
+import mysql.connector
+import sqlite3
+
+"""
+Storage backends
+The DB classes in database.py build their queries in MySQL's dialect, with '%s' placeholders.
+A backend opens the connections, adapts each query and its params to the engine, and provides
+the few SQL fragments that differ between engines (upserts, GREATEST, the current time).
+  - mysql:  a MySQL/MariaDB server, through mysql.connector. The default
+  - sqlite: an embedded SQLite file in WAL mode, so the cronjob can write while the API reads.
+            The chargeback tables are created on first use.
+"""
+
+class MySqlBackend:
+    """
+    A MySQL/MariaDB server. Connections can come from a named pool
+    """
+    name = 'mysql'
+    label = 'MySQL'
+    pooled = True
+    embedded = False
+    supportsPartitions = True
+
+    def connect(self, username, password, host, port, database, poolArgs):
+        logger.info("Connecting to MySQL DB: " + host)
+        return mysql.connector.connect(user=username, password=password,
+                                       host=host, port=port, database=database,
+                                       get_warnings=True, **poolArgs)
+
+    def getLocation(self, host, database):
+        return host
+
+    def cursor(self, cnx, streaming=False):
+        """
+        Get a cursor. Streaming cursors are unbuffered, so rows are fetched from the server in batches
+        """
+        if streaming:
+            return cnx.cursor(buffered=False)
+        return cnx.cursor()
+
+    def discardResults(self, cnx):
+        # Drain anything left unread if the consumer stopped early, so the connection stays usable
+        if cnx.unread_result:
+            cnx.consume_results()
+
+    def prepare(self, query, params):
+        return query, params
+
+    def onDuplicateKeyUpdate(self, keyFields):
+        return "ON DUPLICATE KEY UPDATE"
+
+    def insertedValue(self, field):
+        return "VALUES(" + field + ")"
+
+    def greatest(self, *values):
+        return "GREATEST(" + ", ".join(values) + ")"
+
+    def now(self):
+        return "CURRENT_TIMESTAMP"
+
+    def yearMonth(self, field):
+        return "EXTRACT(YEAR_MONTH FROM " + field + ")"
+
+    def getChargebackSchema(self, chargebackTable, watermarkTable, rollupTable, generationTable):
+        raise Exception("The MySQL schema is created from deploy/files/chargeback_db.sql")
+
+# SQLite keeps DATETIME and DATE values as 'YYYY-MM-DD HH:MM:SS' and 'YYYY-MM-DD' text, which sorts
+#  and compares like the MySQL types. Columns declared with these types are read back as datetime/date.
+sqlite3.register_adapter(datetime, lambda value: value.strftime("%Y-%m-%d %H:%M:%S"))
+sqlite3.register_adapter(date, lambda value: value.strftime("%Y-%m-%d"))
+sqlite3.register_converter("DATETIME", lambda value: datetime.fromisoformat(value.decode()))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+
+# The chargeback schema (see deploy/files/chargeback_db.sql) for SQLite
+#  job_id is the rowid, and the (cluster_name, slurm_id_job, time_end) key makes duplicate inserts fail the same way
+SQLITE_CHARGEBACK_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS {chargebackTable} (
+        job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        slurm_job_name CHAR(50) NOT NULL DEFAULT '',
+        slurm_id_job INT NOT NULL DEFAULT 0,
+        time_start DATETIME NOT NULL,
+        time_end DATETIME NOT NULL,
+        duration_sec INT NOT NULL,
+        cpus_req INT NOT NULL,
+        exit_code INT NOT NULL,
+        user_id INT NOT NULL,
+        group_id INT NOT NULL,
+        user_name CHAR(50) NOT NULL DEFAULT '',
+        group_name CHAR(50) NULL DEFAULT '',
+        nodelist CHAR(128) NOT NULL DEFAULT '',
+        node_alloc INT NOT NULL DEFAULT 0,
+        slurm_job_state INT NOT NULL DEFAULT 0,
+        job_result CHAR(12) NOT NULL,
+        gpus_requested INT NULL DEFAULT 0,
+        gpus_used INT NULL DEFAULT 0,
+        added DATETIME NULL DEFAULT (datetime('now', 'localtime')),
+        `partition` CHAR(128) NOT NULL DEFAULT '',
+        cluster_name CHAR(64) NOT NULL DEFAULT '',
+        UNIQUE (cluster_name, slurm_id_job, time_end)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_{chargebackTable}_time_end ON {chargebackTable} (time_end)",
+    "CREATE INDEX IF NOT EXISTS ix_{chargebackTable}_user_time_end ON {chargebackTable} (user_name, time_end, time_start, duration_sec, gpus_used, job_result)",
+    "CREATE INDEX IF NOT EXISTS ix_{chargebackTable}_group_time_end ON {chargebackTable} (group_name, time_end, time_start, duration_sec, gpus_used, job_result)",
+    "CREATE INDEX IF NOT EXISTS ix_{chargebackTable}_added ON {chargebackTable} (added)",
+    """CREATE TABLE IF NOT EXISTS {watermarkTable} (
+        cluster_name CHAR(64) NOT NULL PRIMARY KEY,
+        last_time_end BIGINT NOT NULL DEFAULT 0,
+        last_job_db_inx BIGINT NOT NULL DEFAULT 0,
+        updated DATETIME NULL DEFAULT (datetime('now', 'localtime'))
+    )""",
+    """CREATE TABLE IF NOT EXISTS {rollupTable} (
+        day DATE NOT NULL,
+        user_name CHAR(50) NOT NULL DEFAULT '',
+        group_name CHAR(50) NOT NULL DEFAULT '',
+        `partition` CHAR(128) NOT NULL DEFAULT '',
+        job_result CHAR(12) NOT NULL,
+        job_count INT NOT NULL DEFAULT 0,
+        gpu_count BIGINT NOT NULL DEFAULT 0,
+        gpu_seconds BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, user_name, group_name, `partition`, job_result)
+    )""",
+    "CREATE INDEX IF NOT EXISTS ix_{rollupTable}_user_day ON {rollupTable} (user_name, day)",
+    "CREATE INDEX IF NOT EXISTS ix_{rollupTable}_group_day ON {rollupTable} (group_name, day)",
+    """CREATE TABLE IF NOT EXISTS {generationTable} (
+        name CHAR(32) NOT NULL PRIMARY KEY,
+        generation BIGINT NOT NULL DEFAULT 0,
+        updated DATETIME NULL DEFAULT (datetime('now', 'localtime'))
+    )"""
+]
+
+class SqliteBackend:
+    """
+    An embedded SQLite database file, given as the database name
+    The file is opened in WAL mode, so readers (E.g. the API) do not block the writer (E.g. the cronjob),
+    and a writer waits up to busyTimeout seconds for another writer to finish.
+    """
+    name = 'sqlite'
+    label = 'SQLite'
+    pooled = False
+    embedded = True
+    supportsPartitions = False
+
+    def __init__(self, busyTimeout=30):
+        self._busyTimeout = busyTimeout
+
+    def connect(self, username, password, host, port, database, poolArgs):
+        logger.info("Opening SQLite DB: " + database)
+
+        # Connections are used from one thread at a time, but streamed results may be read from
+        #  different worker threads (see api.streamDbWork)
+        cnx = sqlite3.connect(database, timeout=self._busyTimeout, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+        cnx.execute("PRAGMA journal_mode=WAL")
+        cnx.execute("PRAGMA synchronous=NORMAL")
+        return cnx
+
+    def getLocation(self, host, database):
+        return database
+
+    def cursor(self, cnx, streaming=False):
+        # SQLite steps through the results as they are fetched, every cursor streams
+        return cnx.cursor()
+
+    def discardResults(self, cnx):
+        pass
+
+    def prepare(self, query, params):
+        return query.replace("%s", "?"), params or ()
+
+    def onDuplicateKeyUpdate(self, keyFields):
+        return "ON CONFLICT (" + ", ".join(keyFields) + ") DO UPDATE SET"
+
+    def insertedValue(self, field):
+        return "excluded." + field
+
+    def greatest(self, *values):
+        return "MAX(" + ", ".join(values) + ")"
+
+    def now(self):
+        return "datetime('now', 'localtime')"
+
+    def yearMonth(self, field):
+        return "CAST(SUBSTR(" + field + ", 1, 4) || SUBSTR(" + field + ", 6, 2) AS INTEGER)"
+
+    def getChargebackSchema(self, chargebackTable, watermarkTable, rollupTable, generationTable):
+        return [statement.format(chargebackTable=chargebackTable, watermarkTable=watermarkTable,
+                                 rollupTable=rollupTable, generationTable=generationTable)
+                for statement in SQLITE_CHARGEBACK_SCHEMA]
+
+BACKENDS = {
+    'mysql': MySqlBackend,
+    'sqlite': SqliteBackend
+}
+
+def getBackend(name):
+    """
+    Get a storage backend by name
+    """
+    if name not in BACKENDS:
+        raise ValueError("Unknown DB backend {}. valid values are {}".format(name, list(BACKENDS.keys())))
+    return BACKENDS[name]()
@@ -0,0 +1,136 @@
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from logzero import logger
+from datetime import datetime, timezone
+import numpy as np
+import common
+
+"""
+Columnar parsing of Slurm jobs
+Jobs arrive as batches of column lists (see SlurmDb.getJobsRangeColumnBatches), and each
+field is computed for the whole batch at once. Per-value work (TRES parsing, identity
+lookups) is only done once for each distinct value in the batch.
+The records produced are identical to common.iterParseSlurmJobs.
+"""
+
+# Offsets between UTC and local time are looked up per 15 minute bucket.
+#  Timezone transitions always happen on a 15 minute boundary.
+_OFFSET_BUCKET_SEC = 900
+
+_JOB_STATES = np.array([common.formatSlurmJobState(state) for state in range(10)] + ['UNKNOWN'], dtype=object)
+
+def _mapUnique(values, func):
+    """
+    Apply func once per distinct value, and return the results as an object array aligned with values
+    """
+    uniqueValues, inverse = np.unique(values, return_inverse=True)
+    mapped = np.array([func(value) for value in uniqueValues.tolist()], dtype=object)
+    return mapped[inverse]
+
+def formatUnixToDateStrings(unixDates):
+    """
+    Format an array of UNIX times to MySQL Datetime Format in local time (see common.formatUnixToDateString)
+    """
+    # np.char.replace rejects empty arrays on numpy 2.x
+    if len(unixDates) == 0:
+        return np.array([], dtype=str)
+    buckets, inverse = np.unique(unixDates // _OFFSET_BUCKET_SEC, return_inverse=True)
+    offsets = np.array([
+        int(datetime.fromtimestamp(int(bucket) * _OFFSET_BUCKET_SEC, timezone.utc).astimezone().utcoffset().total_seconds())
+        for bucket in buckets
+    ], dtype=np.int64)
+    localDates = (unixDates + offsets[inverse]).astype('datetime64[s]')
+    return np.char.replace(np.datetime_as_string(localDates, unit='s'), 'T', ' ')
+
+def formatSlurmJobStates(stateIds):
+    """
+    Convert an array of Job State IDs to friendly names (see common.formatSlurmJobState)
+    """
+    known = (stateIds >= 0) & (stateIds < len(_JOB_STATES) - 1)
+    return _JOB_STATES[np.where(known, stateIds, len(_JOB_STATES) - 1)]
+
+def parseSlurmJobColumns(columns, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField='tres_req'):
+    """
+    Parse a batch of completed slurm jobs given as a dict of column lists, and prepare them for
+    insert into chargeback DB. Returns a list of records.
+    """
+    partition = np.array(columns["partition"], dtype=object)
+
+    # Skip the records if this partition is to be filtered
+    keep = np.ones(len(partition), dtype=bool)
+    if slurmPartitionFilter != '':
+        keep = partition != slurmPartitionFilter
+        common.countEvent("jobs_skipped_by_partition_filter", int((~keep).sum()))
+
+    def column(name, dtype=object):
+        return np.array(columns[name], dtype=dtype)[keep]
+
+    partition   = partition[keep]
+    timeStart   = column("time_start", np.int64)
+    timeEnd     = column("time_end", np.int64)
+    idUser      = column("id_user", np.int64)
+    state       = column("state", np.int64)
+    tresReq     = column("tres_req")
+    tresUsed    = column(gpusUsedField)
+    account     = column("account")
+
+    time_start     = formatUnixToDateStrings(timeStart)
+    time_end       = formatUnixToDateStrings(timeEnd)
+    duration_sec   = timeEnd - timeStart
+    user_name      = _mapUnique(idUser, lambda uid: common.getUsername(sshHost, uid))
+    job_result     = formatSlurmJobStates(state)
+    gpus_requested = _mapUnique(np.array([tres or '' for tres in tresReq.tolist()], dtype=object), common.getGpuCount)
+    gpus_used      = gpus_requested
+    if gpusUsedField != 'tres_req':
+        hasUsed = np.array([bool(tres) for tres in tresUsed.tolist()], dtype=bool)
+        gpusUsed = _mapUnique(np.array([tres or '' for tres in tresUsed.tolist()], dtype=object), common.getGpuCount)
+        gpus_used = np.where(hasUsed, gpusUsed, gpus_requested)
+
+    # Route the Group mapping to the correct backend
+    if slurmAssocBackend == 'etc_group':
+        groupKeys = np.array(["{}\0{}".format(acct or '', user) for acct, user in zip(account.tolist(), user_name.tolist())], dtype=object)
+        group_name = _mapUnique(groupKeys, lambda key: common.getUserGroupname(sshHost, *key.split('\0', 1)))
+    elif slurmAssocBackend == 'slurm_acctdb':
+        group_name = _mapUnique(user_name, lambda user: common.getUserSlurmAssoc(slurmAssocIndex, user))
+    else:
+        logger.error("slurm_assoc_backend is not set properly, this should have been caught earlier")
+        group_name = np.full(len(user_name), 'UNKNOWN', dtype=object)
+
+    # Count problem jobs for the run summary, the same as the row path
+    common.countEvent("jobs_with_unmapped_uid", int((user_name == 'UNKNOWN').sum()))
+    common.countEvent("jobs_with_unknown_group", int((group_name == 'UNKNOWN').sum()))
+    common.countEvent("jobs_without_gpus_requested", int((gpus_requested == 0).sum()))
+
+    # Build the records from the computed columns, in the same field order as the row path
+    fields = {
+        "slurm_job_name":  column("job_name").tolist(),
+        "slurm_id_job":    column("id_job").tolist(),
+        "time_start":      time_start.tolist(),
+        "time_end":        time_end.tolist(),
+        "duration_sec":    duration_sec.tolist(),
+        "cpus_req":        column("cpus_req").tolist(),
+        "exit_code":       column("exit_code").tolist(),
+        "user_id":         column("id_user").tolist(),
+        "group_id":        column("id_group").tolist(),
+        "user_name":       user_name.tolist(),
+        "group_name":      group_name.tolist(),
+        "nodelist":        column("nodelist").tolist(),
+        "node_alloc":      column("nodes_alloc").tolist(),
+        "slurm_job_state": column("state").tolist(),
+        "job_result":      job_result.tolist(),
+        "gpus_requested":  gpus_requested.tolist(),
+        "gpus_used":       gpus_used.tolist(),
+        "partition":       partition.tolist()
+    }
+    keys = list(fields.keys())
+    return [dict(zip(keys, values)) for values in zip(*fields.values())]
+
+def iterParseSlurmJobColumns(batches, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField='tres_req'):
+    """
+    Parse a stream of column batches, yielding records ready for insert into chargeback DB
+    """
+    for columns in batches:
+        for record in parseSlurmJobColumns(columns, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField):
+            yield record
@@ -4,11 +4,64 @@ __license__ = "MIT"
 
 from logzero import logger
 from datetime import datetime, time, timedelta
-import re
+from collections import deque, Counter
+from itertools import islice
+from functools import lru_cache
+import multiprocessing
+import queue
+import threading
 
 """
 Common and Utility functions
 """
+
+"""
+Run events
+Per-job problems (E.g. unmapped UIDs) and run counters (E.g. DB round trips) are counted here
+instead of being logged for every job, and summarized once at the end of the run. Counts are totals of jobs, and the distinct values
+behind them (E.g. the UIDs) are kept so the summary can name a few.
+"""
+_eventCounts = Counter()
+_eventValues = {}
+_eventLock = threading.Lock()
+
+def countEvent(name, count=1):
+    """
+    Add count to a run event counter
+    """
+    if count:
+        with _eventLock:
+            _eventCounts[name] += count
+
+def recordEventValue(name, value):
+    """
+    Record a distinct value behind a run event (E.g. an unmapped UID)
+    """
+    with _eventLock:
+        _eventValues.setdefault(name, set()).add(value)
+
+def getEvents():
+    """
+    Get a copy of the run event counters and their distinct values
+    """
+    with _eventLock:
+        return dict(_eventCounts), {name: set(values) for name, values in _eventValues.items()}
+
+def mergeEvents(events):
+    """
+    Add the events returned by getEvents (E.g. from a worker process) to this process's events
+    """
+    counts, values = events
+    with _eventLock:
+        _eventCounts.update(counts)
+        for name, valueSet in values.items():
+            _eventValues.setdefault(name, set()).update(valueSet)
+
+def resetEvents():
+    with _eventLock:
+        _eventCounts.clear()
+        _eventValues.clear()
+
 def filter_list_of_dictionaries(list_of_dicts, field, value):
     filtered_list = [d for d in list_of_dicts if d.get(field) == value]
     return filtered_list
@@ -26,6 +79,80 @@ def getDateRangeUnix(dayCount):
     }
     return dateRange
 
+def getIncrementalDateRangeUnix(watermarkUnix, overlapSec):
+    """
+    Get start/end range in UNIX timestamps starting from a previous load watermark.
+    The start is moved back by overlapSec to pick up late-arriving jobs, and
+    the range will always end at the previous midnight.
+    """
+    thisMidnight = datetime.combine(datetime.today(), time.min)
+    dateRange = {
+        "start": max(int(watermarkUnix) - int(overlapSec), 0),
+        "end": int(datetime.timestamp(thisMidnight))
+    }
+    return dateRange
+
+def getThisMonthDateRange():
+    """
+    Get a half-open start/end range of date strings for the current month.
+    Range will be from the first of this month, up to (not including) the first of next month
+    """
+    firstOfMonth = datetime.today().date().replace(day=1)
+    firstOfNextMonth = (firstOfMonth + timedelta(days=32)).replace(day=1)
+    dateRange = {
+        "start": firstOfMonth.strftime("%Y-%m-%d"),
+        "end": firstOfNextMonth.strftime("%Y-%m-%d")
+    }
+    return dateRange
+
+def getInclusiveDateRange(startDate, endDate):
+    """
+    Convert an inclusive 'YYYY-MM-DD' start/end date pair into a half-open range of date strings.
+    Range will be from the start date, up to (not including) the day after the end date
+    """
+    dayAfterEnd = datetime.strptime(endDate, "%Y-%m-%d").date() + timedelta(days=1)
+    dateRange = {
+        "start": datetime.strptime(startDate, "%Y-%m-%d").date().strftime("%Y-%m-%d"),
+        "end": dayAfterEnd.strftime("%Y-%m-%d")
+    }
+    return dateRange
+
+def getDaysInRangeUnix(startUnix, endUnix):
+    """
+    Get the list of 'YYYY-MM-DD' day strings touched by a UNIX timestamp range (inclusive)
+    """
+    day = datetime.fromtimestamp(startUnix).date()
+    lastDay = datetime.fromtimestamp(endUnix).date()
+    days = []
+    while day <= lastDay:
+        days.append(day.strftime("%Y-%m-%d"))
+        day += timedelta(days=1)
+    return days
+
+def getNextMonth(month):
+    """
+    Get the month after a 'YYYY-MM' month, as 'YYYY-MM'
+    """
+    firstOfMonth = datetime.strptime(month, "%Y-%m").date()
+    return (firstOfMonth + timedelta(days=32)).strftime("%Y-%m")
+
+def getMonthsInRange(startMonth, endMonth):
+    """
+    Get the list of 'YYYY-MM' months from startMonth to endMonth (inclusive)
+    """
+    months = []
+    month = datetime.strptime(startMonth, "%Y-%m").strftime("%Y-%m")
+    while month <= endMonth:
+        months.append(month)
+        month = getNextMonth(month)
+    return months
+
+def getMonthFromPartitionName(partitionName):
+    """
+    Get the 'YYYY-MM' month of a 'pYYYYMM' partition name
+    """
+    return "{}-{}".format(partitionName[1:5], partitionName[5:7])
+
 def formatUnixToDateString(unixDate):
     """
     Format a UNIX time string to MySQL Datetime Format
@@ -54,94 +181,112 @@ def formatSlurmJobState(stateId):
     state = states.get(stateId, "UNKNOWN")
     return state
 
+# Slurm TRES IDs. IDs above 1000 are assigned per site in Slurm's tres_table
+#  1001 is the generic 'gres/gpu' TRES, typed GPUs (E.g. 'gres/gpu:a100') get their own IDs
+TRES_GPU = 1001
+
+@lru_cache(maxsize=4096)
+def parseTres(tresString):
+    """
+    Parse a TRES field from the SlurmDb (E.g. tres_req or tres_alloc) into a dict of {tres_id: count}
+    This field is stored in CSV format, for example:
+        1=4,2=10240,4=1,5=4,1001=1
+    Most jobs share a handful of TRES shapes, so each distinct string is only parsed once.
+    The returned dict is shared between callers and must not be modified.
+    Returns None if the field cannot be parsed. Failures are cached too, so a bad string is only parsed once.
+    """
+    tresCounts = {}
+    try:
+        for tres in tresString.split(','):
+            tresId, count = tres.split('=', 1)
+            tresCounts[int(tresId)] = int(count)
+    except Exception as err:
+        logger.debug("Failed to parse TRES field '%s': %s", tresString, err)
+        return None
+    return tresCounts
+
 def getGpuCount(tresReq):
     """
-    Extract the requested GPU Count from the tres_req field in the SlurmDb
-    This field is stored in CSV format, where GPU requests are coded as '1001=n'
-    An example tres_req field for a Single GPU request might look like:
+    Extract the GPU Count from a TRES field (tres_req or tres_alloc) in the SlurmDb
+    GPU requests are coded as '1001=n'. An example tres_req field for a Single GPU request might look like:
         1=4,2=10240,4=1,5=4,1001=1
     Meaning, 1 GPU was requested.
+    Fields without a GPU entry count as 0 GPUs. Those jobs are counted by the parsers (see countEvent)
     """
     if tresReq:
-        tres_dict = {}
-        logger.debug("tres_req field is '{}'".format(tresReq))
-
-        try:
-            for tres in tresReq.split(','):
-                tres_dict[int(tres.split('=')[0])] = int(tres.split('=')[1])
-
-            if 1001 in tres_dict:
-                return tres_dict[1001]
-            else:
-                logger.warning("GPU Type (1001) not found in tres_req field, setting GPU count to '0'")
-                return int(0)
-            
-        except Exception as err:
-            logger.error("Failed to parse tres_req field. Look into this or users will not be charged for GPU utilization")
-            logger.error(err)
+        tresCounts = parseTres(tresReq)
+        if tresCounts is None:
+            # Look into these, or users will not be charged for GPU utilization
+            recordEventValue("unparseable_tres", tresReq)
             return int(0)
 
+        return tresCounts.get(TRES_GPU, int(0))
+
     else:
-        logger.warning("No content found in tres_req field, setting GPU count to '0'")
         return int(0)
 
 def getUserGroupname(sshHost, accountName, username):
     """
     Get the GroupName for a user
     If account is not root or NULL, use that.
-    If account is root or NULL, get the group list from SSH Host, and extract it
+    If account is root or NULL, use the user's group ending in '-G' from the SSH Host's group file
     """
     if accountName:
         return str(accountName)
     else:
-        allGroups = []
+        groupname = None
         try:
-            allGroups = sshHost.mapUsernametoGroups(username)
+            groupname = sshHost.mapUsernametoSuffixGroup(username)
         except Exception as err:
             logger.error(err)
             pass
 
-        r = re.compile("^.+-G$")
-        filteredGroups = list(filter(r.match, allGroups))
-
-        if filteredGroups:
-            return str(filteredGroups[0])
+        if groupname:
+            return str(groupname)
         else:
-            logger.error("Failed to map UID: %s to Group ending in '-G'" % (username))
+            recordEventValue("users_without_suffix_group", username)
             return str("UNKNOWN")
         
-def getUserSlurmAssoc(slurmAssocTable, username):
+def buildSlurmAssocIndex(slurmAssocTable):
     """
-    Get the GroupName for a user from the Slurm Assoc Table
-    If we are unable to find an association, raise an error
+    Build a User->Account index from the Slurm Assoc Table
+    If a user has more than 1 association, the 'default' (is_def) account is used,
+    otherwise the first association found for the user.
     """
-    try:
-        matched_account = filter_list_of_dictionaries(slurmAssocTable, 'user', username)
-    except Exception as err:
-        logger.error(err)
-        pass
+    slurmAssocIndex = {}
+    defaultUsers = set()
+    for assoc in slurmAssocTable:
+        username = assoc.get('user')
+        if username in defaultUsers:
+            continue
+        if assoc.get('is_def') == 1:
+            slurmAssocIndex[username] = assoc.get('acct', None)
+            defaultUsers.add(username)
+        elif username not in slurmAssocIndex:
+            slurmAssocIndex[username] = assoc.get('acct', None)
 
-    # If we got more than 1 result for this user, filter to only the 'default' field
-    logger.debug("matched account object is '{}'".format(matched_account))
-    if matched_account is not None and len(matched_account) > 1:
-        logger.debug("Found '{}' matches, filtering to default".format(len(matched_account)))
-        default_account = filter_list_of_dictionaries(matched_account, 'is_def', 1)
-        if default_account is not None:
-            matched_account = default_account
-            logger.debug("default matched account object is '{}'".format(matched_account))
-
-    if matched_account is not None:
-
-        # Get the account name
-        account = matched_account[0].get('acct', None)
-        if account is not None:
-            return account
-        else:
-            logger.error("Failed to map User '{}' to Slurm Assoc Account. Match found, but 'acct' was NULL.".format(username))
-            return 'UNKNOWN'
-    else:
-        logger.error("Failed to map User '{}' to Slurm Assoc Account. No match found in AssocTable.".format(username))
-        return 'UNKNOWN'
+    logger.debug("Built slurmAssocIndex with '%s' users, '%s' with a default account", len(slurmAssocIndex), len(defaultUsers))
+    return slurmAssocIndex
+
+def getUserSlurmAssoc(slurmAssocIndex, username, recordMisses=True):
+    """
+    Get the GroupName for a user from the Slurm Assoc Index (see buildSlurmAssocIndex)
+    If we are unable to find an association, record the user (see recordEventValue) and return 'UNKNOWN'.
+    Failed lookups are memoized in the index, so each user is only resolved once per run.
+    Long running callers (E.g. the API) pass recordMisses=False, so lookups of arbitrary
+    usernames are neither recorded nor memoized and memory does not grow with them.
+    """
+    account = slurmAssocIndex.get(username, 'UNKNOWN')
+    if not recordMisses:
+        return account if account is not None else 'UNKNOWN'
+    if account is None:
+        recordEventValue("users_with_null_slurm_account", username)
+        account = slurmAssocIndex[username] = 'UNKNOWN'
+    elif account == 'UNKNOWN' and username not in slurmAssocIndex:
+        recordEventValue("users_without_slurm_assoc", username)
+        slurmAssocIndex[username] = account
+
+    return account
 
 def getUsername(sshHost, uid):
     """
@@ -154,22 +299,30 @@ def getUsername(sshHost, uid):
         logger.error(err)
         pass
 
-    if username is None:
-        logger.error("Failed to map UID: %s to Username" % (uid))
-        username = 'UNKOWN'
+    if username is None or username == 'UNKNOWN':
+        recordEventValue("unmapped_uids", uid)
+        username = 'UNKNOWN'
 
     return username
 
-def parseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocTable, slurmPartitionFilter):
+def parseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField='tres_req'):
     """
     Parse the completed slurm jobs, and prepare them for insert into chargeback DB.
     """
-    chargebackRecords = []
+    return list(iterParseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField))
+
+def iterParseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField='tres_req'):
+    """
+    Parse the completed slurm jobs one at a time, yielding records ready for insert into chargeback DB.
+    Accepts any iterable of jobs, so it can be chained directly onto a streaming query.
+    gpus_used is taken from the gpusUsedField TRES field ('tres_req' or 'tres_alloc'). If that field
+    is empty (E.g. the job was never allocated), the requested GPU count is used.
+    """
     for job in jobs:
 
         # Skip the record if this partition is to be filtered
         if slurmPartitionFilter != '' and slurmPartitionFilter == job["partition"]:
-            logger.debug("Job ID '{}' matched partition filter of '{}'. Skipping it.".format(job["id_job"],slurmPartitionFilter))
+            countEvent("jobs_skipped_by_partition_filter")
             continue
 
         time_start     = formatUnixToDateString(job["time_start"])
@@ -178,17 +331,25 @@ def parseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocTable, slurmParti
         user_name      = getUsername(sshHost,job["id_user"])
         job_result     = formatSlurmJobState(job["state"])
         gpus_requested = getGpuCount(job["tres_req"])
-        gpus_used      = getGpuCount(job["tres_req"])
+        gpus_used      = getGpuCount(job[gpusUsedField]) if job.get(gpusUsedField) else gpus_requested
 
         # Route the Group mapping to the correct backend
         if slurmAssocBackend == 'etc_group':
             group_name = getUserGroupname(sshHost,job["account"],user_name)
         elif slurmAssocBackend == 'slurm_acctdb':
-            group_name = getUserSlurmAssoc(slurmAssocTable,user_name)
+            group_name = getUserSlurmAssoc(slurmAssocIndex,user_name)
         else:
             logger.error("slurm_assoc_backend is not set properly, this should have been caught earlier")
             group_name = 'UNKNOWN'
 
+        # Count problem jobs for the run summary, rather than logging each one
+        if user_name == 'UNKNOWN':
+            countEvent("jobs_with_unmapped_uid")
+        if group_name == 'UNKNOWN':
+            countEvent("jobs_with_unknown_group")
+        if gpus_requested == 0:
+            countEvent("jobs_without_gpus_requested")
+
         chargebackRecord = {
             "slurm_job_name":  job["job_name"],
             "slurm_id_job":    job["id_job"],
@@ -209,6 +370,118 @@ def parseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocTable, slurmParti
             "gpus_used":       gpus_used,
             "partition":       job["partition"]
         }
-        chargebackRecords.append(chargebackRecord)
-    
-    return chargebackRecords
\ No newline at end of file
+        yield chargebackRecord
+
+"""
+Parallel parsing
+Each worker process receives the identity and association indexes once, when it starts,
+and then only job chunks are sent to it.
+"""
+_parseWorkerState = {}
+
+# Workers are started from a fork server (or spawned where there is none), never forked from this process.
+#  The parser runs in pipeline and cluster threads, and forking while another thread holds a lock
+#  (E.g. _eventLock or a logging handler's) would leave that lock held forever in the worker
+_PARSE_POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def _initParseWorker(identityIndex, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField):
+    resetEvents()
+    _parseWorkerState["identityIndex"] = identityIndex
+    _parseWorkerState["slurmAssocBackend"] = slurmAssocBackend
+    _parseWorkerState["slurmAssocIndex"] = slurmAssocIndex
+    _parseWorkerState["slurmPartitionFilter"] = slurmPartitionFilter
+    _parseWorkerState["gpusUsedField"] = gpusUsedField
+
+def _parseJobChunk(jobs):
+    """
+    Parse a chunk of jobs in a worker, returning the records and the run events they raised
+    """
+    records = parseSlurmJobs(
+        jobs,
+        _parseWorkerState["identityIndex"],
+        _parseWorkerState["slurmAssocBackend"],
+        _parseWorkerState["slurmAssocIndex"],
+        _parseWorkerState["slurmPartitionFilter"],
+        _parseWorkerState["gpusUsedField"])
+    events = getEvents()
+    resetEvents()
+    return records, events
+
+def iterParseSlurmJobsParallel(jobs, identityIndex, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, workers, chunkSize=5000, gpusUsedField='tres_req'):
+    """
+    Parse the completed slurm jobs across a pool of worker processes, yielding records in the original order.
+    identityIndex must be picklable (see Ssh.getIdentityIndex). At most 2 chunks per worker are in flight,
+    so memory stays bounded when jobs is a stream.
+    """
+    jobs = iter(jobs)
+    initArgs = (identityIndex, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField)
+    poolContext = multiprocessing.get_context(_PARSE_POOL_START_METHOD)
+    with poolContext.Pool(workers, initializer=_initParseWorker, initargs=initArgs) as pool:
+        pending = deque()
+        while True:
+            chunk = list(islice(jobs, chunkSize))
+            if chunk:
+                pending.append(pool.apply_async(_parseJobChunk, (chunk,)))
+
+            # Wait on the oldest chunk once the pool is full, or drain everything at the end
+            while pending and (not chunk or len(pending) >= workers * 2):
+                records, events = pending.popleft().get()
+                mergeEvents(events)
+                for record in records:
+                    yield record
+
+            if not chunk:
+                break
+
+"""
+Pipelining
+Each stage of the ETL runs in its own thread, connected by bounded queues. A stage that gets
+ahead blocks on the full queue (backpressure), so wall time approaches that of the slowest stage.
+"""
+_PIPELINE_END = object()
+
+def iterPipelined(iterable, queueSize=4, chunkSize=1000, name='pipeline-stage'):
+    """
+    Consume iterable in a background thread, yielding its items to the caller through a bounded queue
+    Items are passed in chunks of chunkSize to keep the queue overhead low. At most queueSize chunks
+    are buffered. Exceptions raised by the stage are re-raised in the caller.
+    """
+    chunks = queue.Queue(maxsize=queueSize)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the caller has stopped consuming, so the thread does not block forever
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            items = iter(iterable)
+            while True:
+                chunk = list(islice(items, chunkSize))
+                if not chunk:
+                    break
+                if not put(chunk):
+                    return
+            put(_PIPELINE_END)
+        except Exception as err:
+            put(err)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is _PIPELINE_END:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            for item in chunk:
+                yield item
+    finally:
+        stop.set()
@@ -1,5 +1,10 @@
 from logzero import logger
-import mysql.connector
+from itertools import islice
+from collections import Counter
+from datetime import datetime
+import threading
+import backends
+import common
 
 __author__ = "Kalen Peterson"
 __version__ = "0.5.0"
@@ -7,40 +12,100 @@ __license__ = "MIT"
 
 class MySqlDb:
 
-    def __init__(self, username, password, host, port, database):
+    # Connections currently taken from each named pool, for monitoring pool saturation
+    _poolInUse = Counter()
+    _poolSizes = {}
+    _poolLock = threading.Lock()
+
+    def __init__(self, username, password, host, port, database, poolName=None, poolSize=None, backend='mysql'):
         """
         Initialize the Connection to the MySQL DB
+        backend selects the storage engine (see backends.py). With 'sqlite', database is the path of
+        the database file, and the other connection settings are not used.
+        If poolName is set, the connection is taken from (and returned to) a named connection pool
+        that lives for the life of the process. The pool is created by the first connection.
+        Only the mysql backend pools connections.
         """
         self._cnx = None
-        self._host = host
+        self._backend = backends.getBackend(backend)
+        self._host = self._backend.getLocation(host, database)
+        self._poolName = poolName if self._backend.pooled else None
+
+        poolArgs = {}
+        if self._poolName:
+            poolArgs = {"pool_name": poolName, "pool_size": poolSize or 5}
 
         try:
-            logger.info("Connecting to MySQL DB: " + host)
-            self._cnx = mysql.connector.connect(user=username, password=password,
-                                               host=host, port=port, database=database,
-                                               get_warnings=True)
+            self._cnx = self._backend.connect(username, password, host, port, database, poolArgs)
         except Exception as err:
             logger.error(err)
-            raise Exception("Failed to connect to MySQL database")
+            common.countEvent("db_connect_failures")
+            raise Exception("Failed to connect to {} database".format(self._backend.label))
+
+        if self._poolName:
+            with MySqlDb._poolLock:
+                MySqlDb._poolInUse[poolName] += 1
+                MySqlDb._poolSizes[poolName] = poolArgs["pool_size"]
+
+    @classmethod
+    def getPoolUsage(cls):
+        """
+        Get the connections in use and the size of each named pool, as {poolName: (inUse, size)}
+        """
+        with cls._poolLock:
+            return {name: (cls._poolInUse[name], size) for name, size in cls._poolSizes.items()}
 
     def __del__(self):
         """
         Close the DB Connection
         """
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the DB Connection, or return it to the pool if it is pooled
+        """
+        if self._cnx is None:
+            return
+
         try:
-            logger.info("Closing connection to MySQL DB: " + self._host)
+            logger.info("Closing connection to {} DB: {}".format(self._backend.label, self._host))
             self._cnx.close()
         except:
-            logger.warning("Failed to cleanly close the MySQL Connection")
+            logger.warning("Failed to cleanly close the {} Connection".format(self._backend.label))
             pass
+        finally:
+            self._cnx = None
+            if self._poolName:
+                with MySqlDb._poolLock:
+                    MySqlDb._poolInUse[self._poolName] -= 1
+
+    def executeQuery(self, query, params=None):
+        """
+        Run a statement that returns no rows (E.g. DDL), and commit it
+        """
+        cursor = self._backend.cursor(self._cnx)
+        try:
+            cursor.execute(*self._backend.prepare(query, params))
+            self._cnx.commit()
+            common.countEvent("db_round_trips", 2)
+        finally:
+            cursor.close()
 
     def readQuery(self, query, params):
         """
         Run a simple MySQL Query and return the results as a dict
         """
-        cursor = self._cnx.cursor()
+        cursor = self._backend.cursor(self._cnx)
         try:
-            cursor.execute(query, params)
+            cursor.execute(*self._backend.prepare(query, params))
+            common.countEvent("db_round_trips")
             columns = [column[0] for column in cursor.description]
             results = []
             for row in cursor.fetchall():
@@ -50,20 +115,100 @@ class MySqlDb:
         finally:
             cursor.close()
 
+    def streamQuery(self, query, params, batchSize=5000):
+        """
+        Run a MySQL Query with an unbuffered cursor, yielding the results as dicts
+        Rows are fetched from the server in batches, so only one batch is held in memory at a time
+        """
+        cursor = self._backend.cursor(self._cnx, streaming=True)
+        try:
+            cursor.execute(*self._backend.prepare(query, params))
+            common.countEvent("db_round_trips")
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                common.countEvent("db_round_trips")
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(zip(columns, row))
+        finally:
+            self._backend.discardResults(self._cnx)
+            cursor.close()
+
+    def streamColumnsQuery(self, query, params, batchSize=5000):
+        """
+        Run a MySQL Query with an unbuffered cursor, yielding each batch of results as a dict of column lists
+        """
+        cursor = self._backend.cursor(self._cnx, streaming=True)
+        try:
+            cursor.execute(*self._backend.prepare(query, params))
+            common.countEvent("db_round_trips")
+            columns = [column[0] for column in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                common.countEvent("db_round_trips")
+                if not rows:
+                    break
+                yield dict(zip(columns, (list(values) for values in zip(*rows))))
+        finally:
+            self._backend.discardResults(self._cnx)
+            cursor.close()
+
     def insertQuery(self, query, params):
         """
         Run an insert query, returing the number of rows affected
         """
-        cursor = self._cnx.cursor()
+        cursor = self._backend.cursor(self._cnx)
         try:
-            cursor.execute(query, params)
+            cursor.execute(*self._backend.prepare(query, params))
             self._cnx.commit()
+            common.countEvent("db_round_trips", 2)
             count = cursor.rowcount
 
             return count
         finally:
             cursor.close()
 
+    def transactionQuery(self, statements):
+        """
+        Run a list of (query, params) statements in a single transaction, returing the total rows affected
+        """
+        cursor = self._backend.cursor(self._cnx)
+        try:
+            count = 0
+            for query, params in statements:
+                cursor.execute(*self._backend.prepare(query, params))
+                count += max(cursor.rowcount, 0)
+            self._cnx.commit()
+            common.countEvent("db_round_trips", len(statements) + 1)
+
+            return count
+        except:
+            self._cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    def insertManyQuery(self, query, paramsList):
+        """
+        Run an insert query for many rows in a single transaction, returing the number of rows affected
+        """
+        cursor = self._backend.cursor(self._cnx)
+        try:
+            # executemany sends an INSERT like this as a single multi-row statement
+            cursor.executemany(self._backend.prepare(query, None)[0], paramsList)
+            self._cnx.commit()
+            common.countEvent("db_round_trips", 2)
+            count = cursor.rowcount
+
+            return count
+        except:
+            self._cnx.rollback()
+            raise
+        finally:
+            cursor.close()
+
 
 class SlurmDb(MySqlDb):
 
@@ -81,7 +226,20 @@ class SlurmDb(MySqlDb):
         """
         Get all jobs with time_end in a range
         """
+        query, params = self._getJobsRangeQuery(startDate, endDate)
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        return result
+
+    def _getJobsRangeQuery (self, startDate, endDate):
+        """
+        Build the query and params to select all jobs with time_end in a range
+        """
         fields = ", ".join([
+            "job_db_inx",
             "job_name",
             "id_job",
             "time_start",
@@ -94,6 +252,7 @@ class SlurmDb(MySqlDb):
             "nodes_alloc",
             "state",
             "tres_req",
+            "tres_alloc",
             "account",
             "`partition`"
         ])
@@ -107,11 +266,27 @@ class SlurmDb(MySqlDb):
             endDate
         )
 
+        return query, params
+
+    def getJobsRangeStream (self, startDate, endDate, batchSize=5000):
+        """
+        Get all jobs with time_end in a range, yielding them one at a time from a server-side cursor
+        """
+        query, params = self._getJobsRangeQuery(startDate, endDate)
+
         logger.debug(query)
         logger.debug(params)
-        result = self.readQuery(query, params)
+        return self.streamQuery(query, params, batchSize)
+    
+    def getJobsRangeColumnBatches (self, startDate, endDate, batchSize=5000):
+        """
+        Get all jobs with time_end in a range, yielding batches of jobs as a dict of column lists
+        """
+        query, params = self._getJobsRangeQuery(startDate, endDate)
 
-        return result
+        logger.debug(query)
+        logger.debug(params)
+        return self.streamColumnsQuery(query, params, batchSize)
     
     def getAccountAssociations (self):
         """
@@ -131,18 +306,127 @@ class SlurmDb(MySqlDb):
         logger.debug(query)
         logger.debug(params)
         result = self.readQuery(query, params)
-        print(result)
+
         return result
 
 class ChargebackDb(MySqlDb):
-    
-    def __init__(self, chargebackTable, *args, **kwargs):
+
+    # Embedded databases (and table names) whose tables were created by this process
+    _createdSchemas = set()
+    _schemaLock = threading.Lock()
+
+    def __init__(self, chargebackTable, *args, watermarkTable='chargeback_watermark', rollupTable='gpu_usage_daily',
+                 generationTable='chargeback_generation', **kwargs):
         """
         Initialize the ChargebackDb Connection
         """
         super().__init__(*args, **kwargs)
         self._chargebackTable = str(chargebackTable)
+        self._watermarkTable = str(watermarkTable)
+        self._rollupTable = str(rollupTable)
+        self._generationTable = str(generationTable)
         logger.info("My Job Table is " + self._chargebackTable)
+        logger.info("My Watermark Table is " + self._watermarkTable)
+        logger.info("My Rollup Table is " + self._rollupTable)
+        logger.info("My Generation Table is " + self._generationTable)
+
+        # Embedded databases are created on first use, once per process
+        if self._backend.embedded:
+            schema = (self._host, self._chargebackTable, self._watermarkTable, self._rollupTable, self._generationTable)
+            with ChargebackDb._schemaLock:
+                if schema not in ChargebackDb._createdSchemas:
+                    self.createTables()
+                    ChargebackDb._createdSchemas.add(schema)
+
+    def createTables (self):
+        """
+        Create any missing Chargeback tables. Only for embedded backends, the MySQL schema is
+        created from deploy/files/chargeback_db.sql
+        """
+        for query in self._backend.getChargebackSchema(self._chargebackTable, self._watermarkTable,
+                                                       self._rollupTable, self._generationTable):
+            logger.debug(query)
+            self.executeQuery(query)
+
+    def getGeneration (self):
+        """
+        Get the report data generation, which is bumped after every load that changed the data
+        Returns 0 if no load has bumped it yet
+        """
+        query = "SELECT generation FROM " + self._generationTable + " WHERE name = %s"
+        params = (
+            'reports',
+        )
+
+        result = self.readQuery(query, params)
+
+        if result:
+            return int(result[0]["generation"])
+        else:
+            return 0
+
+    def bumpGeneration (self):
+        """
+        Advance the report data generation, so report caches built on the old data are dropped
+        """
+        query = ("INSERT INTO " + self._generationTable + " (name, generation) VALUES (%s, 1) " +
+                 self._backend.onDuplicateKeyUpdate(["name"]) + " generation = generation + 1, updated = " + self._backend.now())
+        params = (
+            'reports',
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.insertQuery(query, params)
+
+        return result
+
+    def getWatermark (self, clusterName):
+        """
+        Get the last successfully loaded position for a cluster, or None if it has never been loaded
+        """
+        fields = ", ".join([
+            "cluster_name",
+            "last_time_end",
+            "last_job_db_inx",
+            "updated"
+        ])
+
+        query = "SELECT " + fields + " FROM " + self._watermarkTable + " WHERE cluster_name = %s"
+        params = (
+            clusterName,
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        if result:
+            return result[0]
+        else:
+            return None
+
+    def setWatermark (self, clusterName, lastTimeEnd, lastJobDbInx):
+        """
+        Record the last successfully loaded position for a cluster
+        """
+        query = ("INSERT INTO " + self._watermarkTable + " (cluster_name, last_time_end, last_job_db_inx) "
+                 "VALUES (%s, %s, %s) " +
+                 self._backend.onDuplicateKeyUpdate(["cluster_name"]) + " "
+                 "last_time_end = " + self._backend.insertedValue("last_time_end") + ", "
+                 "last_job_db_inx = " + self._backend.greatest("last_job_db_inx", self._backend.insertedValue("last_job_db_inx")) + ", "
+                 "updated = " + self._backend.now())
+        params = (
+            clusterName,
+            lastTimeEnd,
+            lastJobDbInx
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.insertQuery(query, params)
+
+        return result
 
     def addUniqueJob (self, record):
         """
@@ -181,13 +465,155 @@ class ChargebackDb(MySqlDb):
             logger.debug(insertQuery)
             logger.debug(values)
             result = self.insertQuery(insertQuery, values)
-            logger.info("Updated: '" + str(result) + "' rows")
+            logger.debug("Updated: '%s' rows", result)
             return True
 
         else:
-            logger.info("No Update needed, slurm_job_id=" + str(record["slurm_id_job"]) + " already exists")
+            logger.debug("No Update needed, slurm_job_id=%s already exists", record["slurm_id_job"])
             return False
+
+    def getExistingSlurmJobKeys (self, slurmJobIds, clusterName=None, timeEndRange=None):
+        """
+        Get the set of (slurm_id_job, time_end) pairs that already exist in the Chargeback DB
+        This is the same key as the ux_cluster_slurm_id_job index (within a cluster), with time_end
+        as a 'YYYY-MM-DD HH:MM:SS' string to match the parsed records.
+        If clusterName is set, only jobs from that cluster are considered
+        If timeEndRange (min, max) is set, only jobs with time_end in that range are considered. This
+        lets MySQL prune to the matching time_end partitions.
+        """
+        if not slurmJobIds:
+            return set()
+
+        idReplacers = ", ".join(["%s"] * len(slurmJobIds))
+        query = "SELECT slurm_id_job, time_end FROM " + self._chargebackTable + " WHERE slurm_id_job IN (" + idReplacers + ")"
+        params = list(slurmJobIds)
+        if clusterName is not None:
+            query += " AND cluster_name = %s"
+            params.append(clusterName)
+        if timeEndRange is not None:
+            query += " AND time_end >= %s AND time_end <= %s"
+            params.extend(timeEndRange)
+        result = self.readQuery(query, params)
+
+        existingKeys = set()
+        for row in result:
+            timeEnd = row["time_end"]
+            if isinstance(timeEnd, datetime):
+                timeEnd = timeEnd.strftime("%Y-%m-%d %H:%M:%S")
+            existingKeys.add((row["slurm_id_job"], timeEnd))
+        return existingKeys
+
+    def addUniqueJobs (self, records, chunkSize=1000, clusterName=None):
+        """
+        Bulk insert completed Jobs into the Chargeback DB, skipping any (Slurm Job ID, time_end) that already exists
+        Records may be any iterable (including a generator) and are consumed in chunks. Each chunk costs
+        one lookup query and one multi-row insert, committed as a single transaction.
+        If clusterName is set, records are tagged with it, and Job IDs are only unique within the cluster.
+        Returns the number of records inserted, and the set of 'YYYY-MM-DD' time_end days they fall on.
+        Inserted records are not kept, so memory does not grow with the number of jobs.
+        """
+        insertedCount = 0
+        insertedDays = set()
+        insertQuery = None
+        keys = None
+
+        seenJobKeys = set()
+        records = iter(records)
+        while True:
+            chunk = list(islice(records, chunkSize))
+            if not chunk:
+                break
+
+            # Build Insert Query from the first record (keys must corrospond to DB Columns)
+            #  Escape the partition colume. It is reserved
+            if insertQuery is None:
+                keys = list(chunk[0].keys())
+                fields = ["`{}`".format(key) if key == 'partition' else key for key in keys]
+                if clusterName is not None:
+                    fields.append("cluster_name")
+                fieldReplacers = ", ".join(["%s"] * len(fields))
+                strFields = ", ".join(fields)
+                insertQuery = "INSERT INTO " + self._chargebackTable + " (" + strFields + ") VALUES (" + fieldReplacers + ")"
+                logger.debug(insertQuery)
+
+            # Resolve which jobs already exist with a single set-based query
+            timeEnds = [record["time_end"] for record in chunk]
+            existingJobKeys = self.getExistingSlurmJobKeys(
+                set(record["slurm_id_job"] for record in chunk), clusterName, (min(timeEnds), max(timeEnds)))
+
+            newRecords = []
+            for record in chunk:
+                jobKey = (record["slurm_id_job"], record["time_end"])
+                if jobKey in existingJobKeys or jobKey in seenJobKeys:
+                    continue
+                seenJobKeys.add(jobKey)
+                newRecords.append(record)
+
+            skipped = len(chunk) - len(newRecords)
+            if newRecords:
+                values = [tuple(record[key] for key in keys) for record in newRecords]
+                if clusterName is not None:
+                    values = [value + (clusterName,) for value in values]
+                result = self.insertManyQuery(insertQuery, values)
+                logger.debug("Updated: '%s' rows, '%s' already existed", result, skipped)
+                insertedCount += len(newRecords)
+                insertedDays.update(record["time_end"][:10] for record in newRecords)
+            else:
+                logger.debug("No Update needed, all '%s' jobs in chunk already exist", skipped)
+            common.countEvent("jobs_skipped_as_duplicate", skipped)
+
+        return insertedCount, insertedDays
         
+    def updateDailyRollup (self, days, min_job_duration_sec):
+        """
+        Rebuild the daily rollup rows for each of the given 'YYYY-MM-DD' days from the Chargeback Table
+        Each day is deleted and re-aggregated in the same transaction, so it is safe to re-run.
+        Only jobs that would be counted by the reports (duration and time_start filters) are rolled up.
+        """
+        fields = ", ".join([
+            "DATE(time_end)",
+            "user_name",
+            "COALESCE(group_name, '')",
+            "`partition`",
+            "job_result",
+            "COUNT(*)",
+            "COALESCE(SUM(gpus_used), 0)",
+            "COALESCE(SUM(gpus_used * duration_sec), 0)"
+        ])
+        rollupFields = ", ".join([
+            "day",
+            "user_name",
+            "group_name",
+            "`partition`",
+            "job_result",
+            "job_count",
+            "gpu_count",
+            "gpu_seconds"
+        ])
+
+        deleteQuery = "DELETE FROM " + self._rollupTable + " WHERE day = %s"
+
+        # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        insertQuery = ("INSERT INTO " + self._rollupTable + " (" + rollupFields + ") "
+                       "SELECT " + fields + " FROM " + self._chargebackTable + " "
+                       "WHERE time_end >= %s AND time_end < %s "
+                       "AND duration_sec >= %s "
+                       "AND time_start >= '2021-01-01' "
+                       "GROUP BY 1, 2, 3, 4, 5")
+
+        count = 0
+        for day in sorted(days):
+            dateRange = common.getInclusiveDateRange(day, day)
+            statements = [
+                (deleteQuery, (day,)),
+                (insertQuery, (dateRange.get("start"), dateRange.get("end"), min_job_duration_sec))
+            ]
+            logger.debug(statements)
+            count += self.transactionQuery(statements)
+
+        logger.info("Rebuilt '{}' days of the daily rollup".format(len(days)))
+        return count
+
     def getLatestJobs (self, limit):
         """
         Get all jobs with time_end in a range
@@ -211,10 +637,91 @@ class ChargebackDb(MySqlDb):
 
         return result
 
+    def getMonthsAddedSince (self, added):
+        """
+        Get the 'YYYY-MM' time_end months that have had jobs added after a datetime, oldest first
+        With added None, every month in the table is returned
+        """
+        query = "SELECT DISTINCT " + self._backend.yearMonth("time_end") + " AS month FROM " + self._chargebackTable
+        params = ()
+        if added is not None:
+            query += " WHERE added > %s"
+            params = (added,)
+        query += " ORDER BY month"
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        return ["{}-{}".format(str(row["month"])[:4], str(row["month"])[4:]) for row in result]
+
+    def getJobsInMonthColumnBatches (self, month, fields, batchSize=5000):
+        """
+        Stream the jobs with time_end in a 'YYYY-MM' month, as batches of column lists
+        Jobs are ordered by user, so files written from them can skip row groups by user_name
+        """
+        query = ("SELECT " + ", ".join("`" + name + "`" for name in fields) + " FROM " + self._chargebackTable + " "
+                 "WHERE time_end >= %s AND time_end < %s "
+                 "ORDER BY user_name, time_end")
+        params = (
+            month + "-01",
+            common.getNextMonth(month) + "-01"
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        return self.streamColumnsQuery(query, params, batchSize)
+
+    def getJobsInDateRangePage (self, dateRange, filters, after=None, limit=5000):
+        """
+        Get a page of up to limit jobs with time_end in a half-open date range, as dicts ordered by time_end and job_id
+        filters is a dict of column name to value (E.g. {"group_name": "mygroup"}), values of None are ignored
+        after is the (time_end, job_id) of the last job of the previous page. Each page is its own query,
+        so a caller streaming every page does not hold the connection in between.
+        """
+        fields = ", ".join([
+            "job_id",
+            "cluster_name",
+            "slurm_id_job",
+            "slurm_job_name",
+            "user_name",
+            "group_name",
+            "`partition`",
+            "time_start",
+            "time_end",
+            "duration_sec",
+            "cpus_req",
+            "gpus_requested",
+            "gpus_used",
+            "node_alloc",
+            "nodelist",
+            "exit_code",
+            "slurm_job_state",
+            "job_result"
+        ])
+
+        query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
+                 "WHERE time_end >= %s AND time_end < %s")
+        params = [dateRange.get("start"), dateRange.get("end")]
+        for name, value in filters.items():
+            if value is not None:
+                query += " AND `" + name + "` = %s"
+                params.append(value)
+        if after is not None:
+            query += " AND (time_end > %s OR (time_end = %s AND job_id > %s))"
+            params.extend([after[0], after[0], after[1]])
+        query += " ORDER BY time_end, job_id LIMIT %s"
+        params.append(limit)
+
+        logger.debug(query)
+        logger.debug(params)
+        return self.readQuery(query, params)
+
     def getUserJobsInDateRange (self, username, start_date, end_date, min_job_duration_sec):
         """
         Get all jobs with time_end in a range
         """
+        dateRange = common.getInclusiveDateRange(start_date, end_date)
         fields = ", ".join([
             "duration_sec",
             "gpus_used",
@@ -222,16 +729,17 @@ class ChargebackDb(MySqlDb):
         ])
 
         # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        #  Predicates compare bare columns to constants, so the (user_name|group_name, time_end) indexes can be used
         query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
                  "WHERE duration_sec >= %s "
                  "AND user_name = %s "
-                 "AND (DATE(time_end) BETWEEN %s AND %s) "
-                 "AND YEAR(time_start) > 2020")
+                 "AND time_end >= %s AND time_end < %s "
+                 "AND time_start >= '2021-01-01'")
         params = (
             min_job_duration_sec,
             username,
-            start_date,
-            end_date
+            dateRange.get("start"),
+            dateRange.get("end")
         )
 
         logger.debug(query)
@@ -244,6 +752,7 @@ class ChargebackDb(MySqlDb):
         """
         Get all jobs with time_end in a range
         """
+        dateRange = common.getInclusiveDateRange(start_date, end_date)
         fields = ", ".join([
             "duration_sec",
             "gpus_used",
@@ -251,16 +760,17 @@ class ChargebackDb(MySqlDb):
         ])
 
         # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        #  Predicates compare bare columns to constants, so the (user_name|group_name, time_end) indexes can be used
         query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
                  "WHERE duration_sec >= %s "
                  "AND group_name = %s "
-                 "AND (DATE(time_end) BETWEEN %s AND %s) "
-                 "AND YEAR(time_start) > 2020")
+                 "AND time_end >= %s AND time_end < %s "
+                 "AND time_start >= '2021-01-01'")
         params = (
             min_job_duration_sec,
             groupname,
-            start_date,
-            end_date
+            dateRange.get("start"),
+            dateRange.get("end")
         )
 
         logger.debug(query)
@@ -271,8 +781,9 @@ class ChargebackDb(MySqlDb):
     
     def getUserJobsThisMonth (self, username, min_job_duration_sec):
         """
-        Get all jobs with time_end in a range
+        Get all jobs with time_end in the current month
         """
+        dateRange = common.getThisMonthDateRange()
         fields = ", ".join([
             "duration_sec",
             "gpus_used",
@@ -280,15 +791,17 @@ class ChargebackDb(MySqlDb):
         ])
 
         # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        #  Predicates compare bare columns to constants, so the (user_name|group_name, time_end) indexes can be used
         query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
                  "WHERE duration_sec >= %s "
                  "AND user_name = %s "
-                 "AND MONTH(time_end) = MONTH(CURDATE()) "
-                 "AND YEAR(time_end) = YEAR(CURDATE()) "
-                 "AND YEAR(time_start) > 2020")
+                 "AND time_end >= %s AND time_end < %s "
+                 "AND time_start >= '2021-01-01'")
         params = (
             min_job_duration_sec,
-            username
+            username,
+            dateRange.get("start"),
+            dateRange.get("end")
         )
 
         logger.debug(query)
@@ -299,8 +812,9 @@ class ChargebackDb(MySqlDb):
     
     def getGroupJobsThisMonth (self, groupname, min_job_duration_sec):
         """
-        Get all jobs with time_end in a range
+        Get all jobs with time_end in the current month
         """
+        dateRange = common.getThisMonthDateRange()
         fields = ", ".join([
             "duration_sec",
             "gpus_used",
@@ -308,15 +822,17 @@ class ChargebackDb(MySqlDb):
         ])
 
         # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        #  Predicates compare bare columns to constants, so the (user_name|group_name, time_end) indexes can be used
         query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
                  "WHERE duration_sec >= %s "
                  "AND group_name = %s "
-                 "AND MONTH(time_end) = MONTH(CURDATE()) "
-                 "AND YEAR(time_end) = YEAR(CURDATE()) "
-                 "AND YEAR(time_start) > 2020")
+                 "AND time_end >= %s AND time_end < %s "
+                 "AND time_start >= '2021-01-01'")
         params = (
             min_job_duration_sec,
-            groupname
+            groupname,
+            dateRange.get("start"),
+            dateRange.get("end")
         )
 
         logger.debug(query)
@@ -324,3 +840,263 @@ class ChargebackDb(MySqlDb):
         result = self.readQuery(query, params)
 
         return result
+
+    def _getJobStats (self, filterField, filterValue, dateRange, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job counts, GPU counts and GPU-seconds for a user or group
+        Returns a single dict, computed in the DB so no job rows are returned
+        With useRollup, the stats are summed from the daily rollup table. The rollup applies the
+        min job duration it was built with, so min_job_duration_sec is not used.
+        """
+        if useRollup:
+            return self._getRollupStats(filterField, filterValue, dateRange)
+
+        fields = ", ".join([
+            "COUNT(*) AS total_jobs",
+            "COALESCE(SUM(job_result = 'COMPLETED'), 0) AS completed_jobs",
+            "COALESCE(SUM(job_result = 'FAILED'), 0) AS failed_jobs",
+            "COALESCE(SUM(gpus_used), 0) AS total_gpus_used",
+            "COALESCE(SUM(gpus_used * duration_sec), 0) AS total_gpu_seconds"
+        ])
+
+        # Hardcode min year to 2020. This resolves some existing issues where time_start is set to 1970
+        #  Predicates compare bare columns to constants, so the (user_name|group_name, time_end) indexes can be used
+        query = ("SELECT " + fields + " FROM " + self._chargebackTable + " "
+                 "WHERE duration_sec >= %s "
+                 "AND " + filterField + " = %s "
+                 "AND time_end >= %s AND time_end < %s "
+                 "AND time_start >= '2021-01-01'")
+        params = (
+            min_job_duration_sec,
+            filterValue,
+            dateRange.get("start"),
+            dateRange.get("end")
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        return {key: int(value) for key, value in result[0].items()}
+
+    def _getRollupStats (self, filterField, filterValue, dateRange):
+        """
+        Get aggregated job stats for a user or group from the daily rollup table
+        """
+        fields = ", ".join([
+            "COALESCE(SUM(job_count), 0) AS total_jobs",
+            "COALESCE(SUM(CASE WHEN job_result = 'COMPLETED' THEN job_count ELSE 0 END), 0) AS completed_jobs",
+            "COALESCE(SUM(CASE WHEN job_result = 'FAILED' THEN job_count ELSE 0 END), 0) AS failed_jobs",
+            "COALESCE(SUM(gpu_count), 0) AS total_gpus_used",
+            "COALESCE(SUM(gpu_seconds), 0) AS total_gpu_seconds"
+        ])
+
+        query = ("SELECT " + fields + " FROM " + self._rollupTable + " "
+                 "WHERE " + filterField + " = %s "
+                 "AND day >= %s AND day < %s")
+        params = (
+            filterValue,
+            dateRange.get("start"),
+            dateRange.get("end")
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        return {key: int(value) for key, value in result[0].items()}
+
+    def getUserJobStatsInDateRange (self, username, start_date, end_date, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a user with time_end in a range
+        """
+        return self._getJobStats("user_name", username,
+                                 common.getInclusiveDateRange(start_date, end_date),
+                                 min_job_duration_sec, useRollup)
+
+    def getGroupJobStatsInDateRange (self, groupname, start_date, end_date, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a group with time_end in a range
+        """
+        return self._getJobStats("group_name", groupname,
+                                 common.getInclusiveDateRange(start_date, end_date),
+                                 min_job_duration_sec, useRollup)
+
+    def getUserJobStatsThisMonth (self, username, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a user with time_end in the current month
+        """
+        return self._getJobStats("user_name", username,
+                                 common.getThisMonthDateRange(),
+                                 min_job_duration_sec, useRollup)
+
+    def getGroupJobStatsThisMonth (self, groupname, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a group with time_end in the current month
+        """
+        return self._getJobStats("group_name", groupname,
+                                 common.getThisMonthDateRange(),
+                                 min_job_duration_sec, useRollup)
+
+    def _getJobStatsPage (self, filterField, filterValues, dateRange, min_job_duration_sec, useRollup=False, after=None, limit=5000):
+        """
+        Get aggregated job stats for many users or groups with one grouped query
+        Returns a dict per target with jobs in the range, ordered by target name, with the target in 'target_name'
+        With filterValues None, every target is returned. At most limit targets are returned, starting after
+        the target name 'after', so callers can page through them one query at a time.
+        """
+        if useRollup:
+            fields = [
+                "COALESCE(SUM(job_count), 0) AS total_jobs",
+                "COALESCE(SUM(CASE WHEN job_result = 'COMPLETED' THEN job_count ELSE 0 END), 0) AS completed_jobs",
+                "COALESCE(SUM(CASE WHEN job_result = 'FAILED' THEN job_count ELSE 0 END), 0) AS failed_jobs",
+                "COALESCE(SUM(gpu_count), 0) AS total_gpus_used",
+                "COALESCE(SUM(gpu_seconds), 0) AS total_gpu_seconds"
+            ]
+            query = ("SELECT " + filterField + " AS target_name, " + ", ".join(fields) + " FROM " + self._rollupTable + " "
+                     "WHERE day >= %s AND day < %s")
+            params = [dateRange.get("start"), dateRange.get("end")]
+        else:
+            fields = [
+                "COUNT(*) AS total_jobs",
+                "COALESCE(SUM(job_result = 'COMPLETED'), 0) AS completed_jobs",
+                "COALESCE(SUM(job_result = 'FAILED'), 0) AS failed_jobs",
+                "COALESCE(SUM(gpus_used), 0) AS total_gpus_used",
+                "COALESCE(SUM(gpus_used * duration_sec), 0) AS total_gpu_seconds"
+            ]
+            query = ("SELECT " + filterField + " AS target_name, " + ", ".join(fields) + " FROM " + self._chargebackTable + " "
+                     "WHERE duration_sec >= %s "
+                     "AND time_end >= %s AND time_end < %s "
+                     "AND time_start >= '2021-01-01'")
+            params = [min_job_duration_sec, dateRange.get("start"), dateRange.get("end")]
+
+        if filterValues is not None:
+            if not filterValues:
+                return []
+            query += " AND " + filterField + " IN (" + ", ".join(["%s"] * len(filterValues)) + ")"
+            params.extend(filterValues)
+        if after is not None:
+            query += " AND " + filterField + " > %s"
+            params.append(after)
+        query += " GROUP BY " + filterField + " ORDER BY " + filterField + " LIMIT %s"
+        params.append(limit)
+
+        logger.debug(query)
+        logger.debug(params)
+        result = []
+        for row in self.readQuery(query, params):
+            stats = {key: int(value) for key, value in row.items() if key != "target_name"}
+            stats["target_name"] = row["target_name"]
+            result.append(stats)
+        return result
+
+    def getUserJobStatsPage (self, usernames, dateRange, min_job_duration_sec, useRollup=False, after=None, limit=5000):
+        """
+        Get aggregated job stats for a page of many users (or all users, with usernames None) with time_end in a range
+        """
+        return self._getJobStatsPage("user_name", usernames, dateRange, min_job_duration_sec, useRollup, after, limit)
+
+    def getGroupJobStatsPage (self, groupnames, dateRange, min_job_duration_sec, useRollup=False, after=None, limit=5000):
+        """
+        Get aggregated job stats for a page of many groups (or all groups, with groupnames None) with time_end in a range
+        """
+        return self._getJobStatsPage("group_name", groupnames, dateRange, min_job_duration_sec, useRollup, after, limit)
+
+    def getPartitions (self):
+        """
+        Get the time_end partitions of the Chargeback Table, oldest first
+        Each partition is named 'pYYYYMM' for a month, 'p_old' for everything before the first month,
+        and 'pmax' for everything after the last month. An unpartitioned table returns an empty list,
+        as does a backend without partitions (E.g. sqlite).
+        """
+        if not self._backend.supportsPartitions:
+            return []
+
+        fields = ", ".join([
+            "PARTITION_NAME AS partition_name",
+            "PARTITION_DESCRIPTION AS less_than",
+            "TABLE_ROWS AS table_rows"
+        ])
+
+        query = ("SELECT " + fields + " FROM information_schema.PARTITIONS "
+                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_NAME IS NOT NULL "
+                 "ORDER BY PARTITION_ORDINAL_POSITION")
+        params = (
+            self._chargebackTable,
+        )
+
+        logger.debug(query)
+        logger.debug(params)
+        result = self.readQuery(query, params)
+
+        return result
+
+    def partitionByMonth (self, startMonth, endMonth):
+        """
+        Partition an unpartitioned Chargeback Table by time_end month, from startMonth to endMonth ('YYYY-MM')
+        The primary and unique keys must already include time_end (see migration 004).
+        """
+        self._requirePartitions()
+        months = common.getMonthsInRange(startMonth, endMonth)
+        definitions = ["PARTITION p_old VALUES LESS THAN ('{}-01')".format(months[0])]
+        definitions += [self._monthPartitionDefinition(month) for month in months]
+        definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+
+        query = ("ALTER TABLE " + self._chargebackTable + " "
+                 "PARTITION BY RANGE COLUMNS(time_end) (" + ", ".join(definitions) + ")")
+
+        logger.info(query)
+        self.executeQuery(query)
+
+    def addMonthPartitions (self, endMonth):
+        """
+        Split month partitions out of the 'pmax' partition, up to and including endMonth ('YYYY-MM')
+        Returns the names of the partitions added
+        """
+        partitions = self.getPartitions()
+        names = [p["partition_name"] for p in partitions]
+        if 'pmax' not in names or len(names) < 2:
+            raise Exception("Table '{}' is not partitioned by month".format(self._chargebackTable))
+
+        # The partition before 'pmax' ends on the first day of the first missing month
+        nextMonth = partitions[-2]["less_than"].strip("'")[:7]
+        months = common.getMonthsInRange(nextMonth, endMonth)
+        if not months:
+            return []
+
+        definitions = [self._monthPartitionDefinition(month) for month in months]
+        definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+        query = ("ALTER TABLE " + self._chargebackTable + " "
+                 "REORGANIZE PARTITION pmax INTO (" + ", ".join(definitions) + ")")
+
+        logger.info(query)
+        self.executeQuery(query)
+
+        return ["p" + month.replace('-', '') for month in months]
+
+    def archivePartition (self, partitionName):
+        """
+        Detach a partition from the Chargeback Table into its own table, for export to cold storage
+        The partition's rows are swapped into '<table>_<partition>' and the empty partition is dropped.
+        Returns the name of the archive table.
+        """
+        self._requirePartitions()
+        archiveTable = self._chargebackTable + "_" + partitionName
+        statements = [
+            "CREATE TABLE " + archiveTable + " LIKE " + self._chargebackTable,
+            "ALTER TABLE " + archiveTable + " REMOVE PARTITIONING",
+            "ALTER TABLE " + self._chargebackTable + " EXCHANGE PARTITION " + partitionName + " WITH TABLE " + archiveTable,
+            "ALTER TABLE " + self._chargebackTable + " DROP PARTITION " + partitionName
+        ]
+        for query in statements:
+            logger.info(query)
+            self.executeQuery(query)
+
+        return archiveTable
+
+    def _requirePartitions (self):
+        if not self._backend.supportsPartitions:
+            raise Exception("Partitions are not supported by the {} backend".format(self._backend.name))
+
+    def _monthPartitionDefinition (self, month):
+        return "PARTITION p{} VALUES LESS THAN ('{}-01')".format(month.replace('-', ''), common.getNextMonth(month))
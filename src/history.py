@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+DGX Chargeback History Export
+
+Exports the chargeback table to monthly Parquet files, and answers report queries from them.
+Each time_end month is written to '<dir>/month=YYYY-MM/gpu_usage.parquet'. Exports are
+incremental: only months that have had jobs added since the last export are rewritten.
+
+Historical reports read only the months and columns they need, with memory-mapped files,
+so long ranges never touch the production DB.
+"""
+
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from os import environ
+from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import logzero
+from logzero import logger
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import common
+import database
+
+# Exported columns of the chargeback table
+HISTORY_SCHEMA = pa.schema([
+    ("job_id", pa.int64()),
+    ("cluster_name", pa.string()),
+    ("slurm_job_name", pa.string()),
+    ("slurm_id_job", pa.int64()),
+    ("time_start", pa.timestamp('s')),
+    ("time_end", pa.timestamp('s')),
+    ("duration_sec", pa.int64()),
+    ("cpus_req", pa.int32()),
+    ("exit_code", pa.int32()),
+    ("user_id", pa.int64()),
+    ("group_id", pa.int64()),
+    ("user_name", pa.string()),
+    ("group_name", pa.string()),
+    ("nodelist", pa.string()),
+    ("node_alloc", pa.int32()),
+    ("slurm_job_state", pa.int32()),
+    ("job_result", pa.string()),
+    ("gpus_requested", pa.int32()),
+    ("gpus_used", pa.int32()),
+    ("partition", pa.string()),
+    ("added", pa.timestamp('s'))
+])
+
+# Columns read to build a report
+REPORT_COLUMNS = ["user_name", "group_name", "time_start", "time_end", "duration_sec", "gpus_used", "job_result"]
+
+STATE_FILE = "_export_state.json"
+
+def getMonthPath(historyDir, month):
+    return os.path.join(historyDir, "month=" + month, "gpu_usage.parquet")
+
+def exportMonth(chargebackDb, historyDir, month, batchSize=5000, rowGroupSize=100000):
+    """
+    Write every job with time_end in a 'YYYY-MM' month to its Parquet file, replacing any earlier export
+    The file is written beside the old one and renamed over it, so readers never see a partial file.
+    Returns the number of jobs written, and the newest 'added' time among them (None if there were none).
+    """
+    path = getMonthPath(historyDir, month)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpPath = path + ".tmp"
+
+    count = 0
+    lastAdded = None
+    with pq.ParquetWriter(tmpPath, HISTORY_SCHEMA) as writer:
+        for columns in chargebackDb.getJobsInMonthColumnBatches(month, HISTORY_SCHEMA.names, batchSize):
+            batch = pa.Table.from_pydict(columns, schema=HISTORY_SCHEMA)
+            writer.write_table(batch, row_group_size=rowGroupSize)
+            count += batch.num_rows
+            batchAdded = pc.max(batch["added"]).as_py()
+            if batchAdded is not None and (lastAdded is None or batchAdded > lastAdded):
+                lastAdded = batchAdded
+    os.replace(tmpPath, path)
+
+    logger.info("Exported '{}' jobs for month '{}'".format(count, month))
+    return count, lastAdded
+
+def readExportState(historyDir):
+    path = os.path.join(historyDir, STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as stateFile:
+        return json.load(stateFile)
+
+def writeExportState(historyDir, state):
+    path = os.path.join(historyDir, STATE_FILE)
+    with open(path + ".tmp", "w") as stateFile:
+        json.dump(state, stateFile)
+    os.replace(path + ".tmp", path)
+
+def exportHistory(chargebackDb, historyDir, fullExport=False, batchSize=5000):
+    """
+    Export every month that has had jobs added since the last export (or every month, with fullExport)
+    The newest 'added' time among the exported jobs is saved, and the next export only picks up
+    jobs added after it, so a rerun with no new jobs rewrites nothing.
+    Returns the list of months exported
+    """
+    os.makedirs(historyDir, exist_ok=True)
+    state = readExportState(historyDir)
+    lastAdded = state.get("last_added")
+
+    months = chargebackDb.getMonthsAddedSince(None if fullExport else lastAdded)
+    if not months:
+        logger.info("No jobs added since '{}', nothing to export".format(lastAdded))
+        return []
+
+    logger.info("Exporting '{}' months since '{}'".format(len(months), lastAdded))
+    newLastAdded = None
+    for month in months:
+        _, monthAdded = exportMonth(chargebackDb, historyDir, month, batchSize)
+        if monthAdded is not None and (newLastAdded is None or monthAdded > newLastAdded):
+            newLastAdded = monthAdded
+
+    # Never move the mark back (E.g. a full export of a table whose newest jobs were deleted)
+    if newLastAdded is not None:
+        newLastAdded = newLastAdded.strftime("%Y-%m-%d %H:%M:%S")
+        if lastAdded is None or newLastAdded > lastAdded:
+            writeExportState(historyDir, {"last_added": newLastAdded})
+    return months
+
+class HistoryStore:
+    """
+    Report queries over the exported Parquet files
+    Provides the same job stats methods as ChargebackDb, so either can back the report API.
+    """
+    def __init__(self, historyDir):
+        self._historyDir = historyDir
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def _readReportTables(self, dateRange, min_job_duration_sec, filters):
+        """
+        Read the report columns of the jobs with time_end in a range, yielding a table per month
+        Only the months overlapping the range are opened, and only the report columns are read.
+        Files are sorted by user, so user filters also skip row groups by their min/max user_name.
+        """
+        start = datetime.strptime(dateRange.get("start"), "%Y-%m-%d")
+        end = datetime.strptime(dateRange.get("end"), "%Y-%m-%d")
+        lastMonth = (end - timedelta(seconds=1)).strftime("%Y-%m")
+
+        for month in common.getMonthsInRange(start.strftime("%Y-%m"), lastMonth):
+            path = getMonthPath(self._historyDir, month)
+            if not os.path.exists(path):
+                logger.debug("No history export for month '{}'".format(month))
+                continue
+
+            # Hardcode min year to 2021, matching the DB queries
+            yield pq.read_table(path, columns=REPORT_COLUMNS, memory_map=True, filters=filters + [
+                ("time_end", ">=", start),
+                ("time_end", "<", end),
+                ("duration_sec", ">=", min_job_duration_sec),
+                ("time_start", ">=", datetime(2021, 1, 1))
+            ])
+
+    def _getJobStats(self, filterField, filterValue, dateRange, min_job_duration_sec):
+        """
+        Get aggregated job counts, GPU counts and GPU-seconds for a user or group
+        """
+        stats = {
+            "total_jobs": 0,
+            "completed_jobs": 0,
+            "failed_jobs": 0,
+            "total_gpus_used": 0,
+            "total_gpu_seconds": 0
+        }
+        for table in self._readReportTables(dateRange, min_job_duration_sec, [(filterField, "=", filterValue)]):
+            gpusUsed = table["gpus_used"].cast(pa.int64())
+            jobResult = table["job_result"]
+
+            stats["total_jobs"] += table.num_rows
+            stats["completed_jobs"] += pc.sum(pc.equal(jobResult, "COMPLETED").cast(pa.int64())).as_py() or 0
+            stats["failed_jobs"] += pc.sum(pc.equal(jobResult, "FAILED").cast(pa.int64())).as_py() or 0
+            stats["total_gpus_used"] += pc.sum(gpusUsed).as_py() or 0
+            stats["total_gpu_seconds"] += pc.sum(pc.multiply(gpusUsed, table["duration_sec"])).as_py() or 0
+
+        return stats
+
+    def _getJobStatsPage(self, filterField, filterValues, dateRange, min_job_duration_sec, after=None, limit=5000):
+        """
+        Get aggregated job stats for a page of many users or groups, grouped per target (see ChargebackDb._getJobStatsPage)
+        """
+        if filterValues is not None and not filterValues:
+            return []
+        filters = [] if filterValues is None else [(filterField, "in", list(filterValues))]
+
+        totals = {}
+        for table in self._readReportTables(dateRange, min_job_duration_sec, filters):
+            gpusUsed = table["gpus_used"].cast(pa.int64())
+            jobs = pa.table({
+                "target_name": table[filterField],
+                "completed": pc.equal(table["job_result"], "COMPLETED").cast(pa.int64()),
+                "failed": pc.equal(table["job_result"], "FAILED").cast(pa.int64()),
+                "gpus_used": gpusUsed,
+                "gpu_seconds": pc.multiply(gpusUsed, table["duration_sec"])
+            })
+            grouped = jobs.group_by("target_name").aggregate([
+                ("completed", "count"),
+                ("completed", "sum"),
+                ("failed", "sum"),
+                ("gpus_used", "sum"),
+                ("gpu_seconds", "sum")
+            ])
+            for row in grouped.to_pylist():
+                stats = totals.setdefault(row["target_name"], dict.fromkeys(
+                    ["total_jobs", "completed_jobs", "failed_jobs", "total_gpus_used", "total_gpu_seconds"], 0))
+                stats["total_jobs"] += row["completed_count"]
+                stats["completed_jobs"] += row["completed_sum"] or 0
+                stats["failed_jobs"] += row["failed_sum"] or 0
+                stats["total_gpus_used"] += row["gpus_used_sum"] or 0
+                stats["total_gpu_seconds"] += row["gpu_seconds_sum"] or 0
+
+        # Order like the DB query, with a null target first
+        targetNames = sorted(totals, key=lambda targetName: (targetName is not None, targetName or ""))
+        if after is not None:
+            targetNames = [targetName for targetName in targetNames if targetName is not None and targetName > after]
+        return [{**totals[targetName], "target_name": targetName} for targetName in targetNames[:limit]]
+
+    def getUserJobStatsInDateRange(self, username, start_date, end_date, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a user with time_end in a range
+        The exported files hold the job rows, so useRollup is ignored
+        """
+        return self._getJobStats("user_name", username,
+                                 common.getInclusiveDateRange(start_date, end_date), min_job_duration_sec)
+
+    def getGroupJobStatsInDateRange(self, groupname, start_date, end_date, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a group with time_end in a range
+        """
+        return self._getJobStats("group_name", groupname,
+                                 common.getInclusiveDateRange(start_date, end_date), min_job_duration_sec)
+
+    def getUserJobStatsThisMonth(self, username, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a user in the current month
+        """
+        return self._getJobStats("user_name", username, common.getThisMonthDateRange(), min_job_duration_sec)
+
+    def getGroupJobStatsThisMonth(self, groupname, min_job_duration_sec, useRollup=False):
+        """
+        Get aggregated job stats for a group in the current month
+        """
+        return self._getJobStats("group_name", groupname, common.getThisMonthDateRange(), min_job_duration_sec)
+
+    def getUserJobStatsPage(self, usernames, dateRange, min_job_duration_sec, useRollup=False, after=None, limit=5000):
+        """
+        Get aggregated job stats for a page of many users (or all users, with usernames None) with time_end in a range
+        """
+        return self._getJobStatsPage("user_name", usernames, dateRange, min_job_duration_sec, after, limit)
+
+    def getGroupJobStatsPage(self, groupnames, dateRange, min_job_duration_sec, useRollup=False, after=None, limit=5000):
+        """
+        Get aggregated job stats for a page of many groups (or all groups, with groupnames None) with time_end in a range
+        """
+        return self._getJobStatsPage("group_name", groupnames, dateRange, min_job_duration_sec, after, limit)
+
+def main(args):
+    """ Main entry point of the app """
+    logzero.loglevel(logzero.INFO)
+    logger.info("Starting DGX Chargeback History Export to '{}'".format(args.history_dir))
+
+    with database.ChargebackDb(
+            args.chargeback_db_table_name,
+            args.chargeback_db_username,
+            args.chargeback_db_password,
+            args.chargeback_db_host,
+            args.chargeback_db_port,
+            args.chargeback_db_schema_name,
+            backend=args.chargeback_db_backend) as chargebackDb:
+        exportHistory(chargebackDb, args.history_dir, args.full_export, args.batch_size)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Chargeback DB Settings
+    parser.add_argument("--chargeback-db-backend", default=environ.get("CHARGEBACK_DB_BACKEND", "mysql").strip())
+    parser.add_argument("--chargeback-db-host", default=environ.get("CHARGEBACK_DB_HOST", "").strip())
+    parser.add_argument("--chargeback-db-port", default=environ.get("CHARGEBACK_DB_PORT", "").strip())
+    parser.add_argument("--chargeback-db-schema-name", default=environ.get("CHARGEBACK_DB_SCHEMA_NAME", "").strip())
+    parser.add_argument("--chargeback-db-table-name", default=environ.get("CHARGEBACK_DB_TABLE_NAME", "").strip())
+    parser.add_argument("--chargeback-db-username", default=environ.get("CHARGEBACK_DB_USERNAME", "").strip())
+    parser.add_argument("--chargeback-db-password", default=environ.get("CHARGEBACK_DB_PASSWORD", "").strip())
+
+    # Export Settings
+    parser.add_argument("--history-dir", default=environ.get("HISTORY_DIR", "/data/chargeback-history").strip())
+    parser.add_argument("--full-export", action='store_true', default=environ.get("HISTORY_FULL_EXPORT", "false").strip().lower() == "true")
+    parser.add_argument("--batch-size", type=int, default=environ.get("HISTORY_EXPORT_BATCH_SIZE", "5000").strip())
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)
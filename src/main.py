@@ -12,94 +12,369 @@ __version__ = "0.5.0"
 __license__ = "MIT"
 
 from os import environ
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
+import json
+import time
 import logzero
 from logzero import logger
 import common
+import columnar
 import database
+import metrics
 import ssh
 import notification
 
+def trackJobs(jobs, jobStats):
+    """
+    Pass jobs through unchanged, counting them and tracking the highest job_db_inx seen
+    """
+    for job in jobs:
+        jobStats["count"] += 1
+        jobStats["last_job_db_inx"] = max(jobStats["last_job_db_inx"], job["job_db_inx"])
+        yield job
+
+def trackJobBatches(batches, jobStats):
+    """
+    Pass column batches of jobs through unchanged, counting them and tracking the highest job_db_inx seen
+    """
+    for columns in batches:
+        jobStats["count"] += len(columns["job_db_inx"])
+        jobStats["last_job_db_inx"] = max(jobStats["last_job_db_inx"], max(columns["job_db_inx"]))
+        yield columns
+
+def getChargebackDb(args, poolSize):
+    """
+    Get a Chargeback DB connection from the run's shared connection pool
+    """
+    return database.ChargebackDb(
+        args.chargeback_db_table_name, args.chargeback_db_username,
+        args.chargeback_db_password, args.chargeback_db_host, 
+        args.chargeback_db_port, args.chargeback_db_schema_name,
+        watermarkTable=args.chargeback_db_watermark_table_name,
+        rollupTable=args.chargeback_db_rollup_table_name,
+        generationTable=args.chargeback_db_generation_table_name,
+        poolName='chargeback_db', poolSize=poolSize, backend=args.chargeback_db_backend)
+
+def loadClusters(args):
+    """
+    Get the per-cluster settings for this run
+    Clusters are read from the JSON list in --clusters-config. Each entry may set any of the
+    slurm_* and ssh_* args (E.g. "slurm_cluster_name", "slurm_db_host", "ssh_host"), anything
+    it leaves out is taken from the command line/ENV. Without a config, the single cluster
+    defined on the command line/ENV is used.
+    """
+    if not args.clusters_config:
+        return [args]
+
+    with open(args.clusters_config) as configFile:
+        clusterConfigs = json.load(configFile)
+
+    clusters = []
+    for clusterConfig in clusterConfigs:
+        cluster = argparse.Namespace(**{**vars(args), **clusterConfig})
+        if not cluster.slurm_cluster_name:
+            raise Exception("Every cluster in '{}' must set slurm_cluster_name".format(args.clusters_config))
+        clusters.append(cluster)
+    return clusters
+
+def ingestCluster(args, chargebackDb, stageTimer, rollupDays):
+    """
+    Load the completed jobs from one Slurm cluster into the Chargeback DB
+    The time spent in each stage is recorded in stageTimer (see metrics.StageTimer)
+    Every day in the extracted range is added to rollupDays before the load starts, so the
+    caller can rebuild the rollup for them even if the load fails part way.
+    Returns the number of inserted jobs and the new watermark
+    """
+    logger.info("Starting ingest for cluster '{}'".format(args.slurm_cluster_name))
+
+    # Setup the Slurm DB
+    slurmDb = database.SlurmDb(
+        args.slurm_cluster_name, args.slurm_db_username,
+        args.slurm_db_password, args.slurm_db_host, 
+        args.slurm_db_port, 'slurm_acct_db')
+    
+    # Setup the Account Associations backend
+    slurmAssocBackend = args.slurm_assoc_backend
+    logger.info("Account association backend set to {}".format(slurmAssocBackend))
+    if slurmAssocBackend == 'slurm_acctdb':
+        with stageTimer.stage('slurm_assoc'):
+            slurmAssocTable = slurmDb.getAccountAssociations()
+            logger.debug("Retrieved slurmAssocTable with %s unique entries", len(slurmAssocTable))
+            slurmAssocIndex = common.buildSlurmAssocIndex(slurmAssocTable)
+    elif slurmAssocBackend == 'etc_group':
+        slurmAssocIndex = None
+    else:
+        raise Exception("slurm_assoc_backend is undefined or invalid. valid values are ['etc_group','slurm_acctdb']")
+    
+    # Setup the SSH Connection
+    with stageTimer.stage('ssh'):
+        sshHost = ssh.Ssh(
+            args.ssh_host, args.ssh_port, args.ssh_username, args.ssh_password)
+        sshHost.getUsersAndGroups()
+
+    # Get day range in UNIX Time
+    #  In incremental mode, start from the last loaded watermark for this cluster (minus the overlap)
+    #  A full backfill, or a cluster with no watermark yet, uses the previous 'n' days
+    watermark = None
+    if args.slurm_job_incremental and not args.slurm_job_full_backfill:
+        watermark = chargebackDb.getWatermark(args.slurm_cluster_name)
+
+    if watermark is not None:
+        overlapSec = args.slurm_job_overlap_hours * 60 * 60
+        logger.info("Looking for completed Slurm jobs since watermark '{}' with '{}' hours of overlap".format(
+            common.formatUnixToDateString(watermark["last_time_end"]), args.slurm_job_overlap_hours))
+        dateRange = common.getIncrementalDateRangeUnix(watermark["last_time_end"], overlapSec)
+    else:
+        logger.info("Looking for completed Slurm jobs in the past '{}' days".format(args.slurm_job_prev_days))
+        dateRange = common.getDateRangeUnix(args.slurm_job_prev_days)
+    logger.debug("Calulated Date-Range in unixtime is '%s' to '%s'", dateRange.get("start"), dateRange.get("end"))
+
+    # Rebuild the rollup for every day in the range, not only the days that receive new jobs
+    #  Chunks are committed as they load, so jobs loaded by a failed run are skipped as duplicates
+    #  by the next one. The watermark only advances after the rollup, so the next run covers them
+    rollupDays.update(common.getDaysInRangeUnix(dateRange.get("start"), dateRange.get("end")))
+    
+    # Stream Jobs in range from Slurm DB, through the parser, into the Chargeback DB
+    #  Jobs are pulled from a server-side cursor in batches, so memory stays flat regardless of the range
+    logger.debug("Start collecting, parsing and inserting chargeback jobs")
+    jobStats = {"count": 0, "last_job_db_inx": 0}
+    if args.parse_engine == 'columnar':
+        logger.info("Parsing jobs with the columnar engine")
+        batches = trackJobBatches(stageTimer.timeIterator(
+            slurmDb.getJobsRangeColumnBatches(dateRange.get("start"), dateRange.get("end"), args.slurm_db_fetch_batch_size),
+            'extract'), jobStats)
+        if args.pipeline:
+            batches = stageTimer.timeIterator(
+                common.iterPipelined(batches, args.pipeline_queue_size, 1, 'slurm-reader'), 'extract_wait')
+        chargebackRecords = columnar.iterParseSlurmJobColumns(
+            batches, sshHost, slurmAssocBackend, slurmAssocIndex, args.slurm_partition_filter, args.gpus_used_field)
+    elif args.parse_engine == 'row':
+        jobs = trackJobs(stageTimer.timeIterator(
+            slurmDb.getJobsRangeStream(dateRange.get("start"), dateRange.get("end"), args.slurm_db_fetch_batch_size),
+            'extract'), jobStats)
+        if args.pipeline:
+            jobs = stageTimer.timeIterator(
+                common.iterPipelined(jobs, args.pipeline_queue_size, args.slurm_db_fetch_batch_size, 'slurm-reader'), 'extract_wait')
+        if args.parse_workers > 1:
+            logger.info("Parsing jobs with '{}' worker processes".format(args.parse_workers))
+            chargebackRecords = common.iterParseSlurmJobsParallel(
+                jobs, sshHost.getIdentityIndex(), slurmAssocBackend, slurmAssocIndex, args.slurm_partition_filter,
+                args.parse_workers, args.parse_chunk_size, args.gpus_used_field)
+        else:
+            chargebackRecords = common.iterParseSlurmJobs(
+                jobs, sshHost, slurmAssocBackend, slurmAssocIndex, args.slurm_partition_filter, args.gpus_used_field)
+    else:
+        raise Exception("parse_engine is invalid. valid values are ['row','columnar']")
+    chargebackRecords = stageTimer.timeIterator(chargebackRecords, 'transform')
+
+    # In pipeline mode, the Slurm reader (above) and the parser each run in their own thread,
+    #  with bounded queues between them. The chargeback writer stage runs in this thread
+    if args.pipeline:
+        logger.info("Running the extract, transform, and load stages as a pipeline")
+        chargebackRecords = stageTimer.timeIterator(common.iterPipelined(
+            chargebackRecords, args.pipeline_queue_size, args.chargeback_db_insert_chunk_size, 'transform'), 'transform_wait')
+
+    with stageTimer.stage('load'):
+        insertedCount, insertedDays = chargebackDb.addUniqueJobs(chargebackRecords, args.chargeback_db_insert_chunk_size, args.slurm_cluster_name)
+    common.countEvent("jobs_extracted", jobStats["count"])
+    common.countEvent("jobs_inserted", insertedCount)
+    logger.info("Processed '" + str(jobStats["count"]) + "' completed jobs from SlurmDb for cluster '" + args.slurm_cluster_name + "'")
+    logger.info("Inserted '" + str(insertedCount) + "' new jobs into chargeback Database for cluster '" + args.slurm_cluster_name + "'")
+
+    rollupDays.update(insertedDays)
+
+    return {
+        "insertedCount": insertedCount,
+        "watermark": (dateRange.get("end"), jobStats["last_job_db_inx"])
+    }
+
+def runCluster(args, poolSize, stageTimer, rollupDays):
+    """
+    Ingest one cluster with its own connection from the shared Chargeback DB pool
+    """
+    with getChargebackDb(args, poolSize) as chargebackDb:
+        return ingestCluster(args, chargebackDb, stageTimer, rollupDays)
+
+def buildRunSummary(startTime, success, clusterStatus, stageTimer, maxExamples=10):
+    """
+    Build the run summary: stage times, throughput, and the run counters (see common.countEvent)
+    """
+    finishTime = time.time()
+    stages, items = stageTimer.getTotals()
+    counts, values = common.getEvents()
+    counts["jobs_parsed"] = items.get("transform", 0)
+
+    # Rows per second of the exclusive time in each stage. Every parsed job passes through the loader
+    rates = {}
+    for name, stage, count in [("extract_rows_per_sec", "extract", counts.get("jobs_extracted", 0)),
+                               ("transform_rows_per_sec", "transform", counts["jobs_parsed"]),
+                               ("load_rows_per_sec", "load", counts["jobs_parsed"])]:
+        if stages.get(stage):
+            rates[name] = count / stages[stage]
+
+    return {
+        "started": common.formatUnixToDateString(startTime),
+        "finished": common.formatUnixToDateString(finishTime),
+        "finished_unix": int(finishTime),
+        "duration_sec": finishTime - startTime,
+        "success": success,
+        "clusters": clusterStatus,
+        "stages": stages,
+        "rates": rates,
+        "counters": counts,
+        "distinct": {name: {"count": len(valueSet), "examples": sorted(valueSet, key=str)[:maxExamples]}
+                     for name, valueSet in values.items()}
+    }
+
+def reportRunSummary(args, summary):
+    """
+    Log the run summary and write it to the summary/metrics files, returning it as lines for the email
+    Failing to write the files does not fail the run
+    """
+    lines = metrics.formatSummaryLines(summary)
+    for line in lines:
+        logger.info("Run summary: %s", line)
+    try:
+        if args.run_summary_file:
+            metrics.writeJsonSummary(args.run_summary_file, summary)
+        if args.metrics_textfile:
+            metrics.writePrometheusTextfile(args.metrics_textfile, summary)
+    except Exception as err:
+        logger.error(err)
+        logger.warning("Failed to write the run summary files")
+    return lines
+
 def main(args):
     """ Main entry point of the app """
-    logzero.loglevel(logzero.DEBUG)
-    logzero.logfile("/tmp/chargeback.log", mode="w", loglevel=logzero.DEBUG)
+    logLevel = getattr(logzero, args.log_level.upper(), None)
+    if not isinstance(logLevel, int):
+        raise Exception("log_level is invalid. valid values are ['DEBUG','INFO','WARNING','ERROR']")
+    logzero.loglevel(logLevel)
+    logzero.logfile(args.log_file, mode="w", loglevel=logLevel)
     logger.info("Starting DGX Chargeback Run")
+    common.resetEvents()
+    startTime = time.time()
+    stageTimer = metrics.StageTimer()
+    clusterStatus = {}
 
     try:
         # Setup the Email Connection
         emailHost = notification.Email(
             args.email_smtp_username, args.email_smtp_password,
             args.email_smtp_host, args.email_smtp_port,
-            args.email_from_address, args.email_to_address)
+            args.email_from_address, args.email_to_address,
+            maxLogBytes=args.email_log_max_bytes)
 
-        # Setup the Slurm DB
-        slurmDb = database.SlurmDb(
-            args.slurm_cluster_name, args.slurm_db_username,
-            args.slurm_db_password, args.slurm_db_host, 
-            args.slurm_db_port, 'slurm_acct_db')
-        
-        # Setup the Account Associations backend
-        slurmAssocBackend = args.slurm_assoc_backend
-        logger.info("Account association backend set to {}".format(slurmAssocBackend))
-        if slurmAssocBackend == 'slurm_acctdb':
-            slurmAssocTable = slurmDb.getAccountAssociations()
-            logger.debug("Retrieved slurmAssocTable with {} unique entries".format(len(slurmAssocTable)))
-        elif slurmAssocBackend == 'etc_group':
-            slurmAssocTable = None
-        else:
-            raise Exception("slurm_assoc_backend is undefined or invalid. valid values are ['etc_group','slurm_acctdb']")
-        
-        # Setup the Chargeback DB
-        chargebackDb = database.ChargebackDb(
-            args.chargeback_db_table_name, args.chargeback_db_username,
-            args.chargeback_db_password, args.chargeback_db_host, 
-            args.chargeback_db_port, args.chargeback_db_schema_name)
+        if args.gpus_used_field not in ['tres_req', 'tres_alloc']:
+            raise Exception("gpus_used_field is invalid. valid values are ['tres_req','tres_alloc']")
 
-        # Setup the SSH Connection
-        sshHost = ssh.Ssh(
-            args.ssh_host, args.ssh_port, args.ssh_username, args.ssh_password)
-        sshHost.getUsersAndGroups()
+        # Ingest every cluster concurrently. Each cluster has its own Slurm DB and SSH connections,
+        #  and shares the Chargeback DB connection pool. A failed cluster does not stop the others
+        clusters = loadClusters(args)
+        clusterWorkers = max(1, min(args.cluster_workers, len(clusters)))
+        poolSize = clusterWorkers + 1
+        logger.info("Ingesting '{}' clusters with '{}' workers".format(len(clusters), clusterWorkers))
 
-        # Get day range in UNIX Time
-        logger.info("Looking for completed Slurm jobs in the past '{}' days".format(args.slurm_job_prev_days))
-        dateRange = common.getDateRangeUnix(args.slurm_job_prev_days)
-        logger.debug("Calulated Date-Range in unixtime is '{}' to '{}'".format(dateRange.get("start"), dateRange.get("end")))
-        
-        # Get Jobs in range from Slurm DB
-        logger.debug("Collecting Jobs from SlurmDb in daterange")
-        jobs = slurmDb.getJobsRange(dateRange.get("start"), dateRange.get("end"))
-        logger.info("Found '" + str(len(jobs)) + "' completed jobs to insert")
-
-        # Format the data and get everything we need to insert into the Chargeback DB
-        logger.debug("Start parsing chargeback jobs")
-        chargebackRecords = common.parseSlurmJobs(jobs, sshHost, slurmAssocBackend, slurmAssocTable, args.slurm_partition_filter)
-        logger.debug("Completed parsing chargeback jobs")
-
-        # Insert Chargeback records
-        logger.debug("Start inserting jobs into chargeback Database")
-        insertedRecords = []
-        for record in chargebackRecords:
-            if chargebackDb.addUniqueJob(record):
-                insertedRecords.append(record)
+        # Each cluster gets its own set of days to rebuild in the rollup, failed clusters included
+        results = {}
+        failedClusters = {}
+        clusterRollupDays = {cluster.slurm_cluster_name: set() for cluster in clusters}
+        with ThreadPoolExecutor(max_workers=clusterWorkers, thread_name_prefix='cluster') as executor:
+            futures = {executor.submit(runCluster, cluster, poolSize, stageTimer, clusterRollupDays[cluster.slurm_cluster_name]): cluster
+                       for cluster in clusters}
+            for future in as_completed(futures):
+                cluster = futures[future]
+                try:
+                    results[cluster.slurm_cluster_name] = (cluster, future.result())
+                    clusterStatus[cluster.slurm_cluster_name] = "OK"
+                except Exception as err:
+                    logger.error('Cluster "{}" encountered Exception: "{}"'.format(cluster.slurm_cluster_name, err))
+                    failedClusters[cluster.slurm_cluster_name] = err
+                    clusterStatus[cluster.slurm_cluster_name] = str(err)
+
+        insertedCount = 0
+        with getChargebackDb(args, poolSize) as chargebackDb:
+
+            # Rebuild the daily rollup for every day extracted, across all clusters
+            #  This includes clusters that failed part way through their load
+            rollupDays = set()
+            for days in clusterRollupDays.values():
+                rollupDays.update(days)
+            for cluster, result in results.values():
+                insertedCount += result["insertedCount"]
+            with stageTimer.stage('rollup'):
+                chargebackDb.updateDailyRollup(rollupDays, args.rollup_min_job_duration_sec)
+
+            # Advance the watermarks now that the load has committed
+            for cluster, result in results.values():
+                if cluster.slurm_job_incremental or cluster.slurm_job_full_backfill:
+                    lastTimeEnd, lastJobDbInx = result["watermark"]
+                    chargebackDb.setWatermark(cluster.slurm_cluster_name, lastTimeEnd, lastJobDbInx)
+                    logger.info("Updated watermark for cluster '{}' to '{}'".format(
+                        cluster.slurm_cluster_name, common.formatUnixToDateString(lastTimeEnd)))
+
+            # Tell the report API the data has changed, so it drops its cached reports
+            #  A rebuilt day can change without new jobs, E.g. after a failed run
+            if insertedCount or rollupDays:
+                chargebackDb.bumpGeneration()
+                logger.info("Bumped report data generation")
+
+        if failedClusters:
+            raise Exception("Failed to ingest clusters: {}".format(", ".join(sorted(failedClusters))))
 
         # Finish up
+        summary = reportRunSummary(args, buildRunSummary(startTime, True, clusterStatus, stageTimer))
         logger.info("Completed DGX Chargeback Run")
-        emailHost.sendSuccessReport(insertedRecords, "/tmp/chargeback.log")
+        emailHost.sendSuccessReport(insertedCount, args.log_file, summary)
 
     except Exception as err:
         logger.error('Encountered Exception: "{}"'.format(err))
         logger.error("DGX Chargeback Run Failed")
-        emailHost.sendFailureReport("/tmp/chargeback.log")
+        summary = reportRunSummary(args, buildRunSummary(startTime, False, clusterStatus, stageTimer))
+        emailHost.sendFailureReport(args.log_file, summary)
         
 
 if __name__ == "__main__":
     """ This is executed when run from the command line """
     parser = argparse.ArgumentParser()
 
+    # Multi-cluster
+    #  A JSON file listing the clusters to ingest, and the number of clusters to ingest at once
+    #  If unset, the single cluster from the Slurm and SSH args is ingested
+    parser.add_argument("--clusters-config", default=environ.get("CLUSTERS_CONFIG", "").strip())
+    parser.add_argument("--cluster-workers", type=int, default=environ.get("CLUSTER_WORKERS", "4").strip())
+
     # Misc Args
     parser.add_argument("--slurm-job-prev-days", type=int, default=environ.get("SLURM_JOB_PREV_DAYS", 5).strip())
 
+    # Incremental extraction
+    #  When enabled, only jobs that ended after the last loaded watermark (minus the overlap) are pulled
+    #  A full backfill ignores the watermark, pulls the previous 'n' days, and then resets the watermark
+    parser.add_argument("--slurm-job-incremental", action='store_true', default=environ.get("SLURM_JOB_INCREMENTAL", "false").strip().lower() == "true")
+    parser.add_argument("--slurm-job-overlap-hours", type=int, default=environ.get("SLURM_JOB_OVERLAP_HOURS", "24").strip())
+    parser.add_argument("--slurm-job-full-backfill", action='store_true', default=environ.get("SLURM_JOB_FULL_BACKFILL", "false").strip().lower() == "true")
+
+    # The Slurm TRES field used for gpus_used
+    #  Can be "tres_req" (requested GPUs, same as gpus_requested) or "tres_alloc" (allocated GPUs)
+    parser.add_argument("--gpus-used-field", default=environ.get("GPUS_USED_FIELD", "tres_req").strip())
+
+    # Pipelining
+    #  When enabled, the Slurm reader, parser and chargeback writer run concurrently
+    #  Each queue holds at most this many chunks of jobs
+    parser.add_argument("--pipeline", action='store_true', default=environ.get("ETL_PIPELINE", "false").strip().lower() == "true")
+    parser.add_argument("--pipeline-queue-size", type=int, default=environ.get("ETL_PIPELINE_QUEUE_SIZE", "4").strip())
+
+    # Parse engine
+    #  Can be "row" (parse each job in turn) or "columnar" (parse each fetched batch as NumPy arrays)
+    parser.add_argument("--parse-engine", default=environ.get("PARSE_ENGINE", "row").strip())
+
+    # Parallel parsing, only used by the "row" engine
+    #  With more than 1 worker, jobs are parsed in chunks across a pool of processes
+    #  The default of 1 keeps the serial path, which is faster for small nightly runs
+    parser.add_argument("--parse-workers", type=int, default=environ.get("PARSE_WORKERS", "1").strip())
+    parser.add_argument("--parse-chunk-size", type=int, default=environ.get("PARSE_CHUNK_SIZE", "5000").strip())
+
     # Define the Account association backend
     #  Can be "etc_group" or "slurm_acctdb"
     parser.add_argument("--slurm-assoc-backend", default=environ.get("SLURM_ASSOC_BACKEND", "").strip())
@@ -117,14 +392,28 @@ if __name__ == "__main__":
     parser.add_argument("--slurm-db-username", default=environ.get("SLURM_DB_USERNAME", "").strip())
     parser.add_argument("--slurm-db-password", default=environ.get("SLURM_DB_PASSWORD", "").strip())
 
+    # Number of rows fetched per round trip from the Slurm DB server-side cursor
+    parser.add_argument("--slurm-db-fetch-batch-size", type=int, default=environ.get("SLURM_DB_FETCH_BATCH_SIZE", "5000").strip())
+
     # Get Chargeback DB Args
+    #  The backend can be "mysql" or "sqlite". With "sqlite", the schema name is the path of the database file
+    parser.add_argument("--chargeback-db-backend", default=environ.get("CHARGEBACK_DB_BACKEND", "mysql").strip())
     parser.add_argument("--chargeback-db-host", default=environ.get("CHARGEBACK_DB_HOST", "").strip())
     parser.add_argument("--chargeback-db-port", default=environ.get("CHARGEBACK_DB_PORT", "").strip())
     parser.add_argument("--chargeback-db-schema-name", default=environ.get("CHARGEBACK_DB_SCHEMA_NAME", "").strip())
     parser.add_argument("--chargeback-db-table-name", default=environ.get("CHARGEBACK_DB_TABLE_NAME", "").strip())
+    parser.add_argument("--chargeback-db-rollup-table-name", default=environ.get("CHARGEBACK_DB_ROLLUP_TABLE_NAME", "gpu_usage_daily").strip())
+    parser.add_argument("--chargeback-db-watermark-table-name", default=environ.get("CHARGEBACK_DB_WATERMARK_TABLE_NAME", "chargeback_watermark").strip())
+    parser.add_argument("--chargeback-db-generation-table-name", default=environ.get("CHARGEBACK_DB_GENERATION_TABLE_NAME", "chargeback_generation").strip())
     parser.add_argument("--chargeback-db-username", default=environ.get("CHARGEBACK_DB_USERNAME", "").strip())
     parser.add_argument("--chargeback-db-password", default=environ.get("CHARGEBACK_DB_PASSWORD", "").strip())
 
+    # Jobs shorter than this are left out of the daily rollup. Must match the API's min job duration
+    parser.add_argument("--rollup-min-job-duration-sec", type=int, default=environ.get("ROLLUP_MIN_JOB_DURATION_SEC", "60").strip())
+
+    # Number of records per bulk dedup query and multi-row insert transaction
+    parser.add_argument("--chargeback-db-insert-chunk-size", type=int, default=environ.get("CHARGEBACK_DB_INSERT_CHUNK_SIZE", "1000").strip())
+
     # SSH Connection Details
     parser.add_argument("--ssh-host", default=environ.get("SSH_HOST", "").strip())
     parser.add_argument("--ssh-port", default=environ.get("SSH_PORT", "").strip())
@@ -139,6 +428,17 @@ if __name__ == "__main__":
     parser.add_argument("--email-smtp-password", default=environ.get("EMAIL_SMTP_PASSWORD", "").strip())
     parser.add_argument("--email-to-address", default=environ.get("EMAIL_TO_ADDRESS", "").strip())
     parser.add_argument("--email-from-address", default=environ.get("EMAIL_FROM_ADDRESS", "").strip())
+    parser.add_argument("--email-log-max-bytes", type=int, default=environ.get("EMAIL_LOG_MAX_BYTES", str(5 * 1024 * 1024)).strip())
+
+    # Logging
+    #  Per-job problems are counted and summarized at the end of the run, so INFO stays small on large runs
+    parser.add_argument("--log-level", default=environ.get("LOG_LEVEL", "INFO").strip())
+    parser.add_argument("--log-file", default=environ.get("LOG_FILE", "/tmp/chargeback.log").strip())
+
+    # Run Summary
+    #  A JSON summary of stage times, throughput and counters, and optionally the same as a Prometheus textfile
+    parser.add_argument("--run-summary-file", default=environ.get("RUN_SUMMARY_FILE", "/tmp/chargeback_summary.json").strip())
+    parser.add_argument("--metrics-textfile", default=environ.get("METRICS_TEXTFILE", "").strip())
 
     # Specify output of "--version"
     parser.add_argument(
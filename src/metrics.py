@@ -0,0 +1,188 @@
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from logzero import logger
+from collections import Counter
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+"""
+Run metrics
+Stage timing for the ETL run, and output of the run summary as JSON and as a
+Prometheus textfile (node_exporter textfile collector / Pushgateway format).
+Histograms and the Prometheus text format are also used by the API's /metrics endpoint.
+"""
+
+class StageTimer:
+    """
+    Exclusive time spent in each ETL stage
+    Stages nest (E.g. the parser pulls jobs from the Slurm reader), and time is only counted
+    against the innermost running stage, so per thread the stage times add up to the wall time.
+    In pipeline mode the stages run in their own threads, so their times overlap.
+    """
+    def __init__(self):
+        self._totals = Counter()
+        self._items = Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _add(self, name, seconds):
+        with self._lock:
+            self._totals[name] += seconds
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of work as a stage
+        """
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+
+        # Pause the enclosing stage while this one runs
+        now = time.perf_counter()
+        if stack:
+            self._add(stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            stageName, start = stack.pop()
+            self._add(stageName, now - start)
+            if stack:
+                stack[-1][1] = now
+
+    def timeIterator(self, iterable, name):
+        """
+        Pass items through unchanged, timing the work done to produce each one as a stage, and counting them
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            with self._lock:
+                self._items[name] += 1
+            yield item
+
+    def getTotals(self):
+        """
+        Get the seconds spent in each stage, and the number of items each timed iterator produced
+        """
+        with self._lock:
+            return dict(self._totals), dict(self._items)
+
+def formatSummaryLines(summary):
+    """
+    Format a run summary as lines of text, E.g. for an email
+    """
+    lines = ["duration_sec: {:.1f}".format(summary["duration_sec"])]
+    for name, seconds in sorted(summary["stages"].items()):
+        lines.append("stage {}: {:.1f} sec".format(name, seconds))
+    for name, rate in sorted(summary["rates"].items()):
+        lines.append("{}: {:.1f}".format(name, rate))
+    for name, count in sorted(summary["counters"].items()):
+        lines.append("{}: {}".format(name, count))
+    for name, values in sorted(summary["distinct"].items()):
+        lines.append("{}: {} ({})".format(name, values["count"], ", ".join(str(value) for value in values["examples"])))
+    return lines
+
+def writeJsonSummary(path, summary):
+    """
+    Write the run summary as JSON, replacing the file atomically
+    """
+    with open(path + ".tmp", "w") as summaryFile:
+        json.dump(summary, summaryFile, indent=2, default=str)
+    os.replace(path + ".tmp", path)
+    logger.info("Wrote run summary to '%s'", path)
+
+class Histogram:
+    """
+    A Prometheus style histogram, with a set of cumulative buckets per label set
+    """
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, labelNames, buckets=DEFAULT_BUCKETS):
+        self._labelNames = tuple(labelNames)
+        self._buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelValues):
+        with self._lock:
+            series = self._series.get(labelValues)
+            if series is None:
+                series = self._series[labelValues] = {"buckets": [0] * len(self._buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self._buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def getSamples(self):
+        """
+        Get the histogram's samples for formatPrometheus
+        """
+        samples = []
+        with self._lock:
+            for labelValues, series in sorted(self._series.items()):
+                labels = dict(zip(self._labelNames, labelValues))
+                for bound, count in zip(self._buckets, series["buckets"]):
+                    samples.append(({**labels, "le": str(bound)}, count, "_bucket"))
+                samples.append(({**labels, "le": "+Inf"}, series["count"], "_bucket"))
+                samples.append((labels, round(series["sum"], 6), "_sum"))
+                samples.append((labels, series["count"], "_count"))
+        return samples
+
+def _escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def formatPrometheus(metrics):
+    """
+    Format metrics in the Prometheus text exposition format
+    metrics is a list of (name, type, help, [(labels dict, value), ...])
+    A sample may have a third item, a suffix for the sample name (E.g. '_bucket' for histograms)
+    """
+    lines = []
+    for name, metricType, helpText, samples in metrics:
+        lines.append("# HELP {} {}".format(name, helpText))
+        lines.append("# TYPE {} {}".format(name, metricType))
+        for sample in samples:
+            labels, value = sample[0], sample[1]
+            suffix = sample[2] if len(sample) > 2 else ""
+            labelText = ",".join('{}="{}"'.format(key, _escapeLabel(labelValue)) for key, labelValue in labels.items())
+            lines.append("{}{}{} {}".format(name, suffix, "{" + labelText + "}" if labelText else "", value))
+    return "\n".join(lines) + "\n"
+
+def writePrometheusTextfile(path, summary):
+    """
+    Write the run summary as Prometheus gauges, replacing the file atomically
+    The file can be read by the node_exporter textfile collector, or pushed to a Pushgateway as-is.
+    """
+    metrics = [
+        ("chargeback_run_success", "gauge", "1 if the last chargeback run succeeded",
+            [({}, int(summary["success"]))]),
+        ("chargeback_run_timestamp_seconds", "gauge", "UNIX time the last chargeback run finished",
+            [({}, summary["finished_unix"])]),
+        ("chargeback_run_duration_seconds", "gauge", "Wall time of the last chargeback run",
+            [({}, round(summary["duration_sec"], 3))]),
+        ("chargeback_stage_seconds", "gauge", "Time spent in each ETL stage in the last run",
+            [({"stage": name}, round(seconds, 3)) for name, seconds in sorted(summary["stages"].items())]),
+        ("chargeback_stage_rows_per_second", "gauge", "Throughput of each ETL stage in the last run",
+            [({"rate": name}, round(rate, 3)) for name, rate in sorted(summary["rates"].items())]),
+        ("chargeback_run_count", "gauge", "Counters of the last chargeback run",
+            [({"counter": name}, count) for name, count in sorted(summary["counters"].items())]),
+        ("chargeback_run_distinct", "gauge", "Distinct values behind run problems (E.g. unmapped UIDs) in the last run",
+            [({"counter": name}, values["count"]) for name, values in sorted(summary["distinct"].items())])
+    ]
+    with open(path + ".tmp", "w") as metricsFile:
+        metricsFile.write(formatPrometheus(metrics))
+    os.replace(path + ".tmp", path)
+    logger.info("Wrote Prometheus metrics to '%s'", path)
@@ -9,10 +9,12 @@ __license__ = "MIT"
 
 class Email:
 
-    def __init__(self, username, password, host, port, mailFrom, mailTo):
+    def __init__(self, username, password, host, port, mailFrom, mailTo, maxLogBytes=5 * 1024 * 1024):
         """
         Setup the SMTP Connection
+        Attached logs larger than maxLogBytes are cut down to their start and end
         """
+        self._maxLogBytes = maxLogBytes
         self._mail = Envelope()\
             .from_(mailFrom)\
             .to(mailTo)
@@ -39,26 +41,52 @@ class Email:
             logger.error(str(result))
             logger.error("Failed to send email")
 
-    def sendSuccessReport(self, insertedRecords, logfile):
+    def _attachLog(self, logfile):
+        """
+        Attach the run log, keeping only its first and last maxLogBytes/2 bytes if it is too large
+        """
+        path = Path(logfile)
+        size = path.stat().st_size
+        if size <= self._maxLogBytes:
+            self._mail.attach(path)
+            return
+
+        half = self._maxLogBytes // 2
+        with open(path, "rb") as logFile:
+            head = logFile.read(half)
+            logFile.seek(size - half)
+            tail = logFile.read(half)
+        marker = "\n\n... {} bytes of log removed, see {} on the host for the full log ...\n\n".format(size - 2 * half, logfile)
+        self._mail.attach(head + marker.encode() + tail, "text/plain", path.name)
+        logger.info("Log file is '%s' bytes, attached the first and last '%s' bytes", size, half)
+
+    def sendSuccessReport(self, insertedCount, logfile, summary=None):
         """
         Send a Successfully Completed Email
+        summary is an optional list of lines (E.g. the run event counts) added to the message
         """
+        message = "The DGX Chargeback process ran successfully and inserted '%s' completed jobs.\n See attached log for details." % (insertedCount)
+        if summary:
+            message += "\n\nRun Summary:\n" + "\n".join(summary)
 
         self._mail\
             .subject("DGX Chargeback Success")\
-            .message("The DGX Chargeback process ran successfully and inserted '%s' completed jobs.\n See attached log for details." % (len(insertedRecords)))\
-            .attach(Path(logfile))
+            .message(message)
+        self._attachLog(logfile)
 
         self._send()
 
-    def sendFailureReport(self, logfile):
+    def sendFailureReport(self, logfile, summary=None):
         """
         Send an exception Email
         """
+        message = "The DGX Chargeback process failed to complete.\nSee attached log for details."
+        if summary:
+            message += "\n\nRun Summary:\n" + "\n".join(summary)
+
         self._mail\
             .subject("DGX Chargeback Failure")\
-            .message("The DGX Chargeback process failed to complete.\nSee attached log for details.")\
-            .attach(Path(logfile))
+            .message(message)
+        self._attachLog(logfile)
 
         self._send()
-
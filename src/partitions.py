@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+DGX Chargeback Partition Maintenance
+
+Manages the monthly time_end partitions of the chargeback table.
+  - list:    Show the partitions and their approximate row counts
+  - init:    Partition an unpartitioned table by month (run once, after migration 004)
+  - add:     Add month partitions ahead of time, so new jobs never land in 'pmax'
+  - archive: Detach month partitions older than a retention period into their own tables
+"""
+
+__author__ = "Kalen Peterson"
+__version__ = "0.5.0"
+__license__ = "MIT"
+
+from os import environ
+from datetime import date
+import argparse
+import logzero
+from logzero import logger
+import common
+import database
+
+def getChargebackDb(args):
+    return database.ChargebackDb(
+        args.chargeback_db_table_name,
+        args.chargeback_db_username,
+        args.chargeback_db_password,
+        args.chargeback_db_host,
+        args.chargeback_db_port,
+        args.chargeback_db_schema_name,
+        backend=args.chargeback_db_backend)
+
+def getMonthOffset(months):
+    """
+    Get the 'YYYY-MM' month that is 'months' away from the current month
+    """
+    today = date.today()
+    index = today.year * 12 + today.month - 1 + months
+    return "{:04d}-{:02d}".format(index // 12, index % 12 + 1)
+
+def listPartitions(chargebackDb, args):
+    for partition in chargebackDb.getPartitions():
+        logger.info("{} < {} ({} rows)".format(partition['partition_name'], partition['less_than'], partition['table_rows']))
+
+def initPartitions(chargebackDb, args):
+    if chargebackDb.getPartitions():
+        raise Exception("Table '{}' is already partitioned".format(args.chargeback_db_table_name))
+    chargebackDb.partitionByMonth(args.start_month, getMonthOffset(args.future_months))
+
+def addPartitions(chargebackDb, args):
+    added = chargebackDb.addMonthPartitions(getMonthOffset(args.future_months))
+    logger.info("Added '{}' partitions: {}".format(len(added), added))
+
+def archivePartitions(chargebackDb, args):
+    """
+    Archive every month partition that ends on or before the start of the retention period
+    """
+    firstKeptMonth = getMonthOffset(-args.retention_months)
+    for partition in chargebackDb.getPartitions():
+        name = partition['partition_name']
+        if name in ('p_old', 'pmax'):
+            continue
+        if common.getNextMonth(common.getMonthFromPartitionName(name)) > firstKeptMonth:
+            continue
+        archiveTable = chargebackDb.archivePartition(name)
+        logger.info("Archived partition '{}' to table '{}'".format(name, archiveTable))
+
+def main(args):
+    """ Main entry point of the app """
+    logzero.loglevel(logzero.INFO)
+    logger.info("Starting DGX Chargeback Partition Maintenance '{}'".format(args.command))
+
+    with getChargebackDb(args) as chargebackDb:
+        args.func(chargebackDb, args)
+
+if __name__ == "__main__":
+    """ This is executed when run from the command line """
+    parser = argparse.ArgumentParser()
+
+    # Chargeback DB Settings
+    parser.add_argument("--chargeback-db-backend", default=environ.get("CHARGEBACK_DB_BACKEND", "mysql").strip())
+    parser.add_argument("--chargeback-db-host", default=environ.get("CHARGEBACK_DB_HOST", "").strip())
+    parser.add_argument("--chargeback-db-port", default=environ.get("CHARGEBACK_DB_PORT", "").strip())
+    parser.add_argument("--chargeback-db-schema-name", default=environ.get("CHARGEBACK_DB_SCHEMA_NAME", "").strip())
+    parser.add_argument("--chargeback-db-table-name", default=environ.get("CHARGEBACK_DB_TABLE_NAME", "").strip())
+    parser.add_argument("--chargeback-db-username", default=environ.get("CHARGEBACK_DB_USERNAME", "").strip())
+    parser.add_argument("--chargeback-db-password", default=environ.get("CHARGEBACK_DB_PASSWORD", "").strip())
+
+    # Number of months ahead of the current month to keep partitions for
+    parser.add_argument("--future-months", type=int, default=environ.get("PARTITION_FUTURE_MONTHS", "3").strip())
+
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    listParser = subparsers.add_parser("list")
+    listParser.set_defaults(func=listPartitions)
+
+    # Jobs that ended before start_month are kept in the 'p_old' partition
+    initParser = subparsers.add_parser("init")
+    initParser.add_argument("--start-month", default=environ.get("PARTITION_START_MONTH", "2021-01").strip())
+    initParser.set_defaults(func=initPartitions)
+
+    addParser = subparsers.add_parser("add")
+    addParser.set_defaults(func=addPartitions)
+
+    # Months before the current month to keep in the live table
+    archiveParser = subparsers.add_parser("archive")
+    archiveParser.add_argument("--retention-months", type=int, default=environ.get("PARTITION_RETENTION_MONTHS", "24").strip())
+    archiveParser.set_defaults(func=archivePartitions)
+
+    # Specify output of "--version"
+    parser.add_argument(
+        "--version",
+        action="version",
+        version="%(prog)s (version {version})".format(version=__version__))
+
+    args = parser.parse_args()
+    main(args)
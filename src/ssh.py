@@ -1,10 +1,9 @@
 from logzero import logger
 import paramiko
 from scp import SCPClient
-import timeout_decorator
-import os
-import pwd
-import grp
+from io import BytesIO
+import re
+import common
 
 __author__ = "Kalen Peterson"
 __version__ = "0.5.0"
@@ -12,19 +11,21 @@ __license__ = "MIT"
 
 class Ssh:
 
-    @timeout_decorator.timeout(30, timeout_exception=TimeoutError, exception_message="SSH Timeout (30 seconds)")
-    def __init__(self, hostname, port, username, password):
+    def __init__(self, hostname, port, username, password, timeout=30, scpTimeout=60):
         """
         Initialize the Connection to SSH Server
+        Timeouts are enforced on the sockets rather than with signals, so this is safe to use from any thread
         """
         self._host = hostname
         self._client = paramiko.SSHClient()
         self._client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._scp = None
+        self._identity = IdentityIndex()
         
         try:
             logger.info("Connecting to SSH Server: " + hostname)
-            self._client.connect(hostname, port, username, password)
+            self._client.connect(hostname, port, username, password,
+                                 timeout=timeout, banner_timeout=timeout, auth_timeout=timeout)
             logger.info("Sucessfully connected to SSH Server: " + hostname)
         except Exception as err:
             logger.error(err)
@@ -32,7 +33,7 @@ class Ssh:
 
         try:
             logger.info("Setting up SCP Connection: " + hostname)
-            self._scp = SCPClient(self._client.get_transport())
+            self._scp = SCPClient(self._client.get_transport(), socket_timeout=scpTimeout)
             logger.info("Sucessfully set up SCP Connection: " + hostname)
         except Exception as err:
             logger.error(err)
@@ -51,62 +52,160 @@ class Ssh:
             logger.warning("Failed to cleanly close the SSH Connection")
             pass
 
-    @timeout_decorator.timeout(60, timeout_exception=TimeoutError, exception_message="SCP Timeout (60 seconds)")
-    def getUsersAndGroups(self):
+    def getUsersAndGroups(self, groupSuffix='-G'):
         """
-        Copy the /etc/passwd and /etc/group files to local container
+        Copy the /etc/passwd and /etc/group files from the SSH Host into memory,
+        and index them for UID->Username and Username->Groups lookups.
+        The local container's /etc files are not modified.
         """
 
         logger.info("Collecting /etc/passwd and /etc/group from SSH Host")
 
         # Get /etc/passwd
         try:
-            self._scp.get('/etc/passwd','/etc/passwd')
+            passwdFile = self._getRemoteFile('/etc/passwd')
         except Exception as err:
             logger.error(err)
             raise Exception("Failed to get /etc/passwd file with SCP")
 
         # Get /etc/group
         try:
-            self._scp.get('/etc/group','/etc/group')
+            groupFile = self._getRemoteFile('/etc/group')
         except Exception as err:
             logger.error(err)
             raise Exception("Failed to get /etc/group file with SCP")
 
+        self._identity = IdentityIndex.fromFiles(passwdFile, groupFile, groupSuffix)
+
+    def _getRemoteFile(self, remotePath):
+        """
+        Copy a remote file with SCP and return its contents as a string
+        """
+        fileObj = BytesIO()
+        self._scp.getfo(remotePath, fileObj)
+        common.countEvent("ssh_bytes_copied", fileObj.tell())
+        return fileObj.getvalue().decode('utf-8', errors='replace')
+
+    def getIdentityIndex(self):
+        """
+        Get the in-memory identity index built by getUsersAndGroups
+        It holds no connections, so it can be shipped to worker processes
+        """
+        return self._identity
+
     def mapUidtoUsername(self, uid):
         """
         Map the UID to Username via the collected /etc/passwd file
         """
+        return self._identity.mapUidtoUsername(uid)
+
+    def mapUsernametoGroups(self, username):
+        """
+        Map the Username to a list of member groups via the collected /etc/group file
+        """
+        return self._identity.mapUsernametoGroups(username)
+
+    def mapUsernametoSuffixGroup(self, username):
+        """
+        Map the Username to its first member group ending in the group suffix (E.g '-G')
+        Returns None if the user has no such group
+        """
+        return self._identity.mapUsernametoSuffixGroup(username)
+
+
+class IdentityIndex:
+
+    def __init__(self, uidToUsername=None, usernameToGroups=None, usernameToSuffixGroup=None):
+        """
+        In-memory UID->Username and Username->Groups lookups, built from passwd and group files
+        """
+        self._uidToUsername = uidToUsername or {}
+        self._usernameToGroups = usernameToGroups or {}
+        self._usernameToSuffixGroup = usernameToSuffixGroup or {}
+
+    @classmethod
+    def fromFiles(cls, passwdFile, groupFile, groupSuffix='-G'):
+        """
+        Parse passwd and group file contents into lookup dictionaries
+        Group membership order matches os.getgrouplist: primary group first, then /etc/group order
+        """
+        gidToGroupname = {}
+        groupMembers = []
+        for line in groupFile.splitlines():
+            fields = line.split(':')
+            if len(fields) < 4 or line.startswith('#'):
+                continue
+            try:
+                gid = int(fields[2])
+            except ValueError:
+                continue
+            gidToGroupname.setdefault(gid, fields[0])
+            groupMembers.append((fields[0], [m for m in fields[3].split(',') if m]))
+
+        uidToUsername = {}
+        usernameToGroups = {}
+        for line in passwdFile.splitlines():
+            fields = line.split(':')
+            if len(fields) < 4 or line.startswith('#'):
+                continue
+            try:
+                uid = int(fields[2])
+                gid = int(fields[3])
+            except ValueError:
+                continue
+            uidToUsername.setdefault(uid, fields[0])
+            if fields[0] not in usernameToGroups:
+                primaryGroup = gidToGroupname.get(gid)
+                usernameToGroups[fields[0]] = [primaryGroup] if primaryGroup else []
+
+        for groupname, members in groupMembers:
+            for member in members:
+                groups = usernameToGroups.get(member)
+                if groups is not None and groupname not in groups:
+                    groups.append(groupname)
+
+        # Precompute the first group ending in the suffix (E.g '-G') for each user
+        r = re.compile("^.+" + re.escape(groupSuffix) + "$")
+        usernameToSuffixGroup = {}
+        for username, groups in usernameToGroups.items():
+            for groupname in groups:
+                if r.match(groupname):
+                    usernameToSuffixGroup[username] = groupname
+                    break
+
+        logger.info("Indexed '{}' users and '{}' groups from SSH Host".format(len(uidToUsername), len(gidToGroupname)))
+        return cls(uidToUsername, usernameToGroups, usernameToSuffixGroup)
+
+    def mapUidtoUsername(self, uid):
+        """
+        Map the UID to Username
+        """
 
         # 2024/10/22 RGK: skip the record if user's id has already expired in this billing cycle.
-        username = None
-        try:
-            user_record = pwd.getpwuid(uid)
-            username = user_record.pw_name
-        except Exception as err:
-            logger.error(err)
-            pass
+        username = self._uidToUsername.get(uid)
 
         if username:
-            logger.debug("Mapped UID '{}' to Username '{}'".format(uid, username))
             return str(username)
         else:
             #raise Exception('Failed to map UID to user')
-            logger.error("Failed to map UID to user")
+            #  Unmapped UIDs are counted and reported once per run (see common.getUsername)
             return 'UNKNOWN'
 
     def mapUsernametoGroups(self, username):
         """
-        Map the Username to a list of member groups via the collected /etc/group file
+        Map the Username to a list of member groups
         """
 
-        groups = []
-        user_record = pwd.getpwnam(username)
-        gid = user_record.pw_gid
-        groups = [grp.getgrgid(g).gr_name for g in os.getgrouplist(username, gid)]
+        groups = self._usernameToGroups.get(username)
 
         if groups:
-            logger.debug("Mapped Username '{}' to Groups '{}'".format(username, ','.join(groups)))
             return groups
         else:
-            raise Exception('Failed to map UID to member groups')
\ No newline at end of file
+            raise Exception('Failed to map UID to member groups')
+
+    def mapUsernametoSuffixGroup(self, username):
+        """
+        Map the Username to its first member group ending in the group suffix (E.g '-G')
+        Returns None if the user has no such group
+        """
+        return self._usernameToSuffixGroup.get(username)
@@ -0,0 +1,138 @@
+"""
+Columnar parser tests
+Feeds the same Slurm jobs through common.iterParseSlurmJobs and columnar.parseSlurmJobColumns,
+and checks both produce the same records and run events.
+Run from the repo root with: python -m unittest discover tests
+"""
+
+from pathlib import Path
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import columnar
+import common
+
+class FakeSsh:
+    """
+    Maps UIDs 20000-20002 to users. user2 has no '-G' group, UID 29999 is unmapped
+    """
+    uidToUsername = {20000: "user0", 20001: "user1", 20002: "user2"}
+    usernameToSuffixGroup = {"user0": "alpha-G", "user1": "beta-G"}
+
+    def mapUidtoUsername(self, uid):
+        return self.uidToUsername.get(uid, "UNKNOWN")
+
+    def mapUsernametoSuffixGroup(self, username):
+        return self.usernameToSuffixGroup.get(username)
+
+# 2024-03-10 07:00 UTC, when US/Eastern moves from EST to EDT
+DST_START = 1710054000
+
+def makeJobs():
+    """
+    Make jobs covering the parser's edge cases, ending either side of a DST change
+    """
+    shapes = [
+        # (id_user, account, state, tres_req, tres_alloc, partition)
+        (20000, "acct", 3, "1=8,1001=1", "1=8,1001=1", "batch"),
+        (20001, None, 5, "1=16,1001=2", None, "batch"),
+        (20002, None, 42, "1=4,1001=8", "1=4,1001=4", "interactive"),
+        (29999, "acct", 3, "1=4", "", "debug"),
+        (20000, "other", -1, "garbage", "1=4,1001=1", "batch"),
+        (20001, "acct", 7, "", None, "debug")
+    ]
+    jobs = []
+    for index in range(24):
+        idUser, account, state, tresReq, tresAlloc, partition = shapes[index % len(shapes)]
+        timeEnd = DST_START - 7200 + index * 600
+        jobs.append({
+            "job_db_inx": index + 1, "job_name": "train", "id_job": 1000 + index,
+            "time_start": timeEnd - 3600, "time_end": timeEnd, "cpus_req": 8, "exit_code": 0,
+            "id_user": idUser, "id_group": 30000, "nodelist": "dgx001", "nodes_alloc": 1,
+            "state": state, "tres_req": tresReq, "tres_alloc": tresAlloc, "account": account,
+            "partition": partition
+        })
+    return jobs
+
+def toColumns(jobs):
+    """
+    Convert job rows to a column batch (see SlurmDb.getJobsRangeColumnBatches)
+    """
+    return {key: [job[key] for job in jobs] for key in jobs[0]}
+
+class ColumnarParityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sshHost = FakeSsh()
+        self.slurmAssocIndex = {"user0": "alpha", "user1": None}
+        self.jobs = makeJobs()
+
+        # Run in a zone with DST, so local time conversion is exercised
+        self.oldTz = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+
+    def tearDown(self):
+        if self.oldTz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = self.oldTz
+        time.tzset()
+        common.resetEvents()
+
+    def parseBoth(self, slurmAssocBackend, slurmPartitionFilter, gpusUsedField):
+        """
+        Parse the jobs with the row and the columnar parser, returning the records and run events of each
+        """
+        results = []
+        for parse in (common.parseSlurmJobs, lambda jobs, *args: columnar.parseSlurmJobColumns(toColumns(jobs), *args)):
+            common.resetEvents()
+            slurmAssocIndex = dict(self.slurmAssocIndex)
+            records = parse(self.jobs, self.sshHost, slurmAssocBackend, slurmAssocIndex, slurmPartitionFilter, gpusUsedField)
+            results.append((records, common.getEvents()))
+        return results
+
+    def assertParity(self, slurmAssocBackend, slurmPartitionFilter, gpusUsedField):
+        (rowRecords, rowEvents), (columnRecords, columnEvents) = self.parseBoth(slurmAssocBackend, slurmPartitionFilter, gpusUsedField)
+        self.assertEqual(columnRecords, rowRecords)
+        self.assertEqual(columnEvents, rowEvents)
+        return rowRecords, rowEvents
+
+    def test_etc_group_tres_req(self):
+        records, events = self.assertParity("etc_group", "", "tres_req")
+        self.assertEqual(len(records), len(self.jobs))
+        self.assertEqual(events[1]["unparseable_tres"], {"garbage"})
+
+    def test_slurm_acctdb_tres_alloc(self):
+        records, events = self.assertParity("slurm_acctdb", "", "tres_alloc")
+        # NULL and empty tres_alloc fall back to the requested GPUs
+        byId = {record["slurm_id_job"]: record for record in records}
+        self.assertEqual(byId[1001]["gpus_used"], 2)
+        self.assertEqual(byId[1002]["gpus_used"], 4)
+        self.assertEqual(events[1]["users_with_null_slurm_account"], {"user1"})
+
+    def test_partition_filter(self):
+        records, events = self.assertParity("etc_group", "debug", "tres_alloc")
+        self.assertNotIn("debug", [record["partition"] for record in records])
+        self.assertEqual(events[0]["jobs_skipped_by_partition_filter"], 8)
+
+    def test_unknown_state(self):
+        records, _ = self.assertParity("etc_group", "", "tres_req")
+        states = {record["slurm_job_state"]: record["job_result"] for record in records}
+        self.assertEqual(states[42], "UNKNOWN")
+        self.assertEqual(states[-1], "UNKNOWN")
+        self.assertEqual(states[3], "COMPLETED")
+
+    def test_local_time_across_dst(self):
+        records, _ = self.assertParity("etc_group", "", "tres_req")
+        timeEnds = {record["slurm_id_job"]: record["time_end"] for record in records}
+        # 1 hour before and exactly at the change, in local time
+        self.assertEqual(timeEnds[1006], "2024-03-10 01:00:00")
+        self.assertEqual(timeEnds[1012], "2024-03-10 03:00:00")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+Daily rollup tests
+Runs main.main against an embedded SQLite Chargeback DB, with the Slurm DB, SSH host and
+email replaced, and checks the rollup matches the raw jobs after a run fails part way.
+Run from the repo root with: python -m unittest discover tests
+"""
+
+from datetime import datetime, time
+from pathlib import Path
+from unittest import mock
+import argparse
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import database
+import main
+
+class FakeSlurmDb:
+    """
+    Serves a fixed list of jobs. Raises after failAfter jobs, if set
+    """
+    jobs = []
+    failAfter = None
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getJobsRangeStream(self, startDate, endDate, batchSize=5000):
+        for index, job in enumerate(self.jobs):
+            if self.failAfter is not None and index >= self.failAfter:
+                raise Exception("Lost connection to the Slurm DB")
+            if startDate <= job["time_end"] <= endDate:
+                yield job
+
+class FakeSsh:
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def getUsersAndGroups(self):
+        pass
+
+    def mapUidtoUsername(self, uid):
+        return "user{}".format(uid)
+
+def makeJobs(count):
+    """
+    Make count 1 GPU, 1 hour jobs, spread over the last 3 days
+    """
+    midnight = int(datetime.combine(datetime.today(), time.min).timestamp())
+    jobs = []
+    for index in range(count):
+        timeEnd = midnight - 3600 - (index % 3) * 86400 - index
+        jobs.append({
+            "job_db_inx": index + 1, "job_name": "train", "id_job": 1000 + index,
+            "time_start": timeEnd - 3600, "time_end": timeEnd, "cpus_req": 8, "exit_code": 0,
+            "id_user": 20000 + index % 2, "id_group": 30000, "nodelist": "dgx001", "nodes_alloc": 1,
+            "state": 3, "tres_req": "1=8,1001=1", "tres_alloc": "1=8,1001=1", "account": "acct",
+            "partition": "batch"
+        })
+    return jobs
+
+class RollupAfterFailureTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.dbPath = str(Path(self.tempDir.name) / "chargeback.db")
+        self.args = argparse.Namespace(
+            clusters_config="", cluster_workers=1, slurm_job_prev_days=5,
+            slurm_job_incremental=False, slurm_job_overlap_hours=24, slurm_job_full_backfill=False,
+            gpus_used_field="tres_req", pipeline=False, pipeline_queue_size=4,
+            parse_engine="row", parse_workers=1, parse_chunk_size=5000,
+            slurm_assoc_backend="etc_group", slurm_partition_filter="",
+            slurm_cluster_name="test", slurm_db_host="", slurm_db_port="", slurm_db_username="",
+            slurm_db_password="", slurm_db_fetch_batch_size=5000,
+            chargeback_db_backend="sqlite", chargeback_db_host="", chargeback_db_port="",
+            chargeback_db_schema_name=self.dbPath, chargeback_db_table_name="gpu_usage",
+            chargeback_db_rollup_table_name="gpu_usage_daily",
+            chargeback_db_watermark_table_name="chargeback_watermark",
+            chargeback_db_generation_table_name="chargeback_generation",
+            chargeback_db_username="", chargeback_db_password="",
+            rollup_min_job_duration_sec=60, chargeback_db_insert_chunk_size=2,
+            ssh_host="", ssh_port="", ssh_username="", ssh_password="", ssh_file_cleanup="",
+            email_smtp_host="", email_smtp_port="", email_smtp_username="", email_smtp_password="",
+            email_to_address="", email_from_address="", email_log_max_bytes=1024,
+            log_level="ERROR", log_file=str(Path(self.tempDir.name) / "chargeback.log"),
+            run_summary_file="", metrics_textfile="")
+        FakeSlurmDb.jobs = makeJobs(9)
+        FakeSlurmDb.failAfter = None
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def runMain(self):
+        with mock.patch.object(main.database, "SlurmDb", FakeSlurmDb), \
+             mock.patch.object(main.ssh, "Ssh", FakeSsh), \
+             mock.patch.object(main.notification, "Email") as email:
+            main.main(self.args)
+        return email.return_value
+
+    def getJobCounts(self):
+        """
+        Get the number of jobs in the raw table and in the rollup
+        """
+        with sqlite3.connect(self.dbPath) as cnx:
+            rawCount = cnx.execute("SELECT COUNT(*) FROM gpu_usage").fetchone()[0]
+            rollupCount = cnx.execute("SELECT COALESCE(SUM(job_count), 0) FROM gpu_usage_daily").fetchone()[0]
+        return rawCount, rollupCount
+
+    def test_failed_load_is_rolled_up(self):
+        # The first chunks commit before the Slurm DB fails
+        FakeSlurmDb.failAfter = 5
+        email = self.runMain()
+        email.sendFailureReport.assert_called_once()
+
+        rawCount, rollupCount = self.getJobCounts()
+        self.assertEqual(rawCount, 4)
+        self.assertEqual(rollupCount, rawCount)
+
+    def test_failed_rollup_is_rebuilt_by_next_run(self):
+        with mock.patch.object(database.ChargebackDb, "updateDailyRollup", side_effect=Exception("Deadlock")):
+            email = self.runMain()
+        email.sendFailureReport.assert_called_once()
+        self.assertEqual(self.getJobCounts(), (9, 0))
+
+        # Every job is now a duplicate, but their days are still rebuilt
+        email = self.runMain()
+        email.sendSuccessReport.assert_called_once()
+        self.assertEqual(email.sendSuccessReport.call_args[0][0], 0)
+        self.assertEqual(self.getJobCounts(), (9, 9))
+
+if __name__ == "__main__":
+    unittest.main()